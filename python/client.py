@@ -24,17 +24,22 @@
 import dbus
 import dbus.service
 import dbus.mainloop.glib
+import json
 import logging
+import os
 import os.path
 import sys
+import time
 import inspect
 
+from collections import deque, OrderedDict
 from xml.etree import ElementTree
 
 dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
 from zeitgeist.datamodel import (Event, Subject, TimeRange, StorageState,
-	ResultType)
+	ResultType, EventBatch, compile_templates, TemplateIndex,
+	get_timestamp_for_now)
 
 SIG_EVENT = "asaasay"
 
@@ -53,6 +58,57 @@ def _set_bus(bus):
 	global session_bus
 	session_bus = bus
 
+# Description of the D-Bus interfaces of the Zeitgeist engine and its
+# extensions, as a tuple with a dictionary mapping the name of each method
+# to the signature of its arguments and a list of signals. Using them
+# instead of introspecting the engine avoids blocking on a round-trip at
+# startup and every time the engine is restarted.
+_SIG_EVENTS = "a(%s)" % SIG_EVENT
+KNOWN_INTERFACES = {
+	"org.gnome.zeitgeist.Log": ({
+		"DeleteEvents": "au",
+		"FindEventIds": "(xx)%suuu" % _SIG_EVENTS,
+		"FindEvents": "(xx)%suuu" % _SIG_EVENTS,
+		"FindRelatedUris": "(xx)%s%suuu" % (_SIG_EVENTS, _SIG_EVENTS),
+		"GetEvents": "au",
+		"InsertEvents": _SIG_EVENTS,
+		"InstallMonitor": "o(xx)%s" % _SIG_EVENTS,
+		"RemoveMonitor": "o",
+		"Quit": "",
+	}, []),
+	"org.gnome.zeitgeist.DataSourceRegistry": ({
+		"GetDataSources": "",
+		"RegisterDataSource": "sss%s" % _SIG_EVENTS,
+		"SetDataSourceEnabled": "sb",
+		"GetDataSourceFromId": "s",
+	}, ["DataSourceDisconnected", "DataSourceEnabled",
+		"DataSourceRegistered"]),
+	"org.gnome.zeitgeist.Blacklist": ({
+		"AddTemplate": "s(%s)" % SIG_EVENT,
+		"GetTemplates": "",
+		"RemoveTemplate": "s",
+	}, ["TemplateAdded", "TemplateRemoved"]),
+	"org.gnome.zeitgeist.Index": ({
+		"Search": "s(xx)%suuu" % _SIG_EVENTS,
+		"SearchWithRelevancies": "s(xx)%suuuu" % _SIG_EVENTS,
+	}, []),
+	"org.gnome.zeitgeist.Histogram": ({
+		"GetHistogramData": "",
+	}, []),
+	"org.gnome.zeitgeist.StorageMonitor": ({
+		"GetStorages": "",
+	}, ["StorageAvailable", "StorageUnavailable"]),
+}
+
+def _get_object(bus_name, object_path, interface_name, introspect=False):
+	"""
+	Return a proxy for the given object, which only introspects it if
+	the interface isn't known in advance or *introspect* is True
+	"""
+	return get_bus().get_object(bus_name, object_path,
+		introspect=introspect or interface_name not in KNOWN_INTERFACES,
+		follow_name_owner_changes=True)
+
 class _DBusInterface(object):
 	"""Wrapper around dbus.Interface adding convenience methods."""
 
@@ -81,9 +137,8 @@ class _DBusInterface(object):
 	def reconnect(self):
 		if not self._reconnect_when_needed:
 			return
-		self.__proxy = get_bus().get_object(
-			self.__iface.requested_bus_name, self.__object_path,
-			follow_name_owner_changes=True)
+		self.__proxy = _get_object(self.__iface.requested_bus_name,
+			self.__object_path, self.__interface_name, self._introspect)
 		self.__iface = dbus.Interface(self.__proxy, self.__interface_name)
 		self._load_introspection_data()
 
@@ -124,11 +179,14 @@ class _DBusInterface(object):
 	def __getattr__(self, name):
 		if self.__methods is not None and name not in self.__methods:
 			raise TypeError("Unknown method name: %s" % name)
+		signature = self.__signatures.get(name)
 		def _ProxyMethod(*args, **kwargs):
 			"""
 			Method wrapping around a D-Bus call, which attempts to recover
 			the connection to Zeitgeist if it got lost.
 			"""
+			if signature is not None:
+				kwargs.setdefault("signature", signature)
 			return self._disconnection_safe(
 				lambda: getattr(self.__iface, name), *args, **kwargs)
 		return _ProxyMethod
@@ -140,9 +198,9 @@ class _DBusInterface(object):
 
 	def connect(self, signal, callback, **kwargs):
 		"""Connect a callback to a signal of the current proxy instance."""
-		if self.__signals is None:
+		if self.__signals is None and self._introspect:
 			self.reconnect()
-		if signal not in self.__signals:
+		if self.__signals is not None and signal not in self.__signals:
 			raise TypeError("Unknown signal name: %s" % signal)
 		return self.__proxy.connect_to_signal(
 			signal,
@@ -167,16 +225,29 @@ class _DBusInterface(object):
 		return self.__proxy
 
 	def _load_introspection_data(self):
-		self.__methods, self.__signals = self.get_members(
-			self.__proxy.Introspect(
-				dbus_interface='org.freedesktop.DBus.Introspectable'))
+		self.__signatures = {}
+		if self._introspect:
+			self.__methods, self.__signals = self.get_members(
+				self.__proxy.Introspect(
+					dbus_interface='org.freedesktop.DBus.Introspectable'))
+		else:
+			self.__signatures, self.__signals = \
+				KNOWN_INTERFACES[self.__interface_name]
+			self.__methods = self.__signatures.keys()
 
-	def __init__(self, proxy, interface_name, object_path, reconnect=True):
+	def __init__(self, proxy, interface_name, object_path, reconnect=True,
+		introspect=False):
+		"""
+		The interface description is taken from :data:`KNOWN_INTERFACES`.
+		If *introspect* is True, or for unknown interfaces, the object is
+		introspected instead, which blocks until the remote side replies.
+		"""
 		self.__proxy = proxy
 		self.__interface_name = interface_name
 		self.__object_path = object_path
 		self.__iface = dbus.Interface(proxy, interface_name)
 		self._reconnect_when_needed = reconnect
+		self._introspect = introspect or interface_name not in KNOWN_INTERFACES
 		self._load_introspection_data()
 		
 		self._first_connection = True
@@ -186,7 +257,8 @@ class _DBusInterface(object):
 		# Listen to (dis)connection notifications, for connect_exit and connect_join
 		def name_owner_changed(connection_name):
 			if connection_name == "":
-				self.__methods = self.__signals = None
+				if self._introspect:
+					self.__methods = self.__signals = None
 				for callback in self._disconnect_callbacks:
 					callback()
 			elif self._first_connection:
@@ -210,6 +282,9 @@ class ZeitgeistDBusInterface(object):
 	interface class, but all instances should share the same state
 	(like use the same bus and be connected to the same proxy). This is
 	achieved by extending the `Borg Pattern` as described by Alex Martelli	
+	
+	The interfaces are described by :data:`KNOWN_INTERFACES`, set
+	*introspect* to True to introspect the engine instead.
 	"""
 	__shared_state = {}
 	
@@ -244,20 +319,22 @@ class ZeitgeistDBusInterface(object):
 		if not name in cls.__shared_state["extension_interfaces"]:
 			interface_name = "org.gnome.zeitgeist.%s" % name
 			object_path = "/org/gnome/zeitgeist/%s" % path
-			proxy = get_bus().get_object(busname, object_path,
-				follow_name_owner_changes=True)
-			iface = _DBusInterface(proxy, interface_name, object_path)
+			introspect = cls.__shared_state["introspect"]
+			proxy = _get_object(busname, object_path, interface_name,
+				introspect)
+			iface = _DBusInterface(proxy, interface_name, object_path,
+				introspect=introspect)
 			iface.BUS_NAME = busname
 			iface.INTERFACE_NAME = interface_name
 			iface.OBJECT_PATH = object_path
 			cls.__shared_state["extension_interfaces"][name] = iface
 		return cls.__shared_state["extension_interfaces"][name]
 	
-	def __init__(self, reconnect=True):
+	def __init__(self, reconnect=True, introspect=False):
 		if not "dbus_interface" in self.__shared_state:
 			try:
-				proxy = get_bus().get_object(self.BUS_NAME,
-					self.OBJECT_PATH, follow_name_owner_changes=True)
+				proxy = _get_object(self.BUS_NAME, self.OBJECT_PATH,
+					self.INTERFACE_NAME, introspect)
 			except dbus.exceptions.DBusException, e:
 				if e.get_dbus_name() == "org.freedesktop.DBus.Error.ServiceUnknown":
 					raise RuntimeError(
@@ -266,8 +343,9 @@ class ZeitgeistDBusInterface(object):
 				else:
 					raise
 			self.__shared_state["extension_interfaces"] = {}
+			self.__shared_state["introspect"] = introspect
 			self.__shared_state["dbus_interface"] = _DBusInterface(proxy,
-				self.INTERFACE_NAME, self.OBJECT_PATH, reconnect)
+				self.INTERFACE_NAME, self.OBJECT_PATH, reconnect, introspect)
 
 class Monitor(dbus.service.Object):
 	"""
@@ -280,15 +358,42 @@ class Monitor(dbus.service.Object):
 	It is important to understand that the Monitor instance lives on the
 	client side, and expose a DBus service there, and the Zeitgeist engine
 	calls back to the monitor when matching events are registered.
+	
+	Notifications can be coalesced, so that a burst of insertions or
+	deletions results in a single call to the callbacks: they are held
+	back for up to *coalesce_delay* milliseconds after the first one
+	arrives, or until *coalesce_size* events (or deleted event ids) have
+	accumulated. The delivered time ranges cover all merged notifications,
+	and events deleted while their insertion was held back are dropped
+	from both notifications.
+	
+	Monitors keep track of the most recent timestamp and the highest
+	event id they have delivered to the *insert_callback*, see
+	:meth:`get_resume_token`; until the first delivery, resumable
+	monitors get a token for the time they were installed at. When *resume* is True, the events missed
+	while the monitor wasn't installed (eg. because the engine was being
+	restarted) are looked up and delivered after reinstalling it,
+	:attr:`CATCH_UP_LIMIT` events at a time. The lookup starts from the
+	timestamp of the token, so events inserted with older timestamps
+	aren't caught up. An initial *resume_token* makes the
+	monitor catch up right after being installed. *resume_file* is
+	the path of a JSON file from which the initial token is read and
+	where it is saved as it changes, so that the monitor can be resumed
+	by a different process; it implies *resume*.
 	"""
 	
 	# Used in Monitor._next_path() to generate unique path names
 	_last_path_id = 0
 	
+	# Number of missed events fetched at a time when catching up
+	CATCH_UP_LIMIT = 1000
+	
 	_event_type = Event
 
 	def __init__ (self, time_range, event_templates, insert_callback,
-		delete_callback, monitor_path=None, event_type=None):
+		delete_callback, monitor_path=None, event_type=None,
+		coalesce_delay=0, coalesce_size=0, resume=False, resume_token=None,
+		resume_file=None):
 		if not monitor_path:
 			monitor_path = Monitor._next_path()
 		elif isinstance(monitor_path, (str, unicode)):
@@ -304,6 +409,27 @@ class Monitor(dbus.service.Object):
 		self._path = monitor_path
 		self._insert_callback = insert_callback
 		self._delete_callback = delete_callback
+		
+		self._coalesce = bool(coalesce_delay or coalesce_size)
+		self._coalesce_delay = coalesce_delay
+		self._coalesce_size = coalesce_size
+		self._pending_inserts = OrderedDict()
+		self._pending_deletes = []
+		self._pending_delete_range = None
+		self._pending_count = 0
+		self._flush_source = None
+		
+		self._resume = bool(resume or resume_token or resume_file)
+		self._resume_file = resume_file
+		if resume_file and resume_token is None:
+			resume_token = self._load_resume_token(resume_file)
+		self._resume_token = resume_token
+		self._save_source = None
+		# Notifications received while catching up, the id of the last
+		# event delivered before and the ids of the missed events
+		self._held_back = None
+		self._catch_up_from = None
+		self._missed_ids = set()
 		dbus.service.Object.__init__(self, get_bus(), monitor_path)
 	
 	def get_path (self): return self._path
@@ -335,8 +461,20 @@ class Monitor(dbus.service.Object):
 		    with the events matching the monitor.
 		    See :meth:`ZeitgeistClient.install_monitor`
 		"""
-		self._insert_callback(TimeRange(time_range[0], time_range[1]),
-			map(self._event_type, events))
+		events = map(self._event_type.new_for_raw_struct, events)
+		if self._held_back is not None:
+			self._held_back.extend(events)
+			return
+		self._notify_insert(TimeRange(time_range[0], time_range[1]), events)
+	
+	def _notify_insert(self, time_range, events):
+		if not self._coalesce:
+			self._update_resume_token(events)
+			self._insert_callback(time_range, events)
+			return
+		for event in events:
+			self._pending_inserts[event.id] = event
+		self._notification_held(len(events))
 	
 	@dbus.service.method("org.gnome.zeitgeist.Monitor",
 	                     in_signature="(xx)au")
@@ -357,7 +495,169 @@ class Monitor(dbus.service.Object):
 		:param event_ids: A list of event ids. An event id is simply
 		    and unsigned 32 bit integer. DBus signature au.
 		"""
-		self._delete_callback(TimeRange(time_range[0], time_range[1]), event_ids)
+		time_range = TimeRange(time_range[0], time_range[1])
+		if not self._coalesce:
+			self._delete_callback(time_range, event_ids)
+			return
+		for event_id in event_ids:
+			# Don't report events which were never reported as inserted
+			if self._pending_inserts.pop(event_id, None) is None:
+				self._pending_deletes.append(event_id)
+		if self._pending_delete_range is None:
+			self._pending_delete_range = time_range
+		else:
+			self._pending_delete_range = TimeRange(
+				min(self._pending_delete_range.begin, time_range.begin),
+				max(self._pending_delete_range.end, time_range.end))
+		self._notification_held(len(event_ids))
+	
+	def get_resume_token(self):
+		"""
+		Return a dictionary with the highest "timestamp" and "event_id"
+		of the events this monitor delivered, or None if there weren't
+		any (and the monitor hasn't been given a token when installed)
+		"""
+		if self._resume_token is None:
+			return None
+		return dict(self._resume_token)
+	
+	def is_resumable(self):
+		return self._resume
+	
+	def _update_resume_token(self, events):
+		if not events:
+			return
+		self._advance_resume_token(
+			max(int(event.timestamp) for event in events),
+			max(event.id for event in events))
+	
+	def _advance_resume_token(self, timestamp, event_id):
+		token = self._resume_token
+		if token is not None:
+			timestamp = max(timestamp, token["timestamp"])
+			event_id = max(event_id, token["event_id"])
+		self._resume_token = {"timestamp": timestamp, "event_id": event_id}
+		if self._resume_file and self._save_source is None:
+			self._save_source = _get_glib().timeout_add(1000,
+				self._save_timeout)
+	
+	@staticmethod
+	def _load_resume_token(path):
+		try:
+			with open(path) as token_file:
+				token = json.load(token_file)
+			return {"timestamp": int(token["timestamp"]),
+				"event_id": int(token["event_id"])}
+		except IOError:
+			return None
+		except (ValueError, KeyError, TypeError), e:
+			log.warn("Ignoring invalid resume token in %s: %s" % (path, e))
+			return None
+	
+	def _save_timeout(self):
+		self._save_source = None
+		self.save_resume_token()
+		return False
+	
+	def save_resume_token(self):
+		"""
+		Write the resume token to the *resume_file*, if any. This is
+		done automatically (at most once per second) when it changes.
+		"""
+		if self._save_source is not None:
+			_get_glib().source_remove(self._save_source)
+			self._save_source = None
+		if not self._resume_file or self._resume_token is None:
+			return
+		temp_path = "%s.tmp" % self._resume_file
+		with open(temp_path, "w") as token_file:
+			json.dump(self._resume_token, token_file)
+		os.rename(temp_path, self._resume_file)
+	
+	def _begin_catch_up(self):
+		"""
+		Hold back notifications until :meth:`_end_catch_up` is called,
+		and return the time range to look up the missed events in (None
+		if there is nothing to catch up)
+		"""
+		if self._resume_token is None:
+			return None
+		begin = max(self._resume_token["timestamp"], self._time_range[0])
+		if begin > self._time_range[1]:
+			return None
+		if self._held_back is None:
+			self._held_back = []
+			self._catch_up_from = self._resume_token["event_id"]
+			self._missed_ids = set()
+		return TimeRange(begin, self._time_range[1])
+	
+	def _get_missed_ids(self, event_ids):
+		"""
+		Return the ids of the events found in the catch up time range
+		which the monitor wasn't notified about, in the same order
+		"""
+		missed_ids = [event_id for event_id in event_ids
+			if event_id > self._catch_up_from]
+		self._missed_ids.update(missed_ids)
+		return missed_ids
+	
+	def _catch_up_events(self, events):
+		"""
+		Deliver some of the missed events, as returned for the ids from
+		:meth:`_get_missed_ids`
+		"""
+		events = [event for event in events if event is not None]
+		if events:
+			timestamps = [int(event.timestamp) for event in events]
+			self._notify_insert(TimeRange(min(timestamps), max(timestamps)),
+				events)
+	
+	def _end_catch_up(self):
+		held_back, self._held_back = self._held_back or [], None
+		missed_ids, self._missed_ids = self._missed_ids, set()
+		events = []
+		for event in held_back:
+			if event.id > self._catch_up_from and \
+				event.id not in missed_ids:
+				missed_ids.add(event.id)
+				events.append(event)
+		self._catch_up_events(events)
+	
+	def _notification_held(self, count):
+		self._pending_count += count
+		if self._coalesce_size and self._pending_count >= self._coalesce_size:
+			self.flush()
+		elif self._flush_source is None:
+			self._flush_source = _get_glib().timeout_add(
+				self._coalesce_delay, self._flush_timeout)
+	
+	def _flush_timeout(self):
+		self._flush_source = None
+		self.flush()
+		return False
+	
+	def flush(self):
+		"""
+		Deliver the notifications held back for coalescing right away
+		"""
+		if self._flush_source is not None:
+			_get_glib().source_remove(self._flush_source)
+			self._flush_source = None
+		events = self._pending_inserts.values()
+		event_ids = self._pending_deletes
+		delete_range = self._pending_delete_range
+		self._pending_inserts.clear()
+		self._pending_deletes = []
+		self._pending_delete_range = None
+		self._pending_count = 0
+		
+		if events:
+			timestamps = [int(event.timestamp) for event in events]
+			self._update_resume_token(events)
+			self._insert_callback(TimeRange(min(timestamps), max(timestamps)),
+				events)
+		if event_ids:
+			self._delete_callback(delete_range, event_ids)
 	
 	def __hash__ (self):
 		return hash(self._path)
@@ -371,6 +671,200 @@ class Monitor(dbus.service.Object):
 		return dbus.ObjectPath("/org/gnome/zeitgeist/monitor/%s" % \
 			cls._last_path_id)
 
+# Template matching no event at all (no actor can not start with ""), for
+# monitors which only care about deletions
+_NO_INSERTIONS_TEMPLATE = Event.new_for_values(actor="!*")
+
+class _EventCache(object):
+	"""
+	Size-bounded LRU cache of events by id, used by ZeitgeistClient when
+	enable_event_cache() is called
+	"""
+	
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self._events = OrderedDict()
+		# Increased on every invalidation. While GetEvents requests are
+		# in flight, the ids removed meanwhile map to the epoch of their
+		# removal, so that replies to requests sent before it don't add
+		# them back
+		self.epoch = 0
+		self._cleared_epoch = 0
+		self._removed = {}
+		self._requests = 0
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+	
+	def get(self, event_id):
+		try:
+			event = self._events.pop(event_id)
+		except KeyError:
+			self.misses += 1
+			return None
+		self._events[event_id] = event
+		self.hits += 1
+		return event
+	
+	def add(self, event):
+		self._events.pop(event.id, None)
+		self._events[event.id] = event
+		while len(self._events) > self.max_size:
+			self._events.popitem(last=False)
+	
+	def add_fetched(self, event, epoch):
+		"""
+		Add an event received in reply to a request sent at *epoch*
+		(see :meth:`begin_request`), unless it was removed since then
+		"""
+		if epoch >= self._cleared_epoch and \
+			self._removed.get(event.id, epoch) <= epoch:
+			self.add(event)
+	
+	def begin_request(self):
+		"""
+		Return the current epoch, for a request whose reply is passed
+		to :meth:`add_fetched`. :meth:`end_request` must be called
+		once it's answered.
+		"""
+		self._requests += 1
+		return self.epoch
+	
+	def end_request(self):
+		self._requests -= 1
+		if not self._requests:
+			self._removed.clear()
+	
+	def remove(self, event_ids):
+		self.epoch += 1
+		for event_id in event_ids:
+			if self._requests:
+				self._removed[event_id] = self.epoch
+			if self._events.pop(event_id, None) is not None:
+				self.invalidations += 1
+	
+	def clear(self):
+		self.epoch += 1
+		self._cleared_epoch = self.epoch
+		self._events.clear()
+	
+	def get_stats(self):
+		return {
+			"size": len(self._events),
+			"max_size": self.max_size,
+			"hits": self.hits,
+			"misses": self.misses,
+			"invalidations": self.invalidations,
+		}
+
+def _make_query_key(kind, timerange, event_templates, storage_state,
+	num_events, result_type):
+	"""
+	Return a hashable key identifying a query, for caching and coalescing
+	"""
+	if timerange is not None:
+		timerange = (int(timerange[0]), int(timerange[1]))
+	templates = tuple((tuple(template[0]),
+		tuple(tuple(subject) for subject in template[1]),
+		tuple(template[2])) for template in event_templates)
+	return (kind, timerange, templates, int(storage_state),
+		int(num_events), int(result_type))
+
+class _QueryCache(object):
+	"""
+	Size-bounded LRU cache of query results, used by ZeitgeistClient when
+	enable_query_cache() is called
+	"""
+	
+	def __init__(self, max_size):
+		self.max_size = max_size
+		# key -> (time range, template matcher, result)
+		self._entries = OrderedDict()
+		# Increased on every invalidation, so that replies to queries
+		# sent before it aren't cached
+		self.epoch = 0
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+	
+	def get(self, key):
+		try:
+			entry = self._entries.pop(key)
+		except KeyError:
+			self.misses += 1
+			return None
+		self._entries[key] = entry
+		self.hits += 1
+		return entry[2]
+	
+	def get_storing_handler(self, key, timerange, event_templates,
+		reply_handler):
+		"""
+		Wrap *reply_handler* so that the result is also stored in the
+		cache, unless there was an invalidation in the meantime
+		"""
+		epoch = self.epoch
+		def storing_handler(result):
+			if self.epoch == epoch:
+				self._add(key, timerange, event_templates, result)
+			reply_handler(result)
+		return storing_handler
+	
+	def _add(self, key, timerange, event_templates, result):
+		if timerange is None:
+			# TimeRange.until_now() is relative to the moment of the query
+			timerange = TimeRange.always()
+		try:
+			matches = compile_templates(event_templates)
+		except ValueError:
+			# Can't match locally, invalidate on any insertion
+			matches = None
+		self._entries.pop(key, None)
+		self._entries[key] = (timerange, matches, result)
+		while len(self._entries) > self.max_size:
+			self._entries.popitem(last=False)
+	
+	def _invalidate(self, predicate):
+		self.epoch += 1
+		for key, entry in self._entries.items():
+			if predicate(entry[0], entry[1]):
+				del self._entries[key]
+				self.invalidations += 1
+	
+	def invalidate_insertion(self, time_range, events):
+		"""
+		Drop the results which may be affected by the insertion of
+		*events*: those with a matching template and time range
+		"""
+		timestamps = [int(event.timestamp) for event in events]
+		def is_affected(timerange, matches):
+			for timestamp, event in zip(timestamps, events):
+				if timerange[0] <= timestamp <= timerange[1] and \
+				(matches is None or matches(event)):
+					return True
+			return False
+		self._invalidate(is_affected)
+	
+	def invalidate_deletion(self, time_range):
+		"""
+		Drop the results whose time range overlaps *time_range*
+		"""
+		self._invalidate(lambda timerange, matches:
+			timerange.intersect(time_range) is not None)
+	
+	def clear(self):
+		self.epoch += 1
+		self._entries.clear()
+	
+	def get_stats(self):
+		return {
+			"size": len(self._entries),
+			"max_size": self.max_size,
+			"hits": self.hits,
+			"misses": self.misses,
+			"invalidations": self.invalidations,
+		}
+
 class ZeitgeistClient:
 	"""
 	Convenience APIs to have a Pythonic way to call and monitor the running
@@ -384,6 +878,14 @@ class ZeitgeistClient:
 	
 	_installed_monitors = []
 	_event_type = Event
+	_event_cache = None
+	_event_cache_monitor = None
+	_query_cache = None
+	_query_cache_monitor = None
+	_in_flight_queries = None
+	_get_events_window = 0
+	_pending_get_events = None
+	_subject_classifier = None
 	
 	@staticmethod
 	def get_event_and_extra_arguments(arguments):
@@ -411,10 +913,18 @@ class ZeitgeistClient:
 				self._iface.InstallMonitor(monitor.path,
 					monitor.time_range,
 					monitor.templates,
-					reply_handler=self._void_reply_handler,
+					reply_handler=self._get_monitor_installed_handler(
+						monitor),
 					error_handler=lambda err: log.warn(
 						"Error reinstalling monitor: %s" % err))
+				if monitor.is_resumable():
+					self._catch_up(monitor)
 		self._iface.connect_join(reconnect_monitors)
+		
+		# Whatever happened while the engine was gone, cached data
+		# can't be trusted anymore
+		self._iface.connect_exit(self._clear_caches)
+		self._iface.connect_join(self._clear_caches)
 	
 	def register_event_subclass(self, event_type):
 		"""
@@ -445,6 +955,244 @@ class ZeitgeistClient:
 			_subject_type = subject_type
 		self._event_type = EventWithCustomSubject
 	
+	def enable_event_cache(self, max_size=1000):
+		"""
+		Keep up to *max_size* of the events retrieved with
+		:meth:`get_events` in memory, so that asking again for them
+		doesn't need a call to the Zeitgeist engine. The least recently
+		used events are dropped first.
+		
+		Events deleted from the log are removed from the cache, using a
+		monitor installed for this purpose. Note that the cached
+		:class:`Event <zeitgeist.datamodel.Event>` instances are shared
+		between all callers, so they must not be modified.
+		
+		If the cache is already enabled only its size is changed.
+		"""
+		if max_size < 1:
+			raise ValueError("max_size must be positive")
+		if self._event_cache is not None:
+			self._event_cache.max_size = max_size
+			return
+		self._event_cache = _EventCache(max_size)
+		self._event_cache_monitor = self.install_monitor(TimeRange.always(),
+			[_NO_INSERTIONS_TEMPLATE], self._void_reply_handler,
+			lambda time_range, event_ids: self._event_cache.remove(event_ids))
+	
+	def disable_event_cache(self):
+		"""
+		Drop the cache enabled with :meth:`enable_event_cache`
+		"""
+		if self._event_cache is None:
+			return
+		self.remove_monitor(self._event_cache_monitor)
+		self._event_cache = self._event_cache_monitor = None
+	
+	def get_event_cache_stats(self):
+		"""
+		Return a dictionary with the *size*, *max_size*, number of *hits*,
+		*misses* and *invalidations* (cached events which were deleted) of
+		the event cache, or None if it isn't enabled.
+		"""
+		if self._event_cache is None:
+			return None
+		return self._event_cache.get_stats()
+	
+	def enable_query_cache(self, max_size=100):
+		"""
+		Keep the results of up to *max_size* queries done with the
+		*find_events_** and *find_event_ids_** families of methods in
+		memory, so that repeating a query with exactly the same arguments
+		doesn't need a call to the Zeitgeist engine. The least recently
+		used results are dropped first.
+		
+		A monitor is installed to drop the results which may have
+		changed: those whose templates and time range match newly
+		inserted events, and those whose time range overlaps deleted
+		events. As the engine notifies the monitor asynchronously, a
+		query done right after inserting or deleting events may still be
+		answered with an outdated result. Cached results are shared
+		between all callers, so they must not be modified.
+		
+		If the cache is already enabled only its size is changed.
+		"""
+		if max_size < 1:
+			raise ValueError("max_size must be positive")
+		if self._query_cache is not None:
+			self._query_cache.max_size = max_size
+			return
+		self._query_cache = cache = _QueryCache(max_size)
+		self._query_cache_monitor = self.install_monitor(TimeRange.always(),
+			[], cache.invalidate_insertion,
+			lambda time_range, event_ids: cache.invalidate_deletion(time_range))
+	
+	def disable_query_cache(self):
+		"""
+		Drop the cache enabled with :meth:`enable_query_cache`
+		"""
+		if self._query_cache is None:
+			return
+		self.remove_monitor(self._query_cache_monitor)
+		self._query_cache = self._query_cache_monitor = None
+	
+	def get_query_cache_stats(self):
+		"""
+		Return a dictionary with the *size*, *max_size*, number of *hits*,
+		*misses* and *invalidations* of the query cache, or None if it
+		isn't enabled.
+		"""
+		if self._query_cache is None:
+			return None
+		return self._query_cache.get_stats()
+	
+	def enable_request_coalescing(self, get_events_window=10):
+		"""
+		Avoid sending the same request several times to the Zeitgeist
+		engine when different parts of a program ask for the same data
+		at once.
+		
+		Queries done with the *find_events_** and *find_event_ids_**
+		families of methods while an identical query is still waiting
+		for its reply don't cause a new D-Bus call; all callers get the
+		same result (or error) instead. Note that callers then share the
+		same Event instances, so they must not be modified.
+		
+		Also, calls to :meth:`get_events` done within *get_events_window*
+		milliseconds are merged into a single request, whose reply is
+		split again for each caller. Use 0 to disable this.
+		"""
+		if self._in_flight_queries is None:
+			self._in_flight_queries = {}
+		self._get_events_window = get_events_window
+	
+	def disable_request_coalescing(self):
+		"""
+		Stop the request coalescing enabled with
+		:meth:`enable_request_coalescing`. Requests already waiting for
+		a reply are not affected.
+		"""
+		self._in_flight_queries = None
+		self._get_events_window = 0
+	
+	def enable_subject_classification(self, fill_origin=True,
+		classifier=None):
+		"""
+		Fill in the empty interpretation, manifestation and origin of
+		the subjects of events given to :meth:`insert_events` (and
+		:meth:`insert_event`) before sending them, based on their
+		mimetype and uri. The events are modified in place.
+		
+		See :class:`SubjectClassifier <zeitgeist.mimetypes.SubjectClassifier>`
+		for the meaning of the arguments.
+		"""
+		from zeitgeist.mimetypes import SubjectClassifier
+		self._subject_classifier = SubjectClassifier(classifier,
+			fill_origin)
+	
+	def disable_subject_classification(self):
+		"""
+		Stop the classification enabled with
+		:meth:`enable_subject_classification`
+		"""
+		self._subject_classifier = None
+	
+	def _clear_caches(self):
+		if self._event_cache is not None:
+			self._event_cache.clear()
+		if self._query_cache is not None:
+			self._query_cache.clear()
+	
+	def _reply_later(self, reply_handler, result):
+		"""
+		Call *reply_handler* with *result* from the main loop, to keep
+		replies asynchronous even if there's no D-Bus call involved
+		"""
+		def idle_reply():
+			reply_handler(result)
+			return False
+		_get_glib().idle_add(idle_reply)
+	
+	def _prepare_query(self, kind, reply_handler, error_handler,
+		event_templates, timerange, storage_state, num_events, result_type):
+		"""
+		Apply the query cache and request coalescing, if enabled. Returns
+		None if the query has been taken care of, or else the
+		(reply_handler, error_handler) tuple to use for the D-Bus call.
+		"""
+		if self._query_cache is None and self._in_flight_queries is None:
+			return reply_handler, error_handler
+		key = _make_query_key(kind, timerange, event_templates,
+			storage_state, num_events, result_type)
+		
+		cache = self._query_cache
+		if cache is not None:
+			result = cache.get(key)
+			if result is not None:
+				self._reply_later(reply_handler, result)
+				return None
+			reply_handler = cache.get_storing_handler(key, timerange,
+				event_templates, reply_handler)
+		
+		queries = self._in_flight_queries
+		if queries is None:
+			return reply_handler, error_handler
+		if key in queries:
+			# Wait for the outcome of the identical request in flight
+			queries[key].append((reply_handler, error_handler))
+			return None
+		waiters = queries[key] = [(reply_handler, error_handler)]
+		def shared_reply_handler(result):
+			del queries[key]
+			for handler, _ in waiters:
+				handler(result)
+		def shared_error_handler(error):
+			del queries[key]
+			for _, handler in waiters:
+				handler(error)
+		return shared_reply_handler, shared_error_handler
+	
+	def _fetch_events(self, event_ids, reply_handler, error_handler,
+		as_batch=False):
+		"""
+		Call GetEvents and pass the decoded events to *reply_handler*.
+		With request coalescing enabled, calls made within a short
+		window of time are merged into a single one.
+		"""
+		if not self._get_events_window:
+			self._iface.GetEvents(event_ids,
+				reply_handler=lambda raw: reply_handler(
+					self._decode_events(raw, as_batch)),
+				error_handler=error_handler)
+			return
+		if self._pending_get_events is None:
+			self._pending_get_events = []
+			_get_glib().timeout_add(self._get_events_window,
+				self._send_pending_get_events)
+		self._pending_get_events.append(
+			(event_ids, reply_handler, error_handler, as_batch))
+	
+	def _send_pending_get_events(self):
+		requests, self._pending_get_events = self._pending_get_events, None
+		event_ids = list(OrderedDict.fromkeys(event_id
+			for request in requests for event_id in request[0]))
+		
+		def reply_handler(raw):
+			events = dict(zip(event_ids, self._decode_events(raw)))
+			for ids, handler, _, as_batch in requests:
+				result = [events[event_id] for event_id in ids]
+				if as_batch:
+					result = EventBatch.new_for_events(result,
+						self._event_type)
+				handler(result)
+		
+		def error_handler(error):
+			for _, _, handler, _ in requests:
+				handler(error)
+		
+		self._iface.GetEvents(event_ids, reply_handler=reply_handler,
+			error_handler=error_handler)
+		return False
+	
 	def _safe_error_handler(self, error_handler, *args):
 		if error_handler is not None:
 			if callable(error_handler):
@@ -549,6 +1297,8 @@ class ZeitgeistClient:
 		
 		self._check_list_or_tuple(events)
 		self._check_members(events, Event)
+		if self._subject_classifier is not None:
+			self._subject_classifier.enrich_events(events)
 		self._iface.InsertEvents(events,
 					reply_handler=self._safe_reply_handler(ids_reply_handler),
 					error_handler=self._safe_error_handler(error_handler,
@@ -622,6 +1372,12 @@ class ZeitgeistClient:
 			raise TypeError(
 				"Reply handler not callable, found %s" % ids_reply_handler)
 		
+		handlers = self._prepare_query("ids", ids_reply_handler,
+			self._safe_error_handler(error_handler, ids_reply_handler, []),
+			event_templates, timerange, storage_state, num_events, result_type)
+		if handlers is None:
+			return
+		
 		if timerange is None:
 			timerange = TimeRange.until_now()
 		
@@ -630,9 +1386,8 @@ class ZeitgeistClient:
 					storage_state,
 					num_events,
 					result_type,
-					reply_handler=self._safe_reply_handler(ids_reply_handler),
-					error_handler=self._safe_error_handler(error_handler,
-						ids_reply_handler, []))
+					reply_handler=handlers[0],
+					error_handler=handlers[1])
 	
 	def find_event_ids_for_template (self, event_template, ids_reply_handler,
 		**kwargs):
@@ -665,7 +1420,8 @@ class ZeitgeistClient:
 					storage_state = StorageState.Any,
 					num_events = 20,
 					result_type = ResultType.MostRecentEvents,
-					error_handler=None):
+					error_handler=None,
+					as_batch=False):
 		"""
 		Send a query matching a collection of
 		:class:`Event <zeitgeist.datamodel.Event>` templates to the
@@ -677,7 +1433,9 @@ class ZeitgeistClient:
 		The query will be done via an asynchronous DBus call and
 		this method will return immediately. The return value
 		will be passed to 'events_reply_handler' as a list
-		of :class:`Event`s. This list must be the sole argument for
+		of :class:`Event`s, or as an
+		:class:`EventBatch <zeitgeist.datamodel.EventBatch>` if
+		*as_batch* is True. This must be the sole argument for
 		the callback.
 		
 		If you need to do a query yielding a large (or unpredictable)
@@ -710,6 +1468,9 @@ class ZeitgeistClient:
 		    enumeration. Defaults to ResultType.MostRecentEvent
 		:param error_handler: Callback to catch error messages.
 		        Read about the default behaviour above
+		:param as_batch: Whether to return the events in an
+		    :class:`EventBatch <zeitgeist.datamodel.EventBatch>` instead
+		    of in a list. Defaults to False
 		"""
 		self._check_list_or_tuple(event_templates)
 		self._check_members(event_templates, Event)
@@ -718,6 +1479,14 @@ class ZeitgeistClient:
 			raise TypeError(
 				"Reply handler not callable, found %s" % events_reply_handler)
 		
+		handlers = self._prepare_query("batch" if as_batch else "events",
+			events_reply_handler,
+			self._safe_error_handler(error_handler, events_reply_handler,
+				self._decode_events([], as_batch)),
+			event_templates, timerange, storage_state, num_events, result_type)
+		if handlers is None:
+			return
+		
 		if timerange is None:
 			timerange = TimeRange.until_now()
 		
@@ -726,10 +1495,98 @@ class ZeitgeistClient:
 					storage_state,
 					num_events,
 					result_type,
-					reply_handler=lambda raw: events_reply_handler(
-						map(self._event_type.new_for_struct, raw)),
-					error_handler=self._safe_error_handler(error_handler,
-						events_reply_handler, []))
+					reply_handler=lambda raw: handlers[0](
+						self._decode_events(raw, as_batch)),
+					error_handler=handlers[1])
+	
+	def iter_events(self, event_templates, timerange=None,
+		storage_state=StorageState.Any, num_events=0,
+		result_type=ResultType.MostRecentEvents, page_size=100, prefetch=2):
+		"""
+		Return a generator over the events matching *event_templates*,
+		for going through large result sets.
+		
+		The ids of the matching events are looked up once with
+		:meth:`find_event_ids_for_templates`, and the events are then
+		retrieved in pages of *page_size* events with :meth:`get_events`.
+		While the events of a page are being consumed the next *prefetch*
+		pages are already requested, so only about
+		``(prefetch + 1) * page_size`` events are held in memory and the
+		first events are available as soon as the first page arrives.
+		Events deleted in the meantime are skipped.
+		
+		The arguments are the same as for :meth:`find_events_for_templates`,
+		except that *num_events* defaults to 0 (no limit). Errors are
+		raised from the generator.
+		
+		The generator blocks while waiting for the replies, dispatching the
+		default GLib main context in the meantime, so it shouldn't be used
+		from inside a callback of the main loop.
+		"""
+		self._check_list_or_tuple(event_templates)
+		self._check_members(event_templates, Event)
+		if page_size < 1 or prefetch < 0:
+			raise ValueError("page_size must be positive and prefetch "
+				"can't be negative")
+		
+		if timerange is None:
+			timerange = TimeRange.until_now()
+		
+		call = Future()
+		self._iface.FindEventIds(timerange, event_templates, storage_state,
+			num_events, result_type, reply_handler=call.reply_handler,
+			error_handler=call.error_handler)
+		event_ids = call.result()
+		
+		pages = deque()
+		offset = 0
+		while offset < len(event_ids) or pages:
+			while offset < len(event_ids) and len(pages) <= prefetch:
+				call = Future(self._decode_events)
+				self._iface.GetEvents(event_ids[offset:offset + page_size],
+					reply_handler=call.reply_handler,
+					error_handler=call.error_handler)
+				pages.append(call)
+				offset += page_size
+			for event in pages.popleft().result():
+				if event is not None:
+					yield event
+	
+	def follow(self, event_templates, events_handler, since=0,
+		storage_state=StorageState.Any, page_size=100, caught_up_handler=None,
+		delete_handler=None, error_handler=None):
+		"""
+		Pass all events matching *event_templates* with a timestamp from
+		*since* on to *events_handler*, first those already in the log
+		and then those inserted afterwards, as they arrive.
+		
+		A monitor is installed before looking up the events in the log,
+		which are then retrieved *page_size* at a time, oldest first.
+		Insertions notified in the meantime are held back and delivered
+		once all the older events have been, leaving out those which
+		were already part of the result. This way no event is missed or
+		delivered twice. If more than :attr:`EventFollower.MAX_HELD_BACK`
+		insertions arrive before that, they are dropped and looked up
+		in the log again instead.
+		
+		*events_handler* is called with lists of events. The optional
+		*caught_up_handler* is called without arguments once the events
+		already in the log have been delivered, and *delete_handler* with
+		a list of event ids when events are deleted afterwards (like for
+		monitors, this includes any events in the time range). If no
+		*error_handler* is given errors are logged. In both cases the
+		follower is cancelled after an error.
+		
+		Returns an :class:`EventFollower`, whose
+		:meth:`cancel <EventFollower.cancel>` method stops it.
+		"""
+		self._check_list_or_tuple(event_templates)
+		self._check_members(event_templates, Event)
+		if page_size < 1:
+			raise ValueError("page_size must be positive")
+		return EventFollower(self, event_templates, events_handler, since,
+			storage_state, page_size, caught_up_handler, delete_handler,
+			error_handler)
 	
 	def find_events_for_template (self, event_template, events_reply_handler,
 		**kwargs):
@@ -755,7 +1612,8 @@ class ZeitgeistClient:
 						events_reply_handler,
 						**arguments)
 	
-	def get_events (self, event_ids, events_reply_handler, error_handler=None):
+	def get_events (self, event_ids, events_reply_handler, error_handler=None,
+		as_batch=False):
 		"""
 		Look up a collection of :class:`Events <zeitgeist.datamodel.Event>`
 		in the Zeitgeist event log given a collection of event ids.
@@ -768,7 +1626,10 @@ class ZeitgeistClient:
 		The query will be done via an asynchronous DBus call and
 		this method will return immediately. The returned events
 		will be passed to *events_reply_handler* as a list
-		of Events, which must be the only argument of the function.
+		of Events (or as an
+		:class:`EventBatch <zeitgeist.datamodel.EventBatch>` if
+		*as_batch* is True), which must be the only argument of the
+		function.
 		 
 		In case of errors a message will be printed on stderr, and
 		an empty result passed to *events_reply_handler*.
@@ -784,13 +1645,52 @@ class ZeitgeistClient:
 			raise TypeError(
 				"Reply handler not callable, found %s" % events_reply_handler)
 		
-		# Generate a wrapper callback that does automagic conversion of
-		# the raw DBus reply into a list of Event instances
-		self._iface.GetEvents(event_ids,
-				reply_handler=lambda raw: events_reply_handler(
-					map(self._event_type.new_for_struct, raw)),
-				error_handler=self._safe_error_handler(error_handler,
-						events_reply_handler, []))
+		if self._event_cache is not None:
+			self._get_events_cached(event_ids, events_reply_handler,
+				error_handler, as_batch)
+			return
+		
+		self._fetch_events(event_ids, events_reply_handler,
+				self._safe_error_handler(error_handler,
+						events_reply_handler,
+						self._decode_events([], as_batch)),
+				as_batch)
+	
+	def _get_events_cached(self, event_ids, events_reply_handler,
+		error_handler, as_batch):
+		cache = self._event_cache
+		events = map(cache.get, event_ids)
+		missing = list(OrderedDict.fromkeys(event_id for (event_id, event)
+			in zip(event_ids, events) if event is None))
+		
+		def reply_handler(found_events=()):
+			found = {}
+			for event_id, event in zip(missing, found_events):
+				if event is not None:
+					cache.add_fetched(event, epoch)
+					found[event_id] = event
+			result = [found.get(event_id) if event is None else event
+				for (event_id, event) in zip(event_ids, events)]
+			if as_batch:
+				result = EventBatch.new_for_events(result, self._event_type)
+			events_reply_handler(result)
+		
+		if not missing:
+			self._reply_later(reply_handler, ())
+			return
+		
+		error_handler = self._safe_error_handler(error_handler,
+			events_reply_handler, self._decode_events([], as_batch))
+		epoch = cache.begin_request()
+		def fetched(found_events):
+			try:
+				reply_handler(found_events)
+			finally:
+				cache.end_request()
+		def failed(error):
+			cache.end_request()
+			error_handler(error)
+		self._fetch_events(missing, fetched, failed)
 	
 	def delete_events(self, event_ids, reply_handler=None, error_handler=None):
 		"""
@@ -888,7 +1788,9 @@ class ZeitgeistClient:
 		                                  error_handler=error_handler)
 	
 	def install_monitor (self, time_range, event_templates,
-		notify_insert_handler, notify_delete_handler, monitor_path=None):
+		notify_insert_handler, notify_delete_handler, monitor_path=None,
+		coalesce_delay=0, coalesce_size=0, resume=False, resume_token=None,
+		resume_file=None):
 		"""
 		Install a monitor in the Zeitgeist engine that calls back
 		when events matching *event_templates* are logged. The matching
@@ -925,6 +1827,18 @@ class ZeitgeistClient:
 		    to install the client side monitor object on. If none is provided
 		    the client will provide one for you namespaced under
 		    /org/gnome/zeitgeist/monitor/*
+		:param coalesce_delay: Optional maximum time, in milliseconds, to
+		    hold back notifications so that they are merged with the
+		    following ones. See :class:`Monitor`
+		:param coalesce_size: Optional number of events (or deleted event
+		    ids) after which held back notifications are delivered
+		:param resume: If True, events missed while the engine was
+		    restarted are delivered once the monitor is reinstalled
+		:param resume_token: Optional token returned by
+		    :meth:`Monitor.get_resume_token`, to deliver the events
+		    inserted since it was obtained
+		:param resume_file: Optional path of a file to load the
+		    resume token from and save it to. See :class:`Monitor`
 		:returns: a :class:`Monitor`
 		"""
 		self._check_list_or_tuple(event_templates)
@@ -940,16 +1854,84 @@ class ZeitgeistClient:
 		
 		mon = Monitor(time_range, event_templates, notify_insert_handler,
 			notify_delete_handler, monitor_path=monitor_path,
-			event_type=self._event_type)
+			event_type=self._event_type, coalesce_delay=coalesce_delay,
+			coalesce_size=coalesce_size, resume=resume,
+			resume_token=resume_token, resume_file=resume_file)
 		self._iface.InstallMonitor(mon.path,
 		                           mon.time_range,
 		                           mon.templates,
-		                           reply_handler=self._void_reply_handler,
+		                           reply_handler=self._get_monitor_installed_handler(mon),
 		                           error_handler=lambda err: log.warn(
 									"Error installing monitor: %s" % err))
 		self._installed_monitors.append(mon)
+		if mon.is_resumable():
+			self._catch_up(mon)
 		return mon
 	
+	def _get_monitor_installed_handler(self, monitor):
+		"""
+		Return the reply handler for (re)installing *monitor*, which gives
+		it a resume token if it's resumable and doesn't have one yet
+		"""
+		if not monitor.is_resumable():
+			return self._void_reply_handler
+		timestamp = get_timestamp_for_now()
+		def installed(*args):
+			if monitor.get_resume_token() is None:
+				self._seed_resume_token(monitor, timestamp)
+		return installed
+	
+	def _seed_resume_token(self, monitor, timestamp):
+		"""
+		Set the resume token of a monitor installed at *timestamp*, so
+		that it catches up after being reinstalled even if it didn't
+		deliver any events before. The event id of the token is the
+		highest one of the matching events which are already logged in
+		the time range to catch up.
+		"""
+		begin = max(timestamp, monitor.time_range[0])
+		def found(event_ids):
+			monitor._advance_resume_token(timestamp, max(event_ids or [0]))
+		if begin > monitor.time_range[1]:
+			found([])
+			return
+		self._iface.FindEventIds(TimeRange(begin, monitor.time_range[1]),
+			monitor.templates, StorageState.Any, 0,
+			ResultType.LeastRecentEvents, reply_handler=found,
+			error_handler=lambda err: log.warn(
+				"Error getting the resume token for monitor %s: %s" % (
+				monitor.path, err)))
+	
+	def _catch_up(self, monitor):
+		"""
+		Deliver the events a monitor missed according to its resume
+		token, right after (re)installing it
+		"""
+		time_range = monitor._begin_catch_up()
+		if time_range is None:
+			return
+		def failed(error):
+			log.warn("Error catching up monitor %s: %s" % (monitor.path,
+				error))
+			monitor._end_catch_up()
+		def fetch_page(event_ids):
+			if not event_ids:
+				monitor._end_catch_up()
+				return
+			page = event_ids[:monitor.CATCH_UP_LIMIT]
+			def page_received(raw):
+				monitor._catch_up_events(self._decode_events(raw))
+				fetch_page(event_ids[len(page):])
+			self._iface.GetEvents(page, reply_handler=page_received,
+				error_handler=failed)
+		# The engine handles the requests in order, so anything inserted
+		# after this query is notified to the monitor
+		self._iface.FindEventIds(time_range, monitor.templates,
+			StorageState.Any, 0, ResultType.LeastRecentEvents,
+			reply_handler=lambda event_ids:
+				fetch_page(monitor._get_missed_ids(event_ids)),
+			error_handler=failed)
+	
 	def remove_monitor (self, monitor, monitor_removed_handler=None):
 		"""
 		Remove a :class:`Monitor` installed with :meth:`install_monitor`
@@ -959,11 +1941,16 @@ class ZeitgeistClient:
 		    string or :class:`dbus.ObjectPath`
 		:param monitor_removed_handler: A callback function taking
 		    one integer argument. 1 on success, 0 on failure.
+		
+		Notifications held back for coalescing are delivered before
+		removing the monitor.
 		"""
 		if isinstance(monitor, (str,unicode)):
 			path = dbus.ObjectPath(monitor)
 		elif isinstance(monitor, Monitor):
 			path = monitor.path
+			monitor.flush()
+			monitor.save_resume_token()
 		else:
 			raise TypeError(
 				"Monitor, str, or unicode expected. Found %s" % type(monitor))
@@ -1080,6 +2067,15 @@ class ZeitgeistClient:
 					"Collection contains member of invalid type %s. Expected %s" % \
 					(m.__class__, member_class))
 	
+	def _decode_events(self, raw, as_batch=False):
+		"""
+		Convert a list of raw DBus event structs into a list of Event
+		instances, or into an EventBatch if `as_batch` is True
+		"""
+		if as_batch:
+			return EventBatch.new_for_structs(raw, self._event_type)
+		return map(self._event_type.new_for_raw_struct, raw)
+	
 	def _void_reply_handler(self, *args, **kwargs):
 		"""
 		Reply handler for async DBus calls that simply ignores the response
@@ -1097,6 +2093,858 @@ class ZeitgeistClient:
 		if callable(normal_reply_handler):
 			normal_reply_handler(normal_reply_data)
 
+def _get_glib():
+	"""
+	Return the GLib bindings used in this process, either the static
+	gobject module or gi.repository.GLib (they can't be mixed)
+	"""
+	if "gobject" in sys.modules:
+		return sys.modules["gobject"]
+	try:
+		from gi.repository import GLib
+	except ImportError:
+		import gobject as GLib
+	return GLib
+
+def _iterate_main_context():
+	"""
+	Dispatch pending events of the default GLib main context, blocking
+	until there is at least one
+	"""
+	glib = _get_glib()
+	if hasattr(glib, "MainContext"):
+		glib.MainContext.default().iteration(True)
+	else:
+		glib.main_context_default().iteration(True)
+
+class Future(object):
+	"""
+	Result of an asynchronous call to the Zeitgeist engine, which may
+	not be available yet.
+	
+	Its :meth:`reply_handler` and :meth:`error_handler` methods can be
+	passed as handlers to any asynchronous call. Callbacks added with
+	:meth:`add_done_callback` are called with the future as argument
+	once the call completes; :meth:`result` instead blocks until then,
+	dispatching the default GLib main context in the meantime, so it
+	shouldn't be used from inside a callback of the main loop.
+	
+	*decode* is an optional function applied to the raw reply.
+	"""
+	
+	def __init__(self, decode=None):
+		self._done = False
+		self._result = None
+		self._error = None
+		self._decode = decode
+		self._callbacks = []
+	
+	def reply_handler(self, result=None):
+		if self._decode is not None:
+			try:
+				result = self._decode(result)
+			except Exception, e:
+				self.error_handler(e)
+				return
+		self._complete(result, None)
+	
+	def error_handler(self, error):
+		self._complete(None, error)
+	
+	def _complete(self, result, error):
+		if self._done:
+			return
+		self._done = True
+		self._result = result
+		self._error = error
+		callbacks, self._callbacks = self._callbacks, None
+		for callback in callbacks:
+			callback(self)
+	
+	def done(self):
+		"""
+		Return True if the call has completed, successfully or not
+		"""
+		return self._done
+	
+	def add_done_callback(self, callback):
+		"""
+		Call *callback* with this future as argument when the call
+		completes, or straight away if it already has
+		"""
+		if self._done:
+			callback(self)
+		else:
+			self._callbacks.append(callback)
+	
+	def wait(self):
+		"""
+		Block until the call is completed
+		"""
+		while not self._done:
+			_iterate_main_context()
+	
+	def result(self):
+		"""
+		Block until the call is completed and return its result (or raise
+		its error)
+		"""
+		self.wait()
+		if self._error is not None:
+			raise self._error
+		return self._result
+	
+	def exception(self):
+		"""
+		Block until the call is completed and return its error, or None
+		if it succeeded
+		"""
+		self.wait()
+		return self._error
+
+def gather(futures):
+	"""
+	Return a :class:`Future` for the list of results of all *futures*,
+	which fails with the first error of any of them
+	"""
+	futures = list(futures)
+	combined = Future()
+	pending = [len(futures)]
+	def done_callback(future):
+		if future.exception() is not None:
+			combined.error_handler(future.exception())
+			return
+		pending[0] -= 1
+		if not pending[0]:
+			combined.reply_handler([f.result() for f in futures])
+	for future in futures:
+		future.add_done_callback(done_callback)
+	if not futures:
+		combined.reply_handler([])
+	return combined
+
+class EventFollower(object):
+	"""
+	Stream of the events matching some templates from a point in time
+	on, see :meth:`ZeitgeistClient.follow`
+	"""
+	
+	# Maximum number of insertions held back while going through the log
+	MAX_HELD_BACK = 1000
+	
+	def __init__(self, client, event_templates, events_handler, since,
+		storage_state, page_size, caught_up_handler, delete_handler,
+		error_handler):
+		self._client = client
+		self._events_handler = events_handler
+		self._caught_up_handler = caught_up_handler
+		self._delete_handler = delete_handler
+		self._error_handler = error_handler
+		self._page_size = page_size
+		self._live = False
+		self._cancelled = False
+		# Events notified while going through the log, and whether some
+		# were dropped because there were too many of them
+		self._held_back = OrderedDict()
+		self._overflowed = False
+		# Ids of the events found in the log, those which haven't been
+		# delivered yet and those deleted before being delivered
+		self._seen = set()
+		self._pending = set()
+		self._deleted = set()
+		self._event_ids = []
+		self._offset = 0
+		
+		# The engine handles the requests in order, so everything missing
+		# from the result of the query will be notified to the monitor
+		self._query = (TimeRange.from_timestamp(since), event_templates,
+			storage_state)
+		self._monitor = client.install_monitor(self._query[0],
+			event_templates, self._notify_insert, self._notify_delete)
+		self._find_event_ids()
+	
+	def is_live(self):
+		"""
+		Return True once all events already in the log were delivered
+		"""
+		return self._live
+	
+	def cancel(self):
+		"""
+		Stop delivering events and remove the monitor
+		"""
+		if not self._cancelled:
+			self._cancelled = True
+			self._client.remove_monitor(self._monitor)
+	
+	def _find_event_ids(self):
+		time_range, event_templates, storage_state = self._query
+		self._client._iface.FindEventIds(time_range, event_templates,
+			storage_state, 0, ResultType.LeastRecentEvents,
+			reply_handler=self._ids_received, error_handler=self._failed)
+	
+	def _ids_received(self, event_ids):
+		if self._cancelled:
+			return
+		# Leave out the events found by an earlier lookup
+		self._event_ids = [event_id for event_id in event_ids
+			if event_id not in self._seen]
+		self._offset = 0
+		self._seen.update(self._event_ids)
+		self._pending.update(self._event_ids)
+		self._fetch_page()
+	
+	def _fetch_page(self):
+		if self._cancelled:
+			return
+		if self._offset >= len(self._event_ids):
+			self._go_live()
+			return
+		event_ids = self._event_ids[self._offset:self._offset + self._page_size]
+		self._offset += self._page_size
+		self._client.get_events(event_ids,
+			lambda events: self._page_received(event_ids, events),
+			self._failed)
+	
+	def _page_received(self, event_ids, events):
+		if self._cancelled:
+			return
+		events = [event for event in events
+			if event is not None and event.id not in self._deleted]
+		self._pending.difference_update(event_ids)
+		self._deleted.difference_update(event_ids)
+		if events:
+			self._events_handler(events)
+		self._fetch_page()
+	
+	def _go_live(self):
+		if self._overflowed:
+			# Look up the events which were dropped from _held_back
+			self._overflowed = False
+			self._held_back.clear()
+			self._find_event_ids()
+			return
+		self._live = True
+		events = [event for event_id, event in self._held_back.iteritems()
+			if event_id not in self._seen]
+		self._held_back.clear()
+		self._seen.clear()
+		self._event_ids = []
+		if events:
+			self._events_handler(events)
+		if self._caught_up_handler is not None:
+			self._caught_up_handler()
+	
+	def _notify_insert(self, time_range, events):
+		if self._cancelled:
+			return
+		if self._live:
+			self._events_handler(events)
+		elif not self._overflowed:
+			for event in events:
+				self._held_back[event.id] = event
+			if len(self._held_back) > self.MAX_HELD_BACK:
+				self._overflowed = True
+				self._held_back.clear()
+	
+	def _notify_delete(self, time_range, event_ids):
+		if self._cancelled:
+			return
+		if not self._live:
+			# Leave out the events which haven't been delivered yet
+			delivered = []
+			for event_id in event_ids:
+				if event_id in self._pending:
+					self._deleted.add(event_id)
+				elif event_id in self._held_back:
+					del self._held_back[event_id]
+				else:
+					delivered.append(event_id)
+			event_ids = delivered
+		if event_ids and self._delete_handler is not None:
+			self._delete_handler(event_ids)
+	
+	def _failed(self, error):
+		self.cancel()
+		if self._error_handler is not None:
+			self._error_handler(error)
+		else:
+			log.warn("Error following events: %s" % error)
+
+class MonitorStream(object):
+	"""
+	Iterator over the notifications of a monitor installed in the
+	Zeitgeist engine, see :meth:`AsyncZeitgeistClient.monitor`.
+	
+	Each notification is either a ``("insert", time_range, events)`` or
+	a ``("delete", time_range, event_ids)`` tuple. Iterating blocks until
+	a notification arrives, dispatching the default GLib main context in
+	the meantime, and stops once :meth:`close` has been called. Use
+	:meth:`poll` to get the notifications received so far without
+	blocking.
+	"""
+	
+	def __init__(self, client, time_range, event_templates):
+		self._client = client
+		self._notifications = deque()
+		self._monitor = client.install_monitor(time_range, event_templates,
+			self._notify_insert, self._notify_delete)
+	
+	def _notify_insert(self, time_range, events):
+		self._notifications.append(("insert", time_range, events))
+	
+	def _notify_delete(self, time_range, event_ids):
+		self._notifications.append(("delete", time_range, event_ids))
+	
+	def get_monitor(self):
+		return self._monitor
+	monitor = property(get_monitor,
+		doc="The underlying :class:`Monitor`, or None once closed")
+	
+	def __iter__(self):
+		return self
+	
+	def next(self):
+		while not self._notifications:
+			if self._monitor is None:
+				raise StopIteration
+			_iterate_main_context()
+		return self._notifications.popleft()
+	
+	def poll(self):
+		"""
+		Return the list of notifications received so far, without
+		blocking
+		"""
+		notifications = list(self._notifications)
+		self._notifications.clear()
+		return notifications
+	
+	def close(self):
+		"""
+		Remove the monitor from the engine. Notifications already
+		received can still be iterated over.
+		"""
+		if self._monitor is not None:
+			self._client.remove_monitor(self._monitor)
+			self._monitor = None
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+class AsyncZeitgeistClient(object):
+	"""
+	Front-end to :class:`ZeitgeistClient` whose methods return a
+	:class:`Future` instead of taking reply and error handlers, so that
+	any number of requests can be sent at once and their results waited
+	for or chained later on::
+	
+	    client = AsyncZeitgeistClient()
+	    futures = [client.find_event_ids([template]) for template in templates]
+	    for ids in gather(futures).result():
+	        ...
+	
+	Errors are reported through the futures rather than printed on
+	stderr. The requests go through *client* (a new
+	:class:`ZeitgeistClient` if not given), so they share its connection
+	handling: calls and monitors are recovered if the engine is
+	restarted, and its caches and request coalescing apply if enabled.
+	"""
+	
+	def __init__(self, client=None):
+		self._client = client if client is not None else ZeitgeistClient()
+	
+	def get_client(self):
+		return self._client
+	client = property(get_client,
+		doc="The underlying :class:`ZeitgeistClient`")
+	
+	def insert_event(self, event):
+		"""
+		Insert an event, the future's result is its id
+		"""
+		future = Future(lambda ids: ids[0])
+		self._client.insert_events([event], future.reply_handler,
+			future.error_handler)
+		return future
+	
+	def insert_events(self, events):
+		"""
+		Insert a list of events, the future's result is the list of
+		their ids
+		"""
+		future = Future()
+		self._client.insert_events(events, future.reply_handler,
+			future.error_handler)
+		return future
+	
+	def find_event_ids(self, event_templates, timerange=None,
+		storage_state=StorageState.Any, num_events=20,
+		result_type=ResultType.MostRecentEvents):
+		"""
+		Like :meth:`ZeitgeistClient.find_event_ids_for_templates`
+		"""
+		future = Future()
+		self._client.find_event_ids_for_templates(event_templates,
+			future.reply_handler, timerange, storage_state, num_events,
+			result_type, future.error_handler)
+		return future
+	
+	def find_events(self, event_templates, timerange=None,
+		storage_state=StorageState.Any, num_events=20,
+		result_type=ResultType.MostRecentEvents, as_batch=False):
+		"""
+		Like :meth:`ZeitgeistClient.find_events_for_templates`
+		"""
+		future = Future()
+		self._client.find_events_for_templates(event_templates,
+			future.reply_handler, timerange, storage_state, num_events,
+			result_type, future.error_handler, as_batch)
+		return future
+	
+	def get_events(self, event_ids, as_batch=False):
+		"""
+		Like :meth:`ZeitgeistClient.get_events`
+		"""
+		future = Future()
+		self._client.get_events(event_ids, future.reply_handler,
+			future.error_handler, as_batch)
+		return future
+	
+	def delete_events(self, event_ids):
+		"""
+		Delete events, the future's result is the
+		:class:`TimeRange <zeitgeist.datamodel.TimeRange>` they covered
+		"""
+		future = Future(lambda time_range: TimeRange(*time_range))
+		self._client.delete_events(event_ids, future.reply_handler,
+			future.error_handler)
+		return future
+	
+	def monitor(self, time_range, event_templates):
+		"""
+		Install a monitor and return a :class:`MonitorStream` over its
+		notifications
+		"""
+		return MonitorStream(self._client, time_range, event_templates)
+
+class _HubMonitor(object):
+	"""
+	Logical monitor of a :class:`MonitorHub`
+	"""
+	
+	def __init__(self, time_range, event_templates, insert_callback,
+		delete_callback):
+		self.time_range = TimeRange(time_range[0], time_range[1])
+		self.templates = event_templates
+		self.insert_callback = insert_callback
+		self.delete_callback = delete_callback
+		self.handles = []
+
+class MonitorHub(object):
+	"""
+	Multiplexer of many monitors over a single monitor installed in the
+	Zeitgeist engine.
+	
+	Each monitor installed with :meth:`install_monitor` is only kept on
+	the client side. The engine gets one monitor covering all of them,
+	whose time range spans theirs and whose templates are the union of
+	theirs, and each notification is dispatched locally to the monitors
+	it concerns, using a :class:`TemplateIndex
+	<zeitgeist.datamodel.TemplateIndex>`. This saves D-Bus traffic and
+	matching work in the engine when there are many monitors.
+	
+	Monitors receive the same notifications as with
+	:meth:`ZeitgeistClient.install_monitor`. When monitors are added or
+	removed, the monitor in the engine is replaced once the main loop
+	is idle; no notification is lost or duplicated in the switch. If
+	the engine fails to install the new monitor, installing it is
+	retried after :attr:`RETRY_INTERVAL` milliseconds, an interval which
+	doubles with each failed attempt up to :attr:`MAX_RETRY_INTERVAL`.
+	"""
+	
+	RETRY_INTERVAL = 1000
+	MAX_RETRY_INTERVAL = 60000
+	
+	def __init__(self, client):
+		self._client = client
+		self._index = TemplateIndex()
+		self._monitors = []
+		# Monitors without templates, which match all events
+		self._catch_all = []
+		# The monitor receiving notifications, and the one replacing it
+		self._monitor = None
+		self._next_monitor = None
+		self._update_source = None
+		self._retry_interval = self.RETRY_INTERVAL
+		# Whether monitors changed while the new monitor was installed
+		self._dirty = False
+	
+	def install_monitor(self, time_range, event_templates,
+		notify_insert_handler, notify_delete_handler):
+		"""
+		Add a monitor, with the same arguments as
+		:meth:`ZeitgeistClient.install_monitor`, and return an object to
+		pass to :meth:`remove_monitor`.
+		
+		Raises a ValueError if a template can't be matched locally (see
+		:meth:`TemplateIndex.add <zeitgeist.datamodel.TemplateIndex.add>`).
+		"""
+		monitor = _HubMonitor(time_range, event_templates,
+			notify_insert_handler, notify_delete_handler)
+		try:
+			for template in event_templates:
+				monitor.handles.append(self._index.add(template, monitor))
+		except ValueError:
+			for handle in monitor.handles:
+				self._index.remove(handle)
+			raise
+		if not event_templates:
+			self._catch_all.append(monitor)
+		self._monitors.append(monitor)
+		self._schedule_update()
+		return monitor
+	
+	def remove_monitor(self, monitor):
+		"""
+		Remove a monitor added with :meth:`install_monitor`
+		"""
+		self._monitors.remove(monitor)
+		if monitor in self._catch_all:
+			self._catch_all.remove(monitor)
+		for handle in monitor.handles:
+			self._index.remove(handle)
+		self._schedule_update()
+	
+	def get_monitors(self):
+		return list(self._monitors)
+	monitors = property(get_monitors,
+		doc="List of the monitors installed in this hub")
+	
+	def _schedule_update(self):
+		if self._next_monitor is not None:
+			# Update again once the previous replacement is finished
+			self._dirty = True
+		elif self._update_source is None:
+			self._update_source = _get_glib().idle_add(self._update)
+	
+	def _schedule_retry(self):
+		if self._update_source is None:
+			self._update_source = _get_glib().timeout_add(
+				self._retry_interval, self._update)
+			self._retry_interval = min(self._retry_interval * 2,
+				self.MAX_RETRY_INTERVAL)
+	
+	def _update(self):
+		"""
+		Replace the monitor installed in the engine with one covering
+		the current monitors
+		"""
+		self._update_source = None
+		if not self._monitors:
+			self._retire(self._monitor)
+			self._monitor = None
+			return False
+		
+		time_range = TimeRange(
+			min(logical.time_range.begin for logical in self._monitors),
+			max(logical.time_range.end for logical in self._monitors))
+		templates = []
+		if not self._catch_all:
+			for logical in self._monitors:
+				for template in logical.templates:
+					if template not in templates:
+						templates.append(template)
+		
+		client = self._client
+		monitor = Monitor(time_range, templates,
+			lambda time_range, events:
+				self._dispatch_insert(monitor, time_range, events),
+			lambda time_range, event_ids:
+				self._dispatch_delete(monitor, time_range, event_ids),
+			event_type=client._event_type)
+		self._next_monitor = monitor
+		
+		def installed(*args):
+			# The engine notifies the new monitor from now on, and the old
+			# one won't get anything that hasn't been delivered yet
+			self._next_monitor = None
+			self._retry_interval = self.RETRY_INTERVAL
+			self._retire(self._monitor)
+			self._monitor = monitor
+			if self._dirty:
+				self._dirty = False
+				self._schedule_update()
+		
+		def failed(error):
+			log.warn("Error installing monitor: %s" % error)
+			self._next_monitor = None
+			client._installed_monitors.remove(monitor)
+			monitor.remove_from_connection()
+			# Until it works, the monitors added since the last update
+			# don't get any notifications
+			if self._dirty:
+				self._dirty = False
+				self._schedule_update()
+			else:
+				self._schedule_retry()
+		
+		client._iface.InstallMonitor(monitor.path, monitor.time_range,
+			monitor.templates, reply_handler=installed, error_handler=failed)
+		client._installed_monitors.append(monitor)
+		return False
+	
+	def _retire(self, monitor):
+		if monitor is not None:
+			# Stop exporting it once the engine won't notify it anymore
+			self._client.remove_monitor(monitor,
+				lambda removed: monitor.remove_from_connection())
+	
+	def _dispatch_insert(self, sender, time_range, events):
+		if sender is not self._monitor:
+			return
+		matches = OrderedDict()
+		for event in events:
+			timestamp = int(event.timestamp)
+			monitors = self._catch_all + [self._index[handle]
+				for handle in self._index.matches(event)]
+			for monitor in monitors:
+				if monitor in matches and matches[monitor][-1] is event:
+					# Matched by several templates
+					continue
+				if monitor.time_range.begin <= timestamp <= \
+					monitor.time_range.end:
+					matches.setdefault(monitor, []).append(event)
+		for monitor, matching in matches.iteritems():
+			timestamps = [int(event.timestamp) for event in matching]
+			monitor.insert_callback(
+				TimeRange(min(timestamps), max(timestamps)), matching)
+	
+	def _dispatch_delete(self, sender, time_range, event_ids):
+		if sender is not self._monitor:
+			return
+		for monitor in list(self._monitors):
+			if monitor.time_range.intersect(time_range) is not None:
+				monitor.delete_callback(time_range, event_ids)
+
+class BulkInserter(object):
+	"""
+	Insert a large number of events into the Zeitgeist log.
+	
+	Events given to :meth:`insert` are buffered and sent in batches of
+	*batch_size* events, using up to *max_in_flight* asynchronous
+	InsertEvents calls at the same time, so that the engine always has
+	work to do. Events which didn't fill a whole batch are sent
+	*flush_interval* milliseconds after being buffered, or when calling
+	:meth:`flush`.
+	
+	If the engine can't keep up, :meth:`insert` returns False to signal
+	that the caller should stop producing events until *ready_handler*
+	is called (or until :meth:`wait_until_ready` returns). Events are
+	never dropped, but ignoring this makes the buffer grow unbounded.
+	
+	The ids of the inserted events are collected in the order the
+	events were inserted, see :meth:`get_ids`. Failed batches have their
+	ids set to 0 (like events the engine refused to insert) and are
+	reported to *error_handler*, which takes the exception and the list
+	of events as arguments.
+	
+	Example usage from a program not running a main loop::
+	
+	    inserter = BulkInserter(ZeitgeistClient())
+	    for event in events:
+	        if not inserter.insert(event):
+	            inserter.wait_until_ready()
+	    ids = inserter.wait()
+	
+	The flush timer and the blocking methods require a GLib main loop.
+	"""
+	
+	def __init__(self, client, batch_size=1000, flush_interval=500,
+		max_in_flight=4, ready_handler=None, error_handler=None):
+		if batch_size < 1 or max_in_flight < 1:
+			raise ValueError("batch_size and max_in_flight must be positive")
+		self._client = client
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.max_in_flight = max_in_flight
+		self._ready_handler = ready_handler
+		self._error_handler = error_handler
+		
+		self._buffer = []
+		self._ids = []
+		self._in_flight = 0
+		self._flush_requested = False
+		self._flush_source = None
+		self._flushed_handlers = []
+		self._saturated = False
+		
+		# Statistics
+		self._latencies = []
+		self._num_inserted = 0
+		self._num_errors = 0
+	
+	def insert(self, event):
+		"""
+		Queue *event* for insertion. Returns False if the engine is
+		falling behind and no more events should be given to this
+		inserter for now, True otherwise.
+		"""
+		if not isinstance(event, Event):
+			raise TypeError("Expected Event, found %s" % type(event))
+		self._buffer.append(event)
+		if len(self._buffer) >= self.batch_size:
+			self._send_batches()
+		elif self.flush_interval is not None and self._flush_source is None:
+			self._flush_source = _get_glib().timeout_add(self.flush_interval,
+				self._flush_timeout)
+		return not self.is_saturated()
+	
+	def insert_events(self, events):
+		"""
+		Queue all *events* for insertion. See :meth:`insert`.
+		"""
+		result = True
+		for event in events:
+			result = self.insert(event)
+		return result
+	
+	def is_saturated(self):
+		"""
+		Returns True if the maximum number of calls are in flight and
+		there is at least one more full batch waiting to be sent
+		"""
+		self._saturated = self._in_flight >= self.max_in_flight and \
+			len(self._buffer) >= self.batch_size
+		return self._saturated
+	
+	def flush(self, ids_reply_handler=None):
+		"""
+		Send all buffered events, even if they don't fill a batch.
+		
+		If *ids_reply_handler* is given it's called with the list of
+		all ids (see :meth:`get_ids`) once there are no more events
+		buffered or being inserted.
+		"""
+		if ids_reply_handler is not None:
+			self._flushed_handlers.append(ids_reply_handler)
+		self._flush_requested = True
+		self._send_batches()
+		self._check_flushed()
+	
+	def wait(self):
+		"""
+		Flush all buffered events and block until they are inserted.
+		Returns the list of ids of all inserted events.
+		"""
+		self.flush()
+		while self._buffer or self._in_flight:
+			_iterate_main_context()
+		return self.get_ids()
+	
+	def wait_until_ready(self):
+		"""
+		Block until the inserter is ready to accept more events
+		"""
+		while self.is_saturated():
+			_iterate_main_context()
+	
+	def get_ids(self):
+		"""
+		Return the ids of all events sent so far, in the order they were
+		inserted. Events still being inserted and failed insertions have
+		an id of 0.
+		"""
+		return list(self._ids)
+	
+	def get_stats(self):
+		"""
+		Return a dictionary with statistics about the insertions: number
+		of events *inserted*, *buffered* and *in_flight* batches, completed
+		*batches* and *errors*, and minimum, average, median, 95th
+		percentile and maximum latency of a batch, in seconds.
+		"""
+		latencies = sorted(self._latencies)
+		stats = {
+			"inserted": self._num_inserted,
+			"buffered": len(self._buffer),
+			"in_flight": self._in_flight,
+			"batches": len(latencies),
+			"errors": self._num_errors,
+		}
+		if latencies:
+			stats.update({
+				"latency_min": latencies[0],
+				"latency_avg": sum(latencies) / len(latencies),
+				"latency_p50": latencies[len(latencies) // 2],
+				"latency_p95": latencies[int(len(latencies) * 0.95)],
+				"latency_max": latencies[-1],
+			})
+		return stats
+	
+	def _flush_timeout(self):
+		self._flush_source = None
+		self._flush_requested = True
+		self._send_batches()
+		return False
+	
+	def _send_batches(self):
+		while self._in_flight < self.max_in_flight and (
+		len(self._buffer) >= self.batch_size or
+		(self._flush_requested and self._buffer)):
+			batch = self._buffer[:self.batch_size]
+			del self._buffer[:self.batch_size]
+			self._send(batch)
+		if not self._buffer:
+			self._flush_requested = False
+			if self._flush_source is not None:
+				_get_glib().source_remove(self._flush_source)
+				self._flush_source = None
+	
+	def _send(self, batch):
+		offset = len(self._ids)
+		self._ids.extend([0] * len(batch))
+		self._in_flight += 1
+		start = time.time()
+		
+		def reply_handler(ids):
+			self._ids[offset:offset + len(batch)] = map(int, ids)
+			self._num_inserted += len(batch)
+			self._batch_done(start)
+		
+		def error_handler(exception):
+			self._num_errors += 1
+			if self._error_handler is not None:
+				self._error_handler(exception, batch)
+			else:
+				log.warn("Error inserting %d events: %s" % (len(batch),
+					exception))
+			self._batch_done(start)
+		
+		self._client.insert_events(batch, ids_reply_handler=reply_handler,
+			error_handler=error_handler)
+	
+	def _batch_done(self, start):
+		self._latencies.append(time.time() - start)
+		self._in_flight -= 1
+		was_saturated = self._saturated
+		self._send_batches()
+		if was_saturated and not self.is_saturated() and \
+		self._ready_handler is not None:
+			self._ready_handler()
+		self._check_flushed()
+	
+	def _check_flushed(self):
+		if self._flushed_handlers and not self._buffer and \
+		not self._in_flight:
+			handlers, self._flushed_handlers = self._flushed_handlers, []
+			ids = self.get_ids()
+			for handler in handlers:
+				handler(ids)
+
 _FIND_EVENTS_FOR_TEMPLATES_ARGS = inspect.getargspec(
 	ZeitgeistClient.find_events_for_templates)[0]
 
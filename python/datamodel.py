@@ -26,6 +26,10 @@ import os.path
 import gettext
 import time
 import sys
+import marshal
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
 gettext.install("zeitgeist", unicode=1)
 
 __all__ = [
@@ -35,9 +39,18 @@ __all__ = [
     'RelevantResultType',
 	'StorageState',
 	'TimeRange',
+	'TimeRangeSet',
 	'DataSource',
 	'Event',
 	'Subject',
+	'CompactEvent',
+	'CompactSubject',
+	'EventBatch',
+	'StringPool',
+	'get_string_pool',
+	'TemplateMatcher',
+	'compile_templates',
+	'TemplateIndex',
 	'NULL_EVENT',
 	'NEGATION_OPERATOR',
 ]
@@ -54,6 +67,13 @@ def STARTSWITH(x, y):
 	return x.startswith(y)
 
 NEEDS_CHILD_RESOLUTION = set()
+
+# Type code for arrays of 64 bit timestamps; Python 2 has no 'q' type code
+try:
+	array("q")
+	INT64_TYPECODE = "q"
+except ValueError:
+	INT64_TYPECODE = "l" if array("l").itemsize >= 8 else "d"
 	
 def get_timestamp_for_now():
 	"""
@@ -72,13 +92,136 @@ class EnumValue(int):
 def isCamelCase(text):
 	return text and text[0].isupper() and " " not in text
 
+def _camel_case(text):
+	"""Convert lower_case to CamelCase"""
+	return "".join(part.capitalize() for part in text.split("_"))
+
 def get_name_or_str(obj):
 	try:
 		return str(obj.name)
 	except AttributeError:
 		return str(obj)
 
+class StringPool(object):
+	"""
+	Pool of shared string instances.
+
+	Some fields of decoded events (interpretations, manifestations, actors
+	and mimetypes) only take a few distinct values. Passing them through
+	:meth:`intern` makes all equal values share a single object, instead of
+	keeping one copy per event.
+
+	Values are only shared with values of the same type, so that for
+	example a `str` is never replaced with an equal `unicode` or
+	:class:`Symbol`.
+
+	The pool stops growing once it holds `max_size` strings; new values
+	are then returned as they are.
+	"""
+
+	def __init__(self, max_size=4096, enabled=True):
+		self.max_size = max_size
+		self.enabled = enabled
+		self._strings = {}
+		self.reset_stats()
+
+	def intern(self, value):
+		"""
+		Return the pooled instance equal to `value`, adding `value` to the
+		pool if there is none yet
+		"""
+		if not value or not self.enabled:
+			return value
+		key = (type(value), value)
+		try:
+			value, size = self._strings[key]
+		except KeyError:
+			self.misses += 1
+			if len(self._strings) < self.max_size:
+				self._strings[key] = (value, sys.getsizeof(value))
+		else:
+			self.hits += 1
+			self.bytes_saved += size
+		return value
+
+	def intern_fields(self, data, fields, copy=True):
+		"""
+		Return the list *data* with the values at the positions *fields*
+		replaced with their pooled instances, like :meth:`intern` does
+		for a single value. Unless *copy* is False, *data* itself isn't
+		modified: if any value is replaced a copy is returned.
+		"""
+		if not self.enabled:
+			return data
+		strings = self._strings
+		hits = misses = bytes_saved = 0
+		for field in fields:
+			value = data[field]
+			if not value:
+				continue
+			key = (type(value), value)
+			entry = strings.get(key)
+			if entry is None:
+				misses += 1
+				if len(strings) < self.max_size:
+					strings[key] = (value, sys.getsizeof(value))
+				continue
+			hits += 1
+			if entry[0] is not value:
+				if copy:
+					data = list(data)
+					copy = False
+				data[field] = entry[0]
+				bytes_saved += entry[1]
+		self.hits += hits
+		self.misses += misses
+		self.bytes_saved += bytes_saved
+		return data
+
+	def get_stats(self):
+		"""
+		Return a dictionary with the number of pooled strings ("size"), the
+		number of "hits" and "misses", the "hit_rate" and an estimation
+		of the number of bytes saved ("bytes_saved")
+		"""
+		lookups = self.hits + self.misses
+		return {
+			"size": len(self._strings),
+			"hits": self.hits,
+			"misses": self.misses,
+			"hit_rate": float(self.hits) / lookups if lookups else 0.0,
+			"bytes_saved": self.bytes_saved,
+		}
+
+	def reset_stats(self):
+		self.hits = 0
+		self.misses = 0
+		self.bytes_saved = 0
+
+	def clear(self):
+		"""
+		Remove all strings from the pool and reset the statistics
+		"""
+		self._strings.clear()
+		self.reset_stats()
+
+_STRING_POOL = StringPool(enabled=False)
+
+def get_string_pool():
+	"""
+	Return the :class:`StringPool` used when decoding events and subjects.
+	
+	It is disabled by default, since it makes decoding slower. Long-lived
+	processes keeping many events around can set its `enabled` attribute
+	to True to save memory.
+	"""
+	return _STRING_POOL
+
 _SYMBOLS_BY_URI = {}
+_ontology_loaded = False
+# Held while loading the ontology, which may happen in any thread
+_ontology_lock = threading.RLock()
+_ontology_loading = False
 
 class Symbol(str):
 
@@ -90,7 +233,10 @@ class Symbol(str):
 	def __init__(self, name, parent=None, uri=None, display_name=None, doc=None, auto_resolve=True):
 		self._children = dict()
 		self._all_children = None
-		self._parents = parent or set() # will be bootstrapped to a dict at module load time
+		# Set up when bootstrapping the ontology, see _index_symbols()
+		self._id = None
+		self._ancestors = 0
+		self._parents = parent or set() # will be bootstrapped to a dict when loading the ontology
 		assert isinstance(self._parents, set), name
 		self._name = name
 		self._uri = uri
@@ -102,6 +248,7 @@ class Symbol(str):
 		return "<%s '%s'>" %(get_name_or_str(self), self.uri)
 		
 	def __getattr__(self, name):
+		if not _ontology_loaded: _load_ontology()
 		self._ensure_all_children()
 		try:
 			return self._all_children[name]
@@ -116,13 +263,18 @@ class Symbol(str):
 			raise AttributeError("'%s' object has no attribute '%s'" %(self.__class__.__name__, name))
 	
 	def __getitem__ (self, uri):
+		if not _ontology_loaded: _load_ontology()
 		return _SYMBOLS_BY_URI[uri]
 
 	def _ensure_all_children (self):
+		# Wait for the ontology first, and only publish the dictionary
+		# once complete, since other threads may be reading it
+		if not _ontology_loaded: _load_ontology()
 		if self._all_children is not None : return
-		self._all_children = dict()
+		all_children = dict()
 		for child in self._children.itervalues():
-			child._visit(self._all_children)
+			child._visit(all_children)
+		self._all_children = all_children
 	
 	def _visit (self, dikt):
 		dikt[self.name] = self
@@ -136,6 +288,7 @@ class Symbol(str):
 		`uri` itself in the list. Hence the "extended". If `uri`
 		is unknown a list containing only `uri` is returned.
 		"""
+		if not _ontology_loaded: _load_ontology()
 		try:
 			symbol = _SYMBOLS_BY_URI[uri]
 			children = list(symbol.get_all_children())
@@ -174,6 +327,7 @@ class Symbol(str):
 		"""
 		Returns a list of immediate child symbols
 		"""
+		if not _ontology_loaded: _load_ontology()
 		return frozenset(self._children.itervalues())
 		
 	def iter_all_children(self):
@@ -194,12 +348,14 @@ class Symbol(str):
 		"""
 		Returns a list of immediate parent symbols
 		"""
+		if not _ontology_loaded: _load_ontology()
 		return frozenset(self._parents.itervalues())
 	
 	def is_child_of (self, parent):
 		"""
 		Returns True if this symbol is a child of `parent`.
 		"""
+		if not _ontology_loaded: _load_ontology()
 		if not isinstance (parent, Symbol):
 			try:
 				parent = _SYMBOLS_BY_URI[parent]
@@ -208,13 +364,16 @@ class Symbol(str):
 				return self.uri == parent
 		
 		# Invariant: parent is a Symbol
-		if self.uri == parent.uri : return True
-		
-		parent._ensure_all_children()
+		if parent._id is not None and self._id is not None:
+			return bool(self._ancestors >> parent._id & 1)
 		
-		# FIXME: We should really check that child.uri is in there,
-		#        but that is not fast with the current code layout
-		return self.name in parent._all_children
+		# One of the symbols was created after loading the ontology
+		if self.uri == parent.uri : return True
+		uri = self.uri
+		for child in parent.iter_all_children():
+			if child.uri == uri:
+				return True
+		return False
 	
 	@staticmethod
 	def uri_is_child_of (child, parent):
@@ -223,6 +382,7 @@ class Symbol(str):
 		and `parent` arguments must be any combination of
 		:class:`Symbol` and/or string.
 		"""
+		if not _ontology_loaded: _load_ontology()
 		if isinstance (child, basestring):
 			try:
 				child = _SYMBOLS_BY_URI[child]
@@ -359,6 +519,207 @@ class TimeRange(list):
 		return result
 
 
+class TimeRangeSet(object):
+	"""
+	An immutable set of timestamps, stored as sorted, non-overlapping
+	intervals. Like with :class:`TimeRange` both ends of an interval are
+	included, and adjacent intervals are merged.
+	
+	The intervals can be given as :class:`TimeRange` instances or as
+	any other pair of timestamps, like the DBus type (xx). Iterating
+	over the set yields :class:`TimeRange` instances.
+	
+	Operations involving a single time range or timestamp use binary
+	searches over the intervals, so they are cheap even for large sets.
+	"""
+	
+	__slots__ = ("_begins", "_ends")
+	
+	def __init__(self, time_ranges=()):
+		self._begins = array(INT64_TYPECODE)
+		self._ends = array(INT64_TYPECODE)
+		if isinstance(time_ranges, TimeRangeSet):
+			self._begins.extend(time_ranges._begins)
+			self._ends.extend(time_ranges._ends)
+			return
+		pairs = sorted((int(begin), int(end)) for begin, end in time_ranges)
+		self._extend(pairs)
+	
+	@classmethod
+	def _new_for_sorted(cls, pairs):
+		result = cls.__new__(cls)
+		result._begins = array(INT64_TYPECODE)
+		result._ends = array(INT64_TYPECODE)
+		result._extend(pairs)
+		return result
+	
+	def _extend(self, pairs):
+		# Append the intervals, sorted by their beginning, merging the
+		# ones that overlap or are adjacent
+		begins, ends = self._begins, self._ends
+		for begin, end in pairs:
+			if begin > end:
+				continue
+			if ends and begin <= ends[-1] + 1:
+				if end > ends[-1]:
+					ends[-1] = end
+			else:
+				begins.append(begin)
+				ends.append(end)
+	
+	def _pairs(self):
+		return zip(map(int, self._begins), map(int, self._ends))
+	
+	def __len__(self):
+		return len(self._begins)
+	
+	def __nonzero__(self):
+		return len(self._begins) > 0
+	
+	def __iter__(self):
+		for begin, end in self._pairs():
+			yield TimeRange(begin, end)
+	
+	def __eq__(self, other):
+		# Sequences of time ranges compare like the sets they make up
+		if not isinstance(other, TimeRangeSet):
+			try:
+				other = TimeRangeSet(other)
+			except (TypeError, ValueError):
+				return NotImplemented
+		return self._begins == other._begins and self._ends == other._ends
+	
+	def __ne__(self, other):
+		equal = self.__eq__(other)
+		if equal is NotImplemented:
+			return NotImplemented
+		return not equal
+	
+	def __hash__(self):
+		return hash(tuple(self._pairs()))
+	
+	def __repr__(self):
+		return "TimeRangeSet(%r)" % self._pairs()
+	
+	def __contains__(self, item):
+		"""
+		Check whether a timestamp, or all of a time range, is in the set
+		"""
+		if isinstance(item, (int, long)):
+			begin = end = item
+		else:
+			begin, end = item
+		i = bisect_right(self._begins, begin) - 1
+		return i >= 0 and end <= self._ends[i]
+	
+	def to_dbus(self):
+		"""
+		Return the intervals as a list of (begin, end) tuples, which
+		is transformed to the DBus type a(xx)
+		"""
+		return self._pairs()
+	
+	def get_bounds(self):
+		"""
+		Return the :class:`TimeRange` spanning all of the set, or
+		:const:`None` if it is empty
+		"""
+		if not self._begins:
+			return None
+		return TimeRange(self._begins[0], self._ends[-1])
+	
+	def overlaps(self, time_range):
+		"""
+		Check whether any timestamp in the given time range is in the set
+		"""
+		begin, end = time_range
+		i = bisect_left(self._ends, begin)
+		return i < len(self._begins) and self._begins[i] <= end
+	
+	def contains_timestamps(self, timestamps):
+		"""
+		Return a list with a boolean for each of the given timestamps,
+		telling whether it is in the set
+		"""
+		begins, ends = self._begins, self._ends
+		result = []
+		append = result.append
+		for timestamp in timestamps:
+			i = bisect_right(begins, timestamp) - 1
+			append(i >= 0 and timestamp <= ends[i])
+		return result
+	
+	def _as_set(self, other):
+		if isinstance(other, TimeRangeSet):
+			return other
+		if isinstance(other, TimeRange):
+			return TimeRangeSet((other,))
+		return TimeRangeSet(other)
+	
+	def union(self, other):
+		"""
+		Return a new :class:`TimeRangeSet` with the timestamps in
+		either set. *other* can also be a :class:`TimeRange` or a
+		list of time ranges.
+		"""
+		other = self._as_set(other)
+		a, b = self._pairs(), other._pairs()
+		merged = []
+		i = j = 0
+		while i < len(a) and j < len(b):
+			if a[i] <= b[j]:
+				merged.append(a[i])
+				i += 1
+			else:
+				merged.append(b[j])
+				j += 1
+		merged.extend(a[i:])
+		merged.extend(b[j:])
+		return self._new_for_sorted(merged)
+	__or__ = union
+	
+	def intersection(self, other):
+		"""
+		Return a new :class:`TimeRangeSet` with the timestamps in both
+		sets. *other* can also be a :class:`TimeRange` or a list of
+		time ranges.
+		"""
+		other = self._as_set(other)
+		begins, ends = self._begins, self._ends
+		result = []
+		for begin, end in other._pairs():
+			# Only the intervals in this set which end after the
+			# given one starts can intersect it
+			i = bisect_left(ends, begin)
+			while i < len(begins) and begins[i] <= end:
+				result.append((max(begin, int(begins[i])),
+					min(end, int(ends[i]))))
+				i += 1
+		return self._new_for_sorted(result)
+	__and__ = intersection
+	
+	def difference(self, other):
+		"""
+		Return a new :class:`TimeRangeSet` with the timestamps in this
+		set that aren't in *other*, which can also be a
+		:class:`TimeRange` or a list of time ranges.
+		"""
+		other = self._as_set(other)
+		other_begins, other_ends = other._begins, other._ends
+		result = []
+		for begin, end in self._pairs():
+			j = bisect_left(other_ends, begin)
+			while j < len(other_begins) and other_begins[j] <= end:
+				if other_begins[j] > begin:
+					result.append((begin, int(other_begins[j]) - 1))
+				begin = int(other_ends[j]) + 1
+				j += 1
+			if begin <= end:
+				result.append((begin, end))
+		return self._new_for_sorted(result)
+	__sub__ = difference
+
+
 class Subject(list):
 	"""
 	Represents a subject of an :class:`Event`. This class is both used to
@@ -382,6 +743,9 @@ class Subject(list):
 		Origin, CurrentOrigin, Mimetype)
 	SUPPORTS_WILDCARDS = (Uri, CurrentUri, Origin, CurrentOrigin, Mimetype)
 	
+	# Fields with few distinct values, shared through the string pool
+	INTERNED_FIELDS = (Interpretation, Manifestation, Mimetype)
+	
 	def __init__(self, data=None):
 		if data:
 			if len(data) == len(Subject.Fields) - 2:
@@ -395,6 +759,7 @@ class Subject(list):
 					"Invalid subject data length %s, expected %s" \
 					%(len(data), len(Subject.Fields)))
 			super(Subject, self).__init__(data)
+			_STRING_POOL.intern_fields(self, Subject.INTERNED_FIELDS, False)
 		else:
 			super(Subject, self).__init__([""]*len(Subject.Fields))
 		
@@ -412,6 +777,18 @@ class Subject(list):
 				return False
 		return True
 	
+	@classmethod
+	def new_for_raw_struct(cls, data):
+		"""
+		Fast variant of the constructor for subject structs received from
+		the Zeitgeist engine, used by :meth:`Event.new_for_raw_struct`.
+		*data* isn't validated.
+		"""
+		self = list.__new__(cls)
+		list.extend(self, data)
+		_STRING_POOL.intern_fields(self, Subject.INTERNED_FIELDS, False)
+		return self
+	
 	@staticmethod
 	def new_for_values (**values):
 		"""
@@ -548,6 +925,9 @@ class Subject(list):
 		else:
 			return comp(self[field_id], expression)
 
+# Subject.new_for_raw_struct() only bypasses this constructor
+_subject_init = Subject.__init__.im_func
+
 class Event(list):
 	"""
 	Core data structure in the Zeitgeist framework. It is an optimized and
@@ -573,6 +953,9 @@ class Event(list):
 	SUPPORTS_NEGATION = (Interpretation, Manifestation, Actor, Origin)
 	SUPPORTS_WILDCARDS = (Actor, Origin)
 	
+	# Fields with few distinct values, shared through the string pool
+	INTERNED_FIELDS = (Interpretation, Manifestation, Actor)
+	
 	_subject_type = Subject
 	
 	def __init__(self, struct = None):
@@ -617,8 +1000,10 @@ class Event(list):
 			# If this event is being created from an existing Event instance,
 			# make a copy of the list holding the event information. This
 			# enables the idiom "event2 = Event(event1)" to copy an event.
-			if isinstance(struct, Event):
+			if isinstance(struct, Event) or isinstance(self[0], tuple):
 				self[0] = list(self[0])
+			self[0] = _STRING_POOL.intern_fields(self[0],
+				Event.INTERNED_FIELDS)
 		else:
 			self.extend(([""]* len(Event.Fields), [], ""))
 		
@@ -658,6 +1043,34 @@ class Event(list):
 			return None
 		return cls(struct)
 	
+	@classmethod
+	def new_for_raw_struct(cls, struct):
+		"""
+		Fast variant of :meth:`new_for_struct` for structs received from
+		the Zeitgeist engine, which are known to be complete and
+		well-formed. The event metadata and payload are used as they are,
+		and the subjects are wrapped into :class:`Subject` instances
+		without validation. Subclasses with their own constructor are
+		created through it.
+		
+		Returns None if `struct` is a `NULL_EVENT`.
+		"""
+		data = struct[0]
+		if not data:
+			return None
+		if cls.__init__.im_func is not _event_init:
+			# Subclasses may need their own constructor to run
+			return cls(struct)
+		data = _STRING_POOL.intern_fields(data, Event.INTERNED_FIELDS)
+		subject_type = cls._subject_type
+		if subject_type.__init__.im_func is _subject_init:
+			subjects = map(subject_type.new_for_raw_struct, struct[1])
+		else:
+			subjects = map(subject_type, struct[1])
+		self = cls.__new__(cls)
+		list.extend(self, (data, subjects, struct[2]))
+		return self
+	
 	@classmethod
 	def new_for_values(cls, **values):
 		"""
@@ -886,6 +1299,841 @@ class Event(list):
 		t = int(self.timestamp) # The timestamp may be stored as a string
 		return (t >= time_range.begin) and (t <= time_range.end)
 
+# Event.new_for_raw_struct() only bypasses this constructor
+_event_init = Event.__init__.im_func
+
+class CompactSubject(tuple):
+	"""
+	Immutable, memory efficient variant of :class:`Subject`.
+
+	A CompactSubject is a plain tuple holding the subject fields at the
+	positions defined by the :attr:`Subject.Fields` enumeration. It has
+	no instance dictionary and no list over-allocation, which makes it
+	considerably smaller than a :class:`Subject`.
+
+	It exposes the same read-only properties and the same
+	:meth:`matches_template` semantics as :class:`Subject`.
+	"""
+	__slots__ = ()
+
+	Fields = Subject.Fields
+	SUPPORTS_NEGATION = Subject.SUPPORTS_NEGATION
+	SUPPORTS_WILDCARDS = Subject.SUPPORTS_WILDCARDS
+
+	def __new__(cls, data=None):
+		if not data:
+			return super(CompactSubject, cls).__new__(cls,
+				("",) * len(Subject.Fields))
+		if len(data) < len(Subject.Fields) - 2:
+			raise ValueError("Invalid subject data length %s, expected %s" \
+				%(len(data), len(Subject.Fields)))
+		data = list(data)
+		if len(data) < len(Subject.Fields):
+			# current_uri and current_origin have been added in
+			# Zeitgeist 0.8.0 and 1.0 Beta 1, respectively
+			data.extend([""] * (len(Subject.Fields) - len(data)))
+		intern = _STRING_POOL.intern
+		for field in Subject.INTERNED_FIELDS:
+			data[field] = intern(data[field])
+		return super(CompactSubject, cls).__new__(cls, data)
+
+	def __repr__(self):
+		return "%s(%s)" %(
+			self.__class__.__name__, super(CompactSubject, self).__repr__()
+		)
+
+	uri = property(Subject.get_uri.im_func,
+		doc="Read-only property with the URI of the subject")
+	current_uri = property(Subject.get_current_uri.im_func,
+		doc="Read-only property with the current URI of the subject")
+	interpretation = property(Subject.get_interpretation.im_func,
+		doc="Read-only property with the interpretation type of the subject")
+	manifestation = property(Subject.get_manifestation.im_func,
+		doc="Read-only property with the manifestation type of the subject")
+	origin = property(Subject.get_origin.im_func,
+		doc="Read-only property with the origin of the subject")
+	current_origin = property(Subject.get_current_origin.im_func,
+		doc="Read-only property with the current origin of the subject")
+	mimetype = property(Subject.get_mimetype.im_func,
+		doc="Read-only property with the mimetype of the subject")
+	text = property(Subject.get_text.im_func,
+		doc="Read-only property with a free form annotation of the subject")
+	storage = property(Subject.get_storage.im_func,
+		doc="Read-only property with the storage medium of the subject")
+
+	# Share the matching code with Subject; it only uses item access
+	matches_template = Subject.matches_template.im_func
+	_check_field_match = Subject._check_field_match.im_func
+
+	def to_subject(self, subject_type=Subject):
+		"""
+		Return a mutable :class:`Subject` with the same contents
+		"""
+		return subject_type(list(self))
+
+class CompactEvent(tuple):
+	"""
+	Immutable, memory efficient variant of :class:`Event`.
+
+	A CompactEvent is a tuple with the same layout as an :class:`Event`
+	(a tuple with the event metadata, a tuple of :class:`CompactSubject`
+	instances and the payload). Since tuples are accepted as D-Bus
+	structs it is marshalled with the signature a(asaasay) as it is,
+	without being converted first.
+
+	This class is meant for keeping large amounts of events around, eg.
+	the results of a query. It exposes the same read-only properties and
+	the same :meth:`matches_template` semantics as :class:`Event`. Use
+	:meth:`to_event` to get a mutable copy.
+	"""
+	__slots__ = ()
+
+	Fields = Event.Fields
+	SUPPORTS_NEGATION = Event.SUPPORTS_NEGATION
+	SUPPORTS_WILDCARDS = Event.SUPPORTS_WILDCARDS
+
+	_subject_type = CompactSubject
+
+	def __new__(cls, struct=None):
+		"""
+		See :meth:`Event.__init__` for a description of the accepted
+		'struct' layout.
+		"""
+		if not struct:
+			struct = ([""] * len(Event.Fields),)
+		elif len(struct) > 3:
+			raise ValueError("Invalid struct length %s" % len(struct))
+		data = struct[0]
+		if len(data) < len(Event.Fields) - 1:
+			raise ValueError("event_data must have %s members, found %s" % \
+				(len(Event.Fields), len(data)))
+		data = list(data)
+		if len(data) < len(Event.Fields):
+			# Old versions of Zeitgeist didn't have the event origin field.
+			data.append("")
+		if not data[Event.Timestamp]:
+			data[Event.Timestamp] = str(get_timestamp_for_now())
+		intern = _STRING_POOL.intern
+		for field in Event.INTERNED_FIELDS:
+			data[field] = intern(data[field])
+		subject_type = cls._subject_type
+		if len(struct) > 1:
+			subjects = tuple([subject_type(s) for s in struct[1]])
+		else:
+			subjects = ()
+		payload = struct[2] if len(struct) > 2 else ""
+		return super(CompactEvent, cls).__new__(cls,
+			(tuple(data), subjects, payload))
+
+	@classmethod
+	def new_for_struct(cls, struct):
+		"""Returns a new CompactEvent instance or None if `struct` is a
+		`NULL_EVENT`"""
+		if struct == NULL_EVENT:
+			return None
+		return cls(struct)
+
+	@classmethod
+	def new_for_values(cls, **values):
+		"""
+		Create a new CompactEvent from the same keyword arguments
+		accepted by :meth:`Event.new_for_values`.
+		"""
+		return cls(Event.new_for_values(**values))
+
+	def __repr__(self):
+		return "%s(%s)" %(
+			self.__class__.__name__, super(CompactEvent, self).__repr__()
+		)
+
+	def to_event(self, event_type=Event):
+		"""
+		Return a mutable :class:`Event` (or instance of `event_type`)
+		with the same contents
+		"""
+		subject_type = event_type._subject_type
+		return event_type((list(self[0]),
+			[subject_type(list(s)) for s in self[1]], self[2]))
+
+	subjects = property(Event.get_subjects.im_func,
+		doc="Read-only property with a tuple of :class:`CompactSubjects <CompactSubject>`")
+	id = property(Event.get_id.im_func,
+		doc="Read only property containing the the event id if the event has one")
+	timestamp = property(Event.get_timestamp.im_func,
+		doc="Read-only property with the event timestamp defined as milliseconds since the Epoch")
+	interpretation = property(Event.get_interpretation.im_func,
+		doc="Read-only property with the interpretation type of the event")
+	manifestation = property(Event.get_manifestation.im_func,
+		doc="Read-only property with the manifestation type of the event")
+	actor = property(Event.get_actor.im_func,
+		doc="Read-only property with the actor of the event")
+	origin = property(Event.get_origin.im_func,
+		doc="Read-only property with the origin of the event")
+	payload = property(Event.get_payload.im_func,
+		doc="Read-only property with the payload of the event")
+
+	# Share the matching code with Event; it only uses item access
+	matches_template = Event.matches_template.im_func
+	_check_field_match = Event._check_field_match.im_func
+	matches_event = Event.matches_event.im_func
+	in_time_range = Event.in_time_range.im_func
+
+# Kinds of checks done by compiled templates
+_MATCH_EQUAL, _MATCH_PREFIX, _MATCH_ANY_OF = range(3)
+
+def _parse_expression(field, expression, supports_negation,
+	supports_wildcards):
+	"""
+	Split the template `expression` for the given field into a
+	(value, negated, is_prefix) tuple
+	"""
+	negated = False
+	while field in supports_negation and \
+	expression.startswith(NEGATION_OPERATOR):
+		expression = expression[len(NEGATION_OPERATOR):]
+		negated = not negated
+	if field in supports_wildcards and expression.endswith(WILDCARD):
+		return (expression[:-len(WILDCARD)], negated, True)
+	return (expression, negated, False)
+
+def _compile_field_check(field, expression, supports_negation,
+	supports_wildcards, is_symbol):
+	"""
+	Turn the template `expression` for the given field into a
+	(field, kind, operand, negated) tuple
+	"""
+	expression, negated, is_prefix = _parse_expression(field, expression,
+		supports_negation, supports_wildcards)
+	if is_prefix:
+		return (field, _MATCH_PREFIX, expression, negated)
+	elif is_symbol:
+		# Symbols also match all their children
+		return (field, _MATCH_ANY_OF,
+			frozenset(Symbol.find_child_uris_extended(expression)), negated)
+	return (field, _MATCH_EQUAL, expression, negated)
+
+def _compile_event_checks(event_template):
+	checks = []
+	data = event_template[0]
+	for field in Event.Fields:
+		if field == Event.Timestamp or not data[field]:
+			continue
+		checks.append(_compile_field_check(field, data[field],
+			Event.SUPPORTS_NEGATION, Event.SUPPORTS_WILDCARDS,
+			field in (Event.Interpretation, Event.Manifestation)))
+	return tuple(checks)
+
+def _compile_subject_checks(subject_template):
+	checks = []
+	for field in Subject.Fields:
+		if not subject_template[field]:
+			continue
+		if field == Subject.Storage:
+			# see Subject.matches_template
+			raise ValueError("zeitgeist does not support searching by "
+				"'storage' field")
+		checks.append(_compile_field_check(field, subject_template[field],
+			Subject.SUPPORTS_NEGATION, Subject.SUPPORTS_WILDCARDS,
+			field in (Subject.Interpretation, Subject.Manifestation)))
+	return tuple(checks)
+
+def _check_fields(values, checks):
+	for field, kind, operand, negated in checks:
+		if kind == _MATCH_EQUAL:
+			result = values[field] == operand
+		elif kind == _MATCH_PREFIX:
+			result = values[field].startswith(operand)
+		else:
+			result = values[field] in operand
+		if result == negated:
+			return False
+	return True
+
+def _compile_template(event_template):
+	subject_checks = None
+	if event_template[1]:
+		subject_checks = tuple(_compile_subject_checks(subject)
+			for subject in event_template[1])
+	return (_compile_event_checks(event_template), subject_checks)
+
+def _compiled_template_matches(compiled, event):
+	checks, subject_checks = compiled
+	if not _check_fields(event[0], checks):
+		return False
+	if subject_checks is None:
+		return True
+	for subject in event[1]:
+		for checks in subject_checks:
+			if _check_fields(subject, checks):
+				return True
+	return False
+
+class TemplateMatcher(object):
+	"""
+	Predicate checking whether an event matches any of a list of event
+	templates, with the same semantics as :meth:`Event.matches_template`.
+
+	The templates are analyzed only once, when the matcher is created:
+	negations and wildcards are resolved and interpretations and
+	manifestations are expanded into the set of URIs of all their
+	children. This makes matching many events against the same templates
+	a lot faster than calling :meth:`Event.matches_template` repeatedly.
+
+	Like in queries to the Zeitgeist engine, an empty list of templates
+	matches all events.
+
+	Changes made to the templates after creating the matcher are not
+	taken into account. Instances are created with :func:`compile_templates`.
+	"""
+
+	def __init__(self, event_templates):
+		self.templates = list(event_templates)
+		self._compiled = map(_compile_template, self.templates)
+		self._match_all = not self.templates
+
+	def __call__(self, event):
+		"""
+		Return True if `event` matches any of the templates
+		"""
+		if self._match_all:
+			return True
+		for compiled in self._compiled:
+			if _compiled_template_matches(compiled, event):
+				return True
+		return False
+
+	matches = __call__
+
+	def get_matching_templates(self, event):
+		"""
+		Return a list with the positions of all templates matched by `event`
+		"""
+		return [i for (i, compiled) in enumerate(self._compiled)
+			if _compiled_template_matches(compiled, event)]
+
+	def filter(self, events):
+		"""
+		Return a list with those `events` matching any of the templates
+		"""
+		if self._match_all:
+			return list(events)
+		return [event for event in events if self(event)]
+
+def compile_templates(event_templates):
+	"""
+	Return a :class:`TemplateMatcher` for the given list of event
+	templates. The result can be used as a predicate on events::
+
+	    matches = compile_templates(templates)
+	    interesting = [event for event in events if matches(event)]
+	"""
+	return TemplateMatcher(event_templates)
+
+def _ancestor_uris(uri, _cache={}):
+	"""
+	Return a frozenset with `uri` and the URIs of all its known
+	ancestors in the ontology
+	"""
+	try:
+		return _cache[uri]
+	except KeyError:
+		pass
+	if not _ontology_loaded: _load_ontology()
+	symbol = _SYMBOLS_BY_URI.get(uri)
+	if symbol is None:
+		# Don't cache unknown URIs, there is no bound on them
+		return frozenset((uri,))
+	ancestors = set((uri,))
+	for parent in symbol.get_parents():
+		ancestors.update(_ancestor_uris(parent.uri))
+	_cache[uri] = ancestors = frozenset(ancestors)
+	return ancestors
+
+class TemplateIndex(object):
+	"""
+	Collection of event templates able to quickly find those matching
+	a given event, even when there are thousands of them.
+
+	Each template is stored in a single bucket, chosen from its first
+	positive requirement in this order: its actor, its interpretation,
+	its manifestation or the URIs of its subject templates (which are
+	kept in a prefix trie, so that wildcards work). Looking up an event
+	then only considers the templates in the bucket of its actor, in the
+	buckets of its interpretation and manifestation and all their
+	ancestors and in the trie nodes along the URIs of its subjects.
+	Templates without any such requirement, eg. those containing only
+	negations, are always considered. Candidates are verified with the
+	same semantics as :meth:`Event.matches_template`.
+
+	Templates are identified by the handle returned by :meth:`add` and
+	can carry any `data`, eg. the destination of a routing rule. Changes
+	made to a template after adding it are not taken into account.
+	"""
+
+	def __init__(self, event_templates=()):
+		self._next_handle = 0
+		# handle -> (template, compiled template, data, locations)
+		self._entries = {}
+		self._by_actor = {}
+		self._by_interpretation = {}
+		self._by_manifestation = {}
+		# Trie nodes are [children, exact handles, prefix handles]
+		self._uri_trie = [{}, set(), set()]
+		self._unindexed = set()
+		for template in event_templates:
+			self.add(template)
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __contains__(self, handle):
+		return handle in self._entries
+
+	def __getitem__(self, handle):
+		"""
+		Return the data attached to the template with the given handle
+		"""
+		return self._entries[handle][2]
+
+	def get_template(self, handle):
+		return self._entries[handle][0]
+
+	def _get_locations(self, template):
+		"""
+		Return a list of (table, key) tuples telling where to store a
+		template. A table of None stands for the subject URI trie,
+		with (uri, is_prefix) keys.
+		"""
+		data = template[0]
+		for field, table in ((Event.Actor, self._by_actor),
+			(Event.Interpretation, self._by_interpretation),
+			(Event.Manifestation, self._by_manifestation)):
+			if not data[field]:
+				continue
+			value, negated, is_prefix = _parse_expression(field,
+				data[field], Event.SUPPORTS_NEGATION,
+				Event.SUPPORTS_WILDCARDS)
+			if not negated and not is_prefix:
+				return [(table, value)]
+		locations = []
+		for subject in template[1]:
+			if not subject[Subject.Uri]:
+				break
+			value, negated, is_prefix = _parse_expression(Subject.Uri,
+				subject[Subject.Uri], Subject.SUPPORTS_NEGATION,
+				Subject.SUPPORTS_WILDCARDS)
+			if negated:
+				break
+			locations.append((None, (value, is_prefix)))
+		else:
+			if locations:
+				return locations
+		return [(self._unindexed, None)]
+
+	def add(self, event_template, data=None):
+		"""
+		Add `event_template` to the index and return its handle. If no
+		`data` is given the template itself is used.
+
+		Raises a ValueError if the template can't be matched locally,
+		eg. if it uses the subject storage field.
+		"""
+		compiled = _compile_template(event_template)
+		handle = self._next_handle
+		self._next_handle += 1
+		locations = self._get_locations(event_template)
+		for table, key in locations:
+			if table is self._unindexed:
+				table.add(handle)
+			elif table is None:
+				self._trie_add(key[0], key[1], handle)
+			else:
+				table.setdefault(key, set()).add(handle)
+		self._entries[handle] = (event_template, compiled,
+			event_template if data is None else data, locations)
+		return handle
+
+	def remove(self, handle):
+		"""
+		Remove the template with the given handle from the index
+		"""
+		locations = self._entries.pop(handle)[3]
+		for table, key in locations:
+			if table is self._unindexed:
+				table.discard(handle)
+			elif table is None:
+				self._trie_remove(key[0], key[1], handle)
+			else:
+				handles = table[key]
+				handles.discard(handle)
+				if not handles:
+					del table[key]
+
+	def clear(self):
+		self._entries.clear()
+		self._by_actor.clear()
+		self._by_interpretation.clear()
+		self._by_manifestation.clear()
+		self._uri_trie = [{}, set(), set()]
+		self._unindexed.clear()
+
+	def _trie_add(self, uri, is_prefix, handle):
+		node = self._uri_trie
+		for char in uri:
+			node = node[0].setdefault(char, [{}, set(), set()])
+		node[2 if is_prefix else 1].add(handle)
+
+	def _trie_remove(self, uri, is_prefix, handle):
+		path = []
+		node = self._uri_trie
+		for char in uri:
+			path.append((node, char))
+			node = node[0][char]
+		node[2 if is_prefix else 1].discard(handle)
+		# Prune the branches which became empty
+		while path and not (node[0] or node[1] or node[2]):
+			node, char = path.pop()
+			del node[0][char]
+
+	def _trie_lookup(self, uri, result):
+		node = self._uri_trie
+		result.update(node[2])
+		for char in uri:
+			node = node[0].get(char)
+			if node is None:
+				return
+			result.update(node[2])
+		result.update(node[1])
+
+	def candidates(self, event):
+		"""
+		Return a set with the handles of the templates which may match
+		`event` and need to be verified
+		"""
+		data = event[0]
+		result = set(self._unindexed)
+		handles = self._by_actor.get(data[Event.Actor])
+		if handles:
+			result.update(handles)
+		for field, table in ((Event.Interpretation, self._by_interpretation),
+			(Event.Manifestation, self._by_manifestation)):
+			if not table:
+				continue
+			for uri in _ancestor_uris(data[field]):
+				handles = table.get(uri)
+				if handles:
+					result.update(handles)
+		if self._uri_trie[0] or self._uri_trie[2]:
+			for subject in event[1]:
+				self._trie_lookup(subject[Subject.Uri], result)
+		return result
+
+	def matches(self, event):
+		"""
+		Return a list with the handles of all templates matching
+		`event`, in the order they were added
+		"""
+		entries = self._entries
+		return sorted(handle for handle in self.candidates(event)
+			if _compiled_template_matches(entries[handle][1], event))
+
+	def matches_any(self, event):
+		"""
+		Return True if `event` matches any of the templates
+		"""
+		entries = self._entries
+		for handle in self.candidates(event):
+			if _compiled_template_matches(entries[handle][1], event):
+				return True
+		return False
+
+class EventBatch(object):
+	"""
+	Columnar container for a large number of events, eg. the result of
+	a query.
+
+	Instead of keeping one :class:`Event` object per row, the event ids
+	and timestamps are stored in flat integer arrays (along with a flag
+	marking the rows which stand for a `NULL_EVENT`) and all other fields
+	are stored as indexes into a string table shared by all the rows. The
+	subjects of all events are stored in the same way, flattened into one
+	set of columns; the subjects of row *i* are those between
+	`subject_offsets[i]` and `subject_offsets[i+1]`.
+
+	:class:`Event` instances are only created when a row is accessed,
+	using item access or iteration. Rows which stand for a `NULL_EVENT`
+	are returned as :const:`None`.
+
+	Filtering and sorting return a new EventBatch sharing the string table
+	with the original one.
+	"""
+
+	# Event fields stored in the string table
+	_EVENT_FIELDS = (Event.Interpretation, Event.Manifestation, Event.Actor,
+		Event.Origin)
+
+	_event_type = Event
+
+	def __init__(self, event_type=None, _strings=None):
+		if event_type is not None:
+			if not issubclass(event_type, Event):
+				raise TypeError("Event subclass expected.")
+			self._event_type = event_type
+		if _strings is None:
+			# The empty string always has index 0
+			_strings = ([""], {"": 0})
+		self._strings, self._string_ids = _strings
+		self.ids = array("I")
+		self.timestamps = array(INT64_TYPECODE)
+		self._nulls = array("B")
+		self._event_columns = dict((field, array("I"))
+			for field in self._EVENT_FIELDS)
+		self._payloads = []
+		self.subject_offsets = array("I", [0])
+		self._subject_columns = [array("I") for f in Subject.Fields]
+
+	@classmethod
+	def new_for_structs(cls, structs, event_type=None):
+		"""
+		Create a new EventBatch from a list of raw event structs, as
+		received over D-Bus. `NULL_EVENT` structs are kept as rows
+		returned as :const:`None`.
+		"""
+		self = cls(event_type)
+		for struct in structs:
+			self.append_struct(struct)
+		return self
+
+	@classmethod
+	def new_for_events(cls, events, event_type=None):
+		"""
+		Create a new EventBatch from a list of :class:`Event` instances.
+		"""
+		return cls.new_for_structs(
+			(NULL_EVENT if event is None else event for event in events),
+			event_type)
+
+	def _get_string_id(self, value, pooled=False):
+		try:
+			return self._string_ids[value]
+		except KeyError:
+			string_id = self._string_ids[value] = len(self._strings)
+			self._strings.append(_STRING_POOL.intern(value) if pooled
+				else value)
+			return string_id
+
+	def append_struct(self, struct):
+		"""
+		Append an event given as a raw struct (or :class:`Event`) to
+		the batch.
+		"""
+		get_string_id = self._get_string_id
+		data = struct[0]
+		if not data:
+			# NULL_EVENT
+			self._nulls.append(1)
+			self.ids.append(0)
+			self.timestamps.append(0)
+			for column in self._event_columns.itervalues():
+				column.append(0)
+			self._payloads.append("")
+		else:
+			self._nulls.append(0)
+			self.ids.append(int(data[Event.Id] or 0))
+			self.timestamps.append(int(data[Event.Timestamp]))
+			for field in self._EVENT_FIELDS:
+				value = data[field] if field < len(data) else ""
+				self._event_columns[field].append(get_string_id(value,
+					field in Event.INTERNED_FIELDS))
+			self._payloads.append(struct[2] if len(struct) > 2 else "")
+		subjects = struct[1] if len(struct) > 1 else ()
+		for subject in subjects:
+			for field, column in enumerate(self._subject_columns):
+				value = subject[field] if field < len(subject) else ""
+				column.append(get_string_id(value,
+					field in Subject.INTERNED_FIELDS))
+		self.subject_offsets.append(
+			self.subject_offsets[-1] + len(subjects))
+
+	def extend(self, events):
+		"""
+		Append a list of raw event structs or :class:`Event` instances
+		"""
+		for event in events:
+			self.append_struct(NULL_EVENT if event is None else event)
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __iter__(self):
+		for row in xrange(len(self.ids)):
+			yield self.get_event(row)
+
+	def __getitem__(self, row):
+		if isinstance(row, slice):
+			return self.select(xrange(*row.indices(len(self.ids))))
+		if row < 0:
+			row += len(self.ids)
+		return self.get_event(row)
+
+	def __repr__(self):
+		return "<%s with %d events>" % (self.__class__.__name__, len(self))
+
+	def is_null(self, row):
+		"""
+		Return True if `row` stands for a `NULL_EVENT`
+		"""
+		return self._nulls[row] == 1
+
+	def get_value(self, row, field):
+		"""
+		Return the value of the :attr:`Event.Fields` `field` for `row`
+		"""
+		if field == Event.Id:
+			return str(self.ids[row]) if self.ids[row] else ""
+		elif field == Event.Timestamp:
+			return str(self.timestamps[row])
+		return self._strings[self._event_columns[field][row]]
+
+	def get_subject_values(self, row, field):
+		"""
+		Return a list with the value of the :attr:`Subject.Fields` `field`
+		for each subject in `row`
+		"""
+		strings = self._strings
+		column = self._subject_columns[field]
+		return [strings[column[i]] for i in
+			xrange(self.subject_offsets[row], self.subject_offsets[row+1])]
+
+	def get_event(self, row):
+		"""
+		Return a new :class:`Event` instance with the data of `row`, or
+		:const:`None` if `row` stands for a `NULL_EVENT`.
+		"""
+		if self._nulls[row]:
+			return None
+		strings = self._strings
+		data = [self.get_value(row, field) for field in Event.Fields]
+		subjects = []
+		for i in xrange(self.subject_offsets[row], self.subject_offsets[row+1]):
+			subjects.append([strings[column[i]]
+				for column in self._subject_columns])
+		return self._event_type((data, subjects, self._payloads[row]))
+
+	def select(self, rows):
+		"""
+		Return a new EventBatch with the given rows, in the given order
+		"""
+		batch = self.__class__(self._event_type,
+			(self._strings, self._string_ids))
+		for row in rows:
+			batch._nulls.append(self._nulls[row])
+			batch.ids.append(self.ids[row])
+			batch.timestamps.append(self.timestamps[row])
+			for field, column in self._event_columns.iteritems():
+				batch._event_columns[field].append(column[row])
+			batch._payloads.append(self._payloads[row])
+			start = self.subject_offsets[row]
+			end = self.subject_offsets[row+1]
+			for column, new_column in zip(self._subject_columns,
+			batch._subject_columns):
+				new_column.extend(column[start:end])
+			batch.subject_offsets.append(
+				batch.subject_offsets[-1] + end - start)
+		return batch
+
+	def filter(self, predicate):
+		"""
+		Return a new EventBatch with the rows for which `predicate` returns
+		True. The predicate is called with an :class:`Event` for each row
+		(:const:`None` for `NULL_EVENT` rows).
+
+		This creates an :class:`Event` per row, so consider using
+		:meth:`filter_time_range` or :meth:`filter_values` if possible.
+		"""
+		return self.select([row for row in xrange(len(self.ids))
+			if predicate(self.get_event(row))])
+
+	def filter_templates(self, event_templates):
+		"""
+		Return a new EventBatch with the (non-null) rows matching any of
+		the given event templates. See :class:`TemplateMatcher`.
+		"""
+		matches = compile_templates(event_templates)
+		return self.filter(lambda event: event is not None and matches(event))
+
+	def filter_time_range(self, time_range):
+		"""
+		Return a new EventBatch with the (non-null) rows lying within the
+		given :class:`TimeRange`
+		"""
+		begin, end = time_range[0], time_range[1]
+		nulls = self._nulls
+		return self.select([row for (row, timestamp) in
+			enumerate(self.timestamps) if begin <= timestamp <= end
+			and not nulls[row]])
+
+	def filter_values(self, **values):
+		"""
+		Return a new EventBatch with the rows where all the given fields
+		are exactly equal to the given values. The keywords are the same
+		as for :meth:`Event.new_for_values`, except for *timestamp* and
+		*subjects*. A row matches a *subject_** keyword if any of its
+		subjects has that value.
+		"""
+		event_fields = []
+		subject_fields = []
+		for key, value in values.iteritems():
+			if key.startswith("subject_") and \
+			hasattr(Subject, _camel_case(key[8:])):
+				fields, field = subject_fields, \
+					getattr(Subject, _camel_case(key[8:]))
+			elif key in ("interpretation", "manifestation", "actor",
+			"origin"):
+				fields, field = event_fields, getattr(Event, _camel_case(key))
+			else:
+				raise ValueError("Unsupported filter '%s'" % key)
+			if value not in self._string_ids:
+				# No row can possibly match
+				return self.select(())
+			fields.append((field, self._string_ids[value]))
+
+		rows = []
+		offsets = self.subject_offsets
+		for row in xrange(len(self.ids)):
+			if self._nulls[row]:
+				continue
+			for field, string_id in event_fields:
+				if self._event_columns[field][row] != string_id:
+					break
+			else:
+				for field, string_id in subject_fields:
+					column = self._subject_columns[field]
+					for i in xrange(offsets[row], offsets[row+1]):
+						if column[i] == string_id:
+							break
+					else:
+						break
+				else:
+					rows.append(row)
+		return self.select(rows)
+
+	def sort_by_timestamp(self, reverse=False):
+		"""
+		Return a new EventBatch with the rows sorted by timestamp. The
+		sort is stable.
+		"""
+		timestamps = self.timestamps
+		return self.select(sorted(xrange(len(self.ids)),
+			key=timestamps.__getitem__, reverse=reverse))
+
+	def get_ids(self):
+		"""
+		Return a list with the ids of all rows (0 for `NULL_EVENT` rows
+		and events which haven't been inserted yet)
+		"""
+		return self.ids.tolist()
+
 class DataSource(list):
 	""" Optimized and convenient data structure representing a datasource.
 	
@@ -1160,52 +2408,158 @@ FileDataObject also match subjects of types Attachment or ArchiveItem and all
 other sub types of FileDataObject
 """
 
-start_symbols = time.time()
-
 Interpretation = Symbol("Interpretation", doc=INTERPRETATION_DOC)
 Manifestation = Symbol("Manifestation", doc=MANIFESTATION_DOC)
 _SYMBOLS_BY_URI["Interpretation"] = Interpretation
 _SYMBOLS_BY_URI["Manifestation"] = Manifestation
 
-# Load the ontology definitions
+# The ontology definitions are only loaded the first time they are needed,
+# see _load_ontology()
 ontology_file = os.path.join(os.path.dirname(__file__), "_ontology.py")
-try:
-	execfile(ontology_file)
-except IOError:
+ontology_snapshot_file = os.path.join(os.path.dirname(__file__),
+	"_ontology.dat")
+if not os.path.exists(ontology_file) and \
+not os.path.exists(ontology_snapshot_file):
 	raise ImportError("Unable to load Zeitgeist ontology. Did you run `make`?")
+_SYMBOLS = []
+
+# Keep in sync with PythonSerializer.dump_snapshot() in data/ontology2code
+ONTOLOGY_SNAPSHOT_MAGIC = "zeitgeist-ontology"
+ONTOLOGY_SNAPSHOT_VERSION = 1
+
+def _load_ontology():
+	"""
+	Create all the symbols of the ontology and bootstrap their relations.
+
+	This is done the first time a symbol is looked up (eg. when accessing
+	``Interpretation.AUDIO``), so that processes which don't care about
+	the ontology don't pay for it when importing this module.
+	"""
+	global _ontology_loaded, _ontology_loading, _SYMBOLS
+	if _ontology_loaded:
+		return
+	with _ontology_lock:
+		# Bootstrapping uses the methods of Symbol, which call us back
+		if _ontology_loaded or _ontology_loading:
+			return
+		_ontology_loading = True
+		symbols_by_uri = dict(_SYMBOLS_BY_URI)
+		try:
+			symbols = _load_ontology_snapshot()
+			if symbols is None:
+				try:
+					execfile(ontology_file, globals())
+				except IOError:
+					raise ImportError("Unable to load Zeitgeist ontology. Did you run `make`?")
+				_bootstrap_symbols()
+				symbols = _index_symbols()
+		except:
+			# Drop whatever was loaded, so that the next lookup starts over
+			_SYMBOLS_BY_URI.clear()
+			_SYMBOLS_BY_URI.update(symbols_by_uri)
+			for symbol in (Interpretation, Manifestation):
+				symbol._children = dict()
+				symbol._all_children = None
+				symbol._parents = set()
+				symbol._id = None
+				symbol._ancestors = 0
+			raise
+		finally:
+			_ontology_loading = False
+		_SYMBOLS = symbols
+		_ontology_loaded = True
+
+def _load_ontology_snapshot():
+	"""
+	Create the symbols from the snapshot written by ``ontology2code
+	--python-snapshot``, which has all relations between them already
+	resolved. Returns the list of symbols ordered by id, or None if
+	there is no usable snapshot.
+	"""
+	try:
+		snapshot = open(ontology_snapshot_file, "rb")
+	except IOError:
+		return None
+	try:
+		try:
+			magic, version, entries = marshal.load(snapshot)
+		except (EOFError, ValueError, TypeError):
+			return None
+	finally:
+		snapshot.close()
+	if magic != ONTOLOGY_SNAPSHOT_MAGIC or \
+	version != ONTOLOGY_SNAPSHOT_VERSION or \
+	[entry[0] for entry in entries[:2]] != ["Interpretation", "Manifestation"]:
+		return None
+	
+	symbols = [Interpretation, Manifestation]
+	for name, uri, display_name, doc, parents, children, ancestors \
+	in entries[2:]:
+		symbols.append(Symbol(name, uri=uri, display_name=display_name,
+			doc=doc))
+	for i, (symbol, entry) in enumerate(zip(symbols, entries)):
+		symbol._parents = dict((symbols[j].uri, symbols[j]) for j in entry[4])
+		symbol._children = dict((symbols[j].uri, symbols[j]) for j in entry[5])
+		symbol._id = i
+		symbol._ancestors = entry[6]
+	return symbols
 
 #
 # Bootstrap the symbol relations. We use a 2-pass strategy:
 #
-# 1) Make sure that all parents and children are registered on each symbol
-for symbol in _SYMBOLS_BY_URI.itervalues():
-	for parent in symbol._parents:
-		try:
-			_SYMBOLS_BY_URI[parent]._children[symbol.uri] = None
-		except KeyError, e:
-			print "ERROR", e, parent, symbol.uri
-			pass
-	for child in symbol._children:
-		try:
-			_SYMBOLS_BY_URI[child]._parents.add(symbol.uri)
-		except KeyError:
-			print "ERROR", e, child, symbol.uri
-			pass
+def _bootstrap_symbols():
+	# 1) Make sure that all parents and children are registered on each symbol
+	for symbol in _SYMBOLS_BY_URI.itervalues():
+		for parent in symbol._parents:
+			try:
+				_SYMBOLS_BY_URI[parent]._children[symbol.uri] = None
+			except KeyError, e:
+				print "ERROR", e, parent, symbol.uri
+				pass
+		for child in symbol._children:
+			try:
+				_SYMBOLS_BY_URI[child]._parents.add(symbol.uri)
+			except KeyError, e:
+				print "ERROR", e, child, symbol.uri
+				pass
 
-# 2) Resolve all child and parent URIs to their actual Symbol instances
-for symbol in _SYMBOLS_BY_URI.itervalues():
-	for child_uri in symbol._children.iterkeys():
-		symbol._children[child_uri] = _SYMBOLS_BY_URI[child_uri]
-	
-	parents = {}
-	for parent_uri in symbol._parents:
-		parents[parent_uri] = _SYMBOLS_BY_URI[parent_uri]
-	symbol._parents = parents
+	# 2) Resolve all child and parent URIs to their actual Symbol instances
+	for symbol in _SYMBOLS_BY_URI.itervalues():
+		for child_uri in symbol._children.iterkeys():
+			symbol._children[child_uri] = _SYMBOLS_BY_URI[child_uri]
+		
+		parents = {}
+		for parent_uri in symbol._parents:
+			parents[parent_uri] = _SYMBOLS_BY_URI[parent_uri]
+		symbol._parents = parents
+
+# 3) Give each symbol a dense integer id and a bitset with the ids of the
+#    symbol itself and all its ancestors, so is_child_of() is a single
+#    bit test
+def _index_symbols():
+	symbols = []
+	for symbol in sorted(_SYMBOLS_BY_URI.itervalues(), key=lambda s: s.uri):
+		if symbol._id is None:
+			# The root symbols are registered under two keys
+			symbol._id = len(symbols)
+			symbols.append(symbol)
+	def get_ancestors(symbol):
+		if not symbol._ancestors:
+			ancestors = 1 << symbol._id
+			for parent in symbol._parents.itervalues():
+				ancestors |= get_ancestors(parent)
+			symbol._ancestors = ancestors
+		return symbol._ancestors
+	for symbol in symbols:
+		get_ancestors(symbol)
+	return symbols
 
 
 if __name__ == "__main__":
+	start_symbols = time.time()
+	_load_ontology()
 	print "Success"
 	end_symbols = time.time()
-	print >> sys.stderr, "Import time: %s" % (end_symbols - start_symbols)
+	print >> sys.stderr, "Ontology load time: %s" % (end_symbols - start_symbols)
 
 # vim:noexpandtab:ts=4:sw=4
@@ -0,0 +1,799 @@
+# -.- coding: utf-8 -.-
+
+# Zeitgeist
+#
+# Read-only access to the Zeitgeist activity database
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Query the activity database of the Zeitgeist engine directly, without
+going through D-Bus (and without needing a running engine).
+
+This is meant for offline reports and other bulk analysis of the whole
+log. The queries have the same semantics as those done through
+:class:`ZeitgeistClient <zeitgeist.client.ZeitgeistClient>` (they are
+translated to SQL the same way the engine's DbReader does), but the
+database is only ever opened read-only: events can't be inserted or
+deleted, and monitors aren't available.
+"""
+
+import os
+import sqlite3
+import urllib
+
+from zeitgeist.datamodel import (Event, Symbol, TimeRange,
+	StorageState, ResultType, NEGATION_OPERATOR, WILDCARD)
+
+__all__ = [
+	"LocalDatabase",
+	"TableLookup",
+	"get_database_path",
+]
+
+NOEXPAND_OPERATOR = "+"
+
+def get_database_path():
+	"""
+	Return the path of the activity database used by the Zeitgeist engine,
+	honouring the ZEITGEIST_DATABASE_PATH and ZEITGEIST_DATA_PATH
+	environment variables like the engine does.
+	"""
+	path = os.environ.get("ZEITGEIST_DATABASE_PATH")
+	if path:
+		return path
+	data_path = os.environ.get("ZEITGEIST_DATA_PATH")
+	if not data_path:
+		data_home = os.environ.get("XDG_DATA_HOME") or \
+			os.path.join(os.path.expanduser("~"), ".local", "share")
+		data_path = os.path.join(data_home, "zeitgeist")
+	return os.path.join(data_path, "activity.sqlite")
+
+def _connect_read_only(path):
+	if not os.path.exists(path):
+		raise IOError("No Zeitgeist database at %s" % path)
+	uri = "file:%s?mode=ro" % urllib.quote(os.path.abspath(path))
+	try:
+		connection = sqlite3.connect(uri, uri=True)
+	except TypeError:
+		# The sqlite3 module of Python 2 can't open URIs
+		connection = sqlite3.connect(path)
+	# Never write to the database, not even by accident. This doesn't
+	# prevent reading a database in WAL mode while the engine writes it.
+	connection.execute("PRAGMA query_only = 1")
+	connection.text_factory = str
+	return connection
+
+# Columns read from the event table by LocalDatabase.get_events()
+_EVENT_COLUMNS = ("id", "timestamp", "interpretation", "manifestation",
+	"actor", "payload", "origin", "subj_id", "subj_interpretation",
+	"subj_manifestation", "subj_origin", "subj_mimetype", "subj_text",
+	"subj_storage", "subj_id_current", "subj_origin_current")
+(_ID, _TIMESTAMP, _INTERPRETATION, _MANIFESTATION, _ACTOR, _PAYLOAD,
+	_ORIGIN, _SUBJECT_ID, _SUBJECT_INTERPRETATION, _SUBJECT_MANIFESTATION,
+	_SUBJECT_ORIGIN, _SUBJECT_MIMETYPE, _SUBJECT_TEXT, _SUBJECT_STORAGE,
+	_SUBJECT_ID_CURRENT, _SUBJECT_ORIGIN_CURRENT) = range(len(_EVENT_COLUMNS))
+
+# Maximum number of values looked up with a single query
+_MAX_QUERY_IDS = 500
+
+# Column to group by, and whether to sort by the number of events in each
+# group (None: don't count; False: most popular first; True: least popular
+# first), for each ResultType which returns one event per group
+_GROUPED_RESULT_TYPES = {
+	ResultType.MostRecentEventOrigin: ("origin", None),
+	ResultType.LeastRecentEventOrigin: ("origin", None),
+	ResultType.MostPopularEventOrigin: ("origin", False),
+	ResultType.LeastPopularEventOrigin: ("origin", True),
+	ResultType.MostRecentSubjects: ("subj_id", None),
+	ResultType.LeastRecentSubjects: ("subj_id", None),
+	ResultType.MostPopularSubjects: ("subj_id", False),
+	ResultType.LeastPopularSubjects: ("subj_id", True),
+	ResultType.MostRecentCurrentUri: ("subj_id_current", None),
+	ResultType.LeastRecentCurrentUri: ("subj_id_current", None),
+	ResultType.MostPopularCurrentUri: ("subj_id_current", False),
+	ResultType.LeastPopularCurrentUri: ("subj_id_current", True),
+	ResultType.MostRecentActor: ("actor", None),
+	ResultType.LeastRecentActor: ("actor", None),
+	ResultType.MostPopularActor: ("actor", False),
+	ResultType.LeastPopularActor: ("actor", True),
+	ResultType.OldestActor: ("actor", None),
+	ResultType.MostRecentOrigin: ("subj_origin", None),
+	ResultType.LeastRecentOrigin: ("subj_origin", None),
+	ResultType.MostPopularOrigin: ("subj_origin", False),
+	ResultType.LeastPopularOrigin: ("subj_origin", True),
+	ResultType.MostRecentCurrentOrigin: ("subj_origin_current", None),
+	ResultType.LeastRecentCurrentOrigin: ("subj_origin_current", None),
+	ResultType.MostPopularCurrentOrigin: ("subj_origin_current", False),
+	ResultType.LeastPopularCurrentOrigin: ("subj_origin_current", True),
+	ResultType.MostRecentSubjectInterpretation: ("subj_interpretation", None),
+	ResultType.LeastRecentSubjectInterpretation: ("subj_interpretation", None),
+	ResultType.MostPopularSubjectInterpretation: ("subj_interpretation", False),
+	ResultType.LeastPopularSubjectInterpretation: ("subj_interpretation", True),
+	ResultType.MostRecentMimeType: ("subj_mimetype", None),
+	ResultType.LeastRecentMimeType: ("subj_mimetype", None),
+	ResultType.MostPopularMimeType: ("subj_mimetype", False),
+	ResultType.LeastPopularMimeType: ("subj_mimetype", True),
+}
+
+_ASCENDING_RESULT_TYPES = frozenset((
+	ResultType.LeastRecentEvents,
+	ResultType.LeastRecentEventOrigin,
+	ResultType.LeastPopularEventOrigin,
+	ResultType.LeastRecentSubjects,
+	ResultType.LeastPopularSubjects,
+	ResultType.LeastRecentCurrentUri,
+	ResultType.LeastPopularCurrentUri,
+	ResultType.LeastRecentActor,
+	ResultType.LeastPopularActor,
+	ResultType.OldestActor,
+	ResultType.LeastRecentOrigin,
+	ResultType.LeastPopularOrigin,
+	ResultType.LeastRecentCurrentOrigin,
+	ResultType.LeastPopularCurrentOrigin,
+	ResultType.LeastRecentSubjectInterpretation,
+	ResultType.LeastPopularSubjectInterpretation,
+	ResultType.LeastRecentMimeType,
+	ResultType.LeastPopularMimeType,
+))
+
+def _get_right_boundary(text):
+	"""
+	Return the smallest string which is greater than all strings
+	starting with the given (UTF-8 encoded) `text`
+	"""
+	text = text.decode("utf-8")
+	while text:
+		last = ord(text[-1])
+		if last < 0x10ffff:
+			return (text[:-1] + unichr(last + 1)).encode("utf-8")
+		# The last character is the biggest possible one, look at the
+		# second last
+		text = text[:-1]
+	return unichr(0x10ffff).encode("utf-8")
+
+def _utf8(value):
+	if isinstance(value, unicode):
+		return value.encode("utf-8")
+	return str(value)
+
+class _WhereClause(object):
+	"""
+	The conditions of a SQL WHERE clause and their arguments, joined
+	with either AND or OR. Equivalent to the WhereClause class used by
+	the engine (where-clause.vala).
+	"""
+
+	AND = " AND "
+	OR = " OR "
+
+	# Table with the values of the ids in each column, for the columns
+	# used with add_text_condition_subquery and add_wildcard_condition
+	_SEARCH_TABLES = {
+		"origin": "uri",
+		"subj_origin": "uri",
+		"subj_origin_current": "uri",
+		"subj_id": "uri",
+		"subj_id_current": "uri",
+		"subj_mimetype": "mimetype",
+		"subj_text_id": "text",
+		"subj_storage_id": "storage",
+	}
+
+	def __init__(self, relation, negated=False):
+		self._relation = relation
+		self._negated = negated
+		self.conditions = []
+		self.arguments = []
+		# True as long as the conditions only use columns of the
+		# event table, so that event_view isn't needed
+		self.is_simple = True
+		# True if some condition is on a subject column, so that rows of
+		# the event table (one per subject) may match without the other
+		# subjects of their event
+		self.has_subject_condition = False
+
+	def __nonzero__(self):
+		return bool(self.conditions)
+
+	def add(self, condition, *arguments):
+		self.conditions.append(condition)
+		self.arguments.extend(arguments)
+
+	def _check_column(self, column):
+		if column.startswith("subj_"):
+			self.has_subject_condition = True
+
+	def add_match_condition(self, column, value, negated=False):
+		self.add("%s %s= %d" % (column, "!" if negated else "", value))
+		self._check_column(column)
+
+	def add_text_condition_subquery(self, column, value, negated=False):
+		self.add("%s %s= (SELECT id FROM %s WHERE value = ?)" % (column,
+			"!" if negated else "", self._SEARCH_TABLES.get(column, column)),
+			_utf8(value))
+		self.is_simple = False
+		self._check_column(column)
+
+	def add_wildcard_condition(self, column, prefix, negated=False):
+		table = self._SEARCH_TABLES.get(column, column)
+		if prefix:
+			# See "The LIKE optimization" in http://www.sqlite.org/optoverview.html
+			prefix = _utf8(prefix)
+			sql = "SELECT id FROM %s WHERE (value >= ? AND value < ?)" % table
+			arguments = (prefix, _get_right_boundary(prefix))
+		else:
+			sql = "SELECT id FROM %s" % table
+			arguments = ()
+		if not negated:
+			self.add("%s IN (%s)" % (column, sql), *arguments)
+		else:
+			self.add("(%s NOT IN (%s) OR %s is NULL)" % (column, sql, column),
+				*arguments)
+		self.is_simple = False
+		self._check_column(column)
+
+	def extend(self, clause):
+		if not clause:
+			return
+		self.add(clause.get_sql_conditions(), *clause.arguments)
+		self.is_simple = self.is_simple and clause.is_simple
+		self.has_subject_condition = self.has_subject_condition or \
+			clause.has_subject_condition
+
+	def has_non_timestamp_condition(self):
+		return any(not condition.startswith("timestamp")
+			for condition in self.conditions)
+
+	def get_sql_conditions(self):
+		negation = "NOT " if self._negated else ""
+		if len(self.conditions) == 1:
+			return negation + self.conditions[0]
+		return "%s(%s)" % (negation, self._relation.join(self.conditions))
+
+class TableLookup(object):
+	"""
+	In-memory copy of one of the tables of the database mapping ids to
+	values (like interpretation, actor or uri), equivalent to the
+	TableLookup class used by the engine (table-lookup.vala).
+	
+	Small tables are loaded completely when *preload* is True, and
+	:meth:`refresh` adds the values inserted since then (those with
+	a higher id). Other values are looked up when they are first
+	needed and then remembered.
+	"""
+
+	def __init__(self, connection, table, preload=True):
+		self._connection = connection
+		self._table = table
+		self._values = {}
+		self._ids = {}
+		self._max_id = 0
+		self._preload = preload
+		if preload:
+			self.refresh()
+
+	def _add(self, id, value):
+		self._values[id] = value
+		self._ids[value] = id
+
+	def refresh(self):
+		"""
+		Load the values added to the table since it was last loaded. Does
+		nothing if the table isn't preloaded.
+		"""
+		if not self._preload:
+			return
+		for id, value in self._connection.execute(
+			"SELECT id, value FROM %s WHERE id > ?" % self._table,
+			(self._max_id,)):
+			self._add(id, value)
+			self._max_id = max(self._max_id, id)
+
+	def id_try_string(self, value):
+		"""
+		Return the id of the given value, or -1 if it isn't in the table
+		"""
+		value = _utf8(value)
+		try:
+			return self._ids[value]
+		except KeyError:
+			pass
+		row = self._connection.execute(
+			"SELECT id FROM %s WHERE value = ?" % self._table,
+			(value,)).fetchone()
+		if row is None:
+			return -1
+		self._add(row[0], value)
+		return row[0]
+
+	def get_value(self, id):
+		"""
+		Return the value with the given id, or an empty string if there
+		is none
+		"""
+		if not id:
+			return ""
+		try:
+			return self._values[id]
+		except KeyError:
+			self.fetch((id,))
+			return self._values.get(id, "")
+
+	def fetch(self, ids):
+		"""
+		Look up the values of all the given ids which aren't known yet,
+		so that :meth:`get_value` doesn't need to query them one by one
+		"""
+		missing = [id for id in set(ids) if id and id not in self._values]
+		for start in xrange(0, len(missing), _MAX_QUERY_IDS):
+			for id, value in self._connection.execute(
+				"SELECT id, value FROM %s WHERE id IN (%s)" % (self._table,
+				",".join(map(str, missing[start:start + _MAX_QUERY_IDS])))):
+				self._add(id, value)
+
+def _parse_wildcard(value):
+	if value.endswith(WILDCARD):
+		return True, value[:-1]
+	return False, value
+
+def _parse_negation(value):
+	if value.startswith(NEGATION_OPERATOR):
+		return True, value[len(NEGATION_OPERATOR):]
+	return False, value
+
+def _parse_noexpand(value):
+	if value.startswith(NOEXPAND_OPERATOR):
+		return True, value[len(NOEXPAND_OPERATOR):]
+	return False, value
+
+def _assert_no_negation(field, value):
+	if value.startswith(NEGATION_OPERATOR):
+		raise ValueError("Field '%s' doesn't support negation" % field)
+
+def _assert_no_noexpand(field, value):
+	if value.startswith(NOEXPAND_OPERATOR):
+		raise ValueError("Field '%s' doesn't support the no-expand operator"
+			% field)
+
+def _assert_no_wildcard(field, value):
+	if value.endswith(WILDCARD):
+		raise ValueError("Field '%s' doesn't support prefix search" % field)
+
+class LocalDatabase(object):
+	"""
+	Read-only view of a Zeitgeist activity database.
+
+	The query methods take the same arguments as their counterparts in
+	:class:`ZeitgeistClient <zeitgeist.client.ZeitgeistClient>` (but
+	return their results instead of passing them to a callback), and
+	invalid arguments raise a :class:`ValueError`. The iter_* methods
+	stream the results from a database cursor, so that queries over the
+	whole log don't need to keep all of it in memory.
+
+	*path* defaults to the database used by the engine, see
+	:func:`get_database_path`. The engine may keep running (and writing
+	to the database) while it is being read.
+
+	Example usage::
+
+	    with LocalDatabase() as db:
+	        for event in db.iter_events(TimeRange.from_seconds_ago(86400)):
+	            print event.actor
+	"""
+
+	def __init__(self, path=None):
+		self._path = path or get_database_path()
+		self._connection = _connect_read_only(self._path)
+		self._interpretations = TableLookup(self._connection,
+			"interpretation")
+		self._manifestations = TableLookup(self._connection, "manifestation")
+		self._mimetypes = TableLookup(self._connection, "mimetype")
+		self._actors = TableLookup(self._connection, "actor")
+		# These are too big to load completely
+		self._uris = TableLookup(self._connection, "uri", False)
+		self._texts = TableLookup(self._connection, "text", False)
+		self._storages = TableLookup(self._connection, "storage", False)
+
+	def get_path(self):
+		return self._path
+	path = property(get_path, doc="Path of the database file")
+
+	def close(self):
+		self._connection.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def get_events(self, event_ids):
+		"""
+		Return a list with the :class:`Event <zeitgeist.datamodel.Event>`
+		for each of the given ids, with None for the ids which aren't in
+		the log
+		"""
+		if not event_ids:
+			return []
+		# Read the ids from the event table instead of going through
+		# event_view, which looks up every value with a subquery
+		rows = self._connection.execute(
+			"SELECT %s FROM event WHERE id IN (%s)" % (
+			", ".join(_EVENT_COLUMNS),
+			",".join(str(int(event_id)) for event_id in event_ids))).fetchall()
+		events = dict((event.id, event) for event in self._decode_rows(rows))
+		return [events.get(int(event_id)) for event_id in event_ids]
+
+	def _decode_rows(self, rows):
+		"""
+		Return the events in the given rows of the event table, in the
+		order they first appear
+		"""
+		self._uris.fetch(id for row in rows for id in (row[_ORIGIN],
+			row[_SUBJECT_ID], row[_SUBJECT_ORIGIN], row[_SUBJECT_ID_CURRENT],
+			row[_SUBJECT_ORIGIN_CURRENT]))
+		self._texts.fetch(row[_SUBJECT_TEXT] for row in rows)
+		self._storages.fetch(row[_SUBJECT_STORAGE] for row in rows)
+		payloads = self._get_payloads(set(row[_PAYLOAD] for row in rows
+			if row[_PAYLOAD]))
+		
+		structs = {}
+		order = []
+		for row in rows:
+			event_id = row[_ID]
+			struct = structs.get(event_id)
+			if struct is None:
+				struct = structs[event_id] = self._get_event_from_row(row,
+					payloads)
+				order.append(struct)
+			struct[1].append(self._get_subject_from_row(row))
+		return map(Event.new_for_raw_struct, order)
+
+	def _get_payloads(self, ids):
+		payloads = {}
+		ids = list(ids)
+		for start in xrange(0, len(ids), _MAX_QUERY_IDS):
+			for id, value in self._connection.execute(
+				"SELECT id, value FROM payload WHERE id IN (%s)" % ",".join(
+				map(str, ids[start:start + _MAX_QUERY_IDS]))):
+				payloads[id] = str(value) if value is not None else ""
+		return payloads
+
+	def _get_event_from_row(self, row, payloads):
+		return [[
+			str(row[_ID]),
+			str(row[_TIMESTAMP]),
+			self._interpretations.get_value(row[_INTERPRETATION]),
+			self._manifestations.get_value(row[_MANIFESTATION]),
+			self._actors.get_value(row[_ACTOR]),
+			self._uris.get_value(row[_ORIGIN]),
+		], [], payloads.get(row[_PAYLOAD], "")]
+
+	def _get_subject_from_row(self, row):
+		uris = self._uris
+		return [
+			uris.get_value(row[_SUBJECT_ID]),
+			self._interpretations.get_value(row[_SUBJECT_INTERPRETATION]),
+			self._manifestations.get_value(row[_SUBJECT_MANIFESTATION]),
+			uris.get_value(row[_SUBJECT_ORIGIN]),
+			self._mimetypes.get_value(row[_SUBJECT_MIMETYPE]),
+			self._texts.get_value(row[_SUBJECT_TEXT]),
+			self._storages.get_value(row[_SUBJECT_STORAGE]),
+			uris.get_value(row[_SUBJECT_ID_CURRENT]),
+			uris.get_value(row[_SUBJECT_ORIGIN_CURRENT]),
+		]
+
+	def iter_event_ids(self, time_range=None, event_templates=[],
+		storage_state=StorageState.Any, num_events=0,
+		result_type=ResultType.MostRecentEvents):
+		"""
+		Like :meth:`find_event_ids`, but returns an iterator
+		"""
+		where = self._get_where_clause_for_query(time_range,
+			event_templates, storage_state)
+		cursor = self._connection.execute(
+			self._get_sql_for_clause(where, result_type), where.arguments)
+		last_id = None
+		count = 0
+		for row in cursor:
+			event_id = row[0]
+			# Events are supposed to be contiguous in the database
+			if event_id != last_id:
+				yield event_id
+				last_id = event_id
+				count += 1
+				if count == num_events:
+					break
+		cursor.close()
+
+	def find_event_ids(self, time_range=None, event_templates=[],
+		storage_state=StorageState.Any, num_events=0,
+		result_type=ResultType.MostRecentEvents):
+		"""
+		Return the ids of the events matching any of the given
+		templates, see :meth:`ZeitgeistClient.find_event_ids_for_templates
+		<zeitgeist.client.ZeitgeistClient.find_event_ids_for_templates>`.
+		*time_range* defaults to :meth:`TimeRange.always
+		<zeitgeist.datamodel.TimeRange.always>` and *num_events* 0
+		means no limit.
+		"""
+		return list(self.iter_event_ids(time_range, event_templates,
+			storage_state, num_events, result_type))
+
+	def iter_events(self, time_range=None, event_templates=[],
+		storage_state=StorageState.Any, num_events=0,
+		result_type=ResultType.MostRecentEvents, batch_size=500):
+		"""
+		Like :meth:`find_events`, but returns an iterator. The events
+		are read *batch_size* at a time.
+		"""
+		if result_type in (ResultType.MostRecentEvents,
+			ResultType.LeastRecentEvents):
+			where = self._get_where_clause_for_query(time_range,
+				event_templates, storage_state)
+			if where.is_simple and not where.has_subject_condition:
+				return self._scan_events(where, num_events, result_type,
+					batch_size)
+		return self._iter_events(time_range, event_templates,
+			storage_state, num_events, result_type, batch_size)
+
+	def _scan_events(self, where, num_events, result_type, batch_size):
+		# The conditions only use columns of the event table, and none
+		# of the subject columns, so all rows of the matching events can
+		# be read in a single pass
+		sql = "SELECT %s FROM event " % ", ".join(_EVENT_COLUMNS)
+		if where:
+			sql += "WHERE " + where.get_sql_conditions()
+		# Sort by id too, so that the rows of each event are together
+		sql += " ORDER BY timestamp %s, id" % ("ASC"
+			if result_type == ResultType.LeastRecentEvents else "DESC")
+		cursor = self._connection.execute(sql, where.arguments)
+		rows = []
+		last_id = None
+		count = 0
+		for row in cursor:
+			if row[_ID] != last_id:
+				if num_events and count == num_events:
+					break
+				if count % batch_size == 0 and rows:
+					for event in self._decode_rows(rows):
+						yield event
+					rows = []
+				last_id = row[_ID]
+				count += 1
+			rows.append(row)
+		cursor.close()
+		for event in self._decode_rows(rows):
+			yield event
+
+	def _iter_events(self, time_range, event_templates, storage_state,
+		num_events, result_type, batch_size):
+		event_ids = self.iter_event_ids(time_range, event_templates,
+			storage_state, num_events, result_type)
+		while True:
+			batch = []
+			for event_id in event_ids:
+				batch.append(event_id)
+				if len(batch) == batch_size:
+					break
+			if not batch:
+				return
+			for event in self.get_events(batch):
+				if event is not None:
+					yield event
+
+	def find_events(self, time_range=None, event_templates=[],
+		storage_state=StorageState.Any, num_events=0,
+		result_type=ResultType.MostRecentEvents):
+		"""
+		Return the events matching any of the given templates, see
+		:meth:`find_event_ids`
+		"""
+		return self.get_events(self.find_event_ids(time_range,
+			event_templates, storage_state, num_events, result_type))
+
+	def _get_sql_for_clause(self, where, result_type):
+		if result_type in (ResultType.MostRecentEvents,
+			ResultType.LeastRecentEvents):
+			sql = "SELECT id FROM event_view "
+			if where:
+				sql += "WHERE " + where.get_sql_conditions()
+			sql += " ORDER BY "
+		elif result_type in _GROUPED_RESULT_TYPES:
+			field, count_asc = _GROUPED_RESULT_TYPES[result_type]
+			aggregation = "min" if result_type == ResultType.OldestActor \
+				else "max"
+			sql = self._group_and_sort(field, where, count_asc, aggregation)
+		else:
+			raise ValueError("Invalid ResultType %r" % result_type)
+		sql += " timestamp %s" % ("ASC"
+			if result_type in _ASCENDING_RESULT_TYPES else "DESC")
+		if where.is_simple:
+			sql = sql.replace("FROM event_view", "FROM event")
+		return sql
+
+	def _group_and_sort(self, field, where, count_asc, aggregation):
+		where_sql = where.get_sql_conditions() if where else "1"
+		if count_asc is not None:
+			aggregation_sql = ", COUNT(%s) AS num_events" % field
+			order_sql = "num_events %s," % ("ASC" if count_asc else "DESC")
+		else:
+			aggregation_sql = order_sql = ""
+		if count_asc is not None or not where.has_non_timestamp_condition():
+			return """
+				SELECT id FROM event
+				NATURAL JOIN (
+					SELECT %s,
+					%s(timestamp) AS timestamp
+					%s
+					FROM event_view WHERE %s
+					GROUP BY %s)
+				GROUP BY %s
+				ORDER BY %s
+				""" % (field, aggregation, aggregation_sql, where_sql, field,
+					field, order_sql)
+		return """
+			SELECT id, %s(timestamp) AS timestamp
+				FROM event_view WHERE %s AND %s IS NOT NULL
+			GROUP BY %s
+			ORDER BY
+			""" % (aggregation, where_sql, field, field)
+
+	def refresh(self):
+		"""
+		Load the interpretations, manifestations, mimetypes and actors
+		added to the database since it was opened (or last refreshed).
+		This is done automatically before each query.
+		"""
+		for table in (self._interpretations, self._manifestations,
+			self._mimetypes, self._actors):
+			table.refresh()
+
+	def _get_where_clause_for_query(self, time_range, event_templates,
+		storage_state):
+		self.refresh()
+		where = _WhereClause(_WhereClause.AND)
+		if time_range is None:
+			time_range = TimeRange.always()
+		if time_range[0] != 0:
+			where.add("timestamp >= %d" % time_range[0])
+		if time_range[1] != 0:
+			where.add("timestamp <= %d" % time_range[1])
+
+		if storage_state in (StorageState.Available,
+			StorageState.NotAvailable):
+			where.add("(subj_storage_state=? OR subj_storage_state IS NULL)",
+				int(storage_state))
+			where.is_simple = False
+		elif storage_state != StorageState.Any:
+			raise ValueError("Unknown storage state '%s'" % storage_state)
+
+		templates = _WhereClause(_WhereClause.OR)
+		for template in event_templates:
+			templates.extend(self._get_where_clause_for_template(template))
+		where.extend(templates)
+		return where
+
+	def _get_where_clause_for_symbol(self, column, symbol, table):
+		negated, symbol = _parse_negation(symbol)
+		noexpand, symbol = _parse_noexpand(symbol)
+		if noexpand:
+			symbols = [symbol]
+		else:
+			symbols = Symbol.find_child_uris_extended(symbol)
+		where = _WhereClause(_WhereClause.OR, negated)
+		if len(symbols) == 1:
+			where.add_match_condition(column, table.id_try_string(symbol))
+		else:
+			where.add("(%s)" % " OR ".join("%s = %d" % (column,
+				table.id_try_string(uri)) for uri in symbols))
+			where._check_column(column)
+		return where
+
+	def _add_uri_condition(self, where, column, field, value):
+		wildcard, value = _parse_wildcard(value)
+		negated, value = _parse_negation(value)
+		_assert_no_noexpand(field, value)
+		if wildcard:
+			where.add_wildcard_condition(column, value, negated)
+		else:
+			where.add_text_condition_subquery(column, value, negated)
+
+	def _get_where_clause_for_template(self, template):
+		where = _WhereClause(_WhereClause.AND)
+
+		if template.id:
+			where.add("id=?", template.id)
+
+		if template.interpretation:
+			_assert_no_wildcard("interpretation", template.interpretation)
+			where.extend(self._get_where_clause_for_symbol("interpretation",
+				template.interpretation, self._interpretations))
+
+		if template.manifestation:
+			_assert_no_wildcard("manifestation", template.manifestation)
+			where.extend(self._get_where_clause_for_symbol("manifestation",
+				template.manifestation, self._manifestations))
+
+		if template.actor:
+			wildcard, value = _parse_wildcard(template.actor)
+			negated, value = _parse_negation(value)
+			if wildcard:
+				where.add_wildcard_condition("actor", value, negated)
+			else:
+				where.add_match_condition("actor",
+					self._actors.id_try_string(value), negated)
+
+		if template.origin:
+			self._add_uri_condition(where, "origin", "origin",
+				template.origin)
+
+		# Subject templates within the same event template are AND'd
+		for subject in template.subjects:
+			if subject.interpretation:
+				_assert_no_wildcard("subject interpretation",
+					subject.interpretation)
+				where.extend(self._get_where_clause_for_symbol(
+					"subj_interpretation", subject.interpretation,
+					self._interpretations))
+
+			if subject.manifestation:
+				_assert_no_wildcard("subject manifestation",
+					subject.manifestation)
+				where.extend(self._get_where_clause_for_symbol(
+					"subj_manifestation", subject.manifestation,
+					self._manifestations))
+
+			if subject.mimetype:
+				wildcard, value = _parse_wildcard(subject.mimetype)
+				negated, value = _parse_negation(value)
+				_assert_no_noexpand("mime-type", value)
+				if wildcard:
+					where.add_wildcard_condition("subj_mimetype", value,
+						negated)
+				else:
+					where.add_match_condition("subj_mimetype",
+						self._mimetypes.id_try_string(value), negated)
+
+			if subject.uri:
+				self._add_uri_condition(where, "subj_id", "uri", subject.uri)
+
+			if subject.origin:
+				self._add_uri_condition(where, "subj_origin",
+					"subject origin", subject.origin)
+
+			if subject.text:
+				# Negation, noexpand and prefix search aren't supported
+				# for subject texts, but "!", "+" and "*" are valid as
+				# plain text characters.
+				where.add_text_condition_subquery("subj_text_id",
+					subject.text)
+
+			if subject.current_uri:
+				self._add_uri_condition(where, "subj_id_current",
+					"current_uri", subject.current_uri)
+
+			if subject.current_origin:
+				self._add_uri_condition(where, "subj_origin_current",
+					"current_origin", subject.current_origin)
+
+			if subject.storage:
+				_assert_no_negation("subject storage", subject.storage)
+				_assert_no_wildcard("subject storage", subject.storage)
+				_assert_no_noexpand("subject storage", subject.storage)
+				where.add_text_condition_subquery("subj_storage_id",
+					subject.storage)
+
+		return where
@@ -21,11 +21,17 @@
 
 import re
 
-from datamodel import Interpretation, Manifestation
+from datamodel import Interpretation, Manifestation, Subject
 
 __all__ = [
     "get_interpretation_for_mimetype",
     "get_manifestation_for_uri",
+    "get_interpretations_for_mimetypes",
+    "get_manifestations_for_uris",
+    "get_origin_for_uri",
+    "classify_subjects",
+    "Classifier",
+    "SubjectClassifier",
 ]
 
 class RegExpr(object):
@@ -46,26 +52,207 @@ class RegExpr(object):
 def make_regex_tuple(*items):
     return tuple((RegExpr(k), v) for k, v in items)
 
+class Classifier(object):
+    """ Looks up interpretations for mimetypes and manifestations for
+    uris, like :func:`get_interpretation_for_mimetype` and
+    :func:`get_manifestation_for_uri` do with the default tables.
+    
+    The regular expressions are compiled into a single alternation
+    which is tried at once, and the schemes are looked up in a
+    dictionary. The results of the regular expression fallback are
+    remembered for at most `cache_size` mimetypes.
+    
+    The `mimes` dictionary is used as is, so changes to it take effect
+    right away, but the patterns and schemes are only read when the
+    classifier is created. The module functions use a classifier for
+    :data:`MIMES`, :data:`MIMES_REGEX` and :data:`SCHEMES`, which is
+    created again when any of them is replaced.
+    """
+    
+    def __init__(self, mimes, mimes_regex, schemes, cache_size=1024):
+        self._mimes = mimes
+        self._regex_results = [interpretation
+            for pattern, interpretation in mimes_regex]
+        # re.match() tries the alternatives in order, so the first
+        # matching pattern wins, as in a linear scan
+        self._regex = re.compile("|".join("(?P<_%d>%s)" % (i, pattern)
+            for i, (pattern, interpretation) in enumerate(mimes_regex)))
+        self._cache = {}
+        self._cache_size = cache_size
+        self._schemes = {}
+        # Schemes which don't end in "://" need a linear scan
+        self._other_schemes = []
+        for scheme, manifestation in schemes:
+            if scheme.endswith("://") and scheme.find("://") == len(scheme) - 3:
+                self._schemes.setdefault(scheme, manifestation)
+            else:
+                self._other_schemes.append((scheme, manifestation))
+    
+    def get_interpretation(self, mimetype):
+        interpretation = self._mimes.get(mimetype, None)
+        if interpretation is not None:
+            return interpretation
+        try:
+            return self._cache[mimetype]
+        except KeyError:
+            pass
+        match = self._regex.match(mimetype)
+        if match is not None:
+            interpretation = self._regex_results[int(match.lastgroup[1:])]
+        if len(self._cache) >= self._cache_size:
+            self._cache.clear()
+        self._cache[mimetype] = interpretation
+        return interpretation
+    
+    def get_manifestation(self, uri):
+        end = uri.find("://")
+        if end != -1:
+            manifestation = self._schemes.get(uri[:end + 3], None)
+            if manifestation is not None:
+                return manifestation
+        for scheme, manifestation in self._other_schemes:
+            if uri.startswith(scheme):
+                return manifestation
+        return None
+    
+    def get_interpretations(self, mimetypes):
+        """ Return a list with the interpretation for each mimetype """
+        get_interpretation = self.get_interpretation
+        return [get_interpretation(mimetype) for mimetype in mimetypes]
+    
+    def get_manifestations(self, uris):
+        """ Return a list with the manifestation for each uri """
+        get_manifestation = self.get_manifestation
+        return [get_manifestation(uri) for uri in uris]
+    
+    def classify_subjects(self, subjects):
+        """ Return a list with an (interpretation, manifestation) tuple
+        for each :class:`Subject <zeitgeist.datamodel.Subject>`, based
+        on its mimetype and uri
+        """
+        get_interpretation = self.get_interpretation
+        get_manifestation = self.get_manifestation
+        return [(get_interpretation(subject.mimetype),
+            get_manifestation(subject.uri)) for subject in subjects]
+
+
+class SubjectClassifier(object):
+    """ Fills in the interpretation, manifestation and origin of the
+    subjects which have them empty, based on their mimetype and uri.
+    
+    Mimetypes and uri schemes repeated within a batch are only looked
+    up once, and the :class:`Classifier` (the default one unless given)
+    remembers its results across batches. The origin of a subject is
+    taken to be the parent of its uri; pass `fill_origin=False` to
+    leave it alone.
+    """
+    
+    def __init__(self, classifier=None, fill_origin=True):
+        self._classifier = classifier
+        self.fill_origin = fill_origin
+    
+    def enrich_subjects(self, subjects):
+        """ Fill in the empty fields of the given subjects, in place.
+        Returns the number of subjects which were changed.
+        """
+        classifier = self._classifier or _get_classifier()
+        interpretations = {}
+        manifestations = {}
+        fill_origin = self.fill_origin
+        changed = 0
+        for subject in subjects:
+            uri = subject[Subject.Uri]
+            modified = False
+            if not subject[Subject.Interpretation]:
+                mimetype = subject[Subject.Mimetype]
+                try:
+                    interpretation = interpretations[mimetype]
+                except KeyError:
+                    interpretation = interpretations[mimetype] = \
+                        classifier.get_interpretation(mimetype) \
+                        if mimetype else None
+                if interpretation is not None:
+                    subject[Subject.Interpretation] = interpretation
+                    modified = True
+            if not subject[Subject.Manifestation]:
+                end = uri.find("://")
+                scheme = uri[:end + 3] if end != -1 else uri
+                try:
+                    manifestation = manifestations[scheme]
+                except KeyError:
+                    manifestation = manifestations[scheme] = \
+                        classifier.get_manifestation(uri)
+                if manifestation is not None:
+                    subject[Subject.Manifestation] = manifestation
+                    modified = True
+            if fill_origin and not subject[Subject.Origin]:
+                origin = get_origin_for_uri(uri)
+                if origin is not None:
+                    subject[Subject.Origin] = origin
+                    modified = True
+            changed += modified
+        return changed
+    
+    def enrich_events(self, events):
+        """ Fill in the empty fields of the subjects of all events, see
+        :meth:`enrich_subjects`
+        """
+        return self.enrich_subjects(subject for event in events
+            for subject in event.subjects)
+
+
+def _get_classifier():
+    """ Return the classifier for the current module tables """
+    global _classifier, _classifier_tables
+    if _classifier is None or _classifier_tables[0] is not MIMES or \
+        _classifier_tables[1] is not MIMES_REGEX or \
+        _classifier_tables[2] is not SCHEMES:
+        _classifier = Classifier(MIMES, MIMES_REGEX, SCHEMES)
+        _classifier_tables = (MIMES, MIMES_REGEX, SCHEMES)
+    return _classifier
+
 def get_interpretation_for_mimetype(mimetype):
     """ get interpretation for a given mimetype, returns :const:`None`
     if none of the predefined interpretations matches
     """
-    interpretation = MIMES.get(mimetype, None)
-    if interpretation is not None:
-        return interpretation
-    for pattern, interpretation in MIMES_REGEX:
-        if pattern.match(mimetype):
-            return interpretation
-    return None
+    return _get_classifier().get_interpretation(mimetype)
     
 def get_manifestation_for_uri(uri):
     """ Lookup Manifestation for a given uri based on the scheme part,
     returns :const:`None` if no suitable manifestation is found
     """
-    for scheme, manifestation in SCHEMES:
-        if uri.startswith(scheme):
-            return manifestation
-    return None
+    return _get_classifier().get_manifestation(uri)
+
+def get_interpretations_for_mimetypes(mimetypes):
+    """ Bulk version of :func:`get_interpretation_for_mimetype` """
+    return _get_classifier().get_interpretations(mimetypes)
+
+def get_manifestations_for_uris(uris):
+    """ Bulk version of :func:`get_manifestation_for_uri` """
+    return _get_classifier().get_manifestations(uris)
+
+def get_origin_for_uri(uri):
+    """ Return the uri of the parent of the given uri, or :const:`None`
+    if it has no scheme or no parent
+    """
+    start = uri.find("://")
+    if start == -1:
+        return None
+    path = uri.rstrip("/")
+    end = path.rfind("/")
+    if end <= start + 2:
+        return None
+    if end == start + 3:
+        # The parent is the root, as in file:///foo
+        return path[:end + 1]
+    return path[:end]
+
+def classify_subjects(subjects):
+    """ Return a list with the (interpretation, manifestation) tuples
+    for the mimetypes and uris of the given subjects, see
+    :meth:`Classifier.classify_subjects`
+    """
+    return _get_classifier().classify_subjects(subjects)
     
     
 MIMES = {
@@ -250,4 +437,8 @@ SCHEMES = tuple((
     ("smb://", Manifestation.REMOTE_DATA_OBJECT),
 ))
 
+# Created by _get_classifier(), along with the tables it was created for
+_classifier = None
+_classifier_tables = None
+
 # vim:noexpandtab:ts=4:sw=4
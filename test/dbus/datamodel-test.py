@@ -0,0 +1,674 @@
+#! /usr/bin/env python
+# -.- coding: utf-8 -.-
+
+# datamodel-test.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+import subprocess
+
+import testutils
+from testutils import parse_events
+
+from zeitgeist.datamodel import (Symbol, Event, Subject, Interpretation, Manifestation,
+	TimeRange, TimeRangeSet, CompactEvent, CompactSubject, EventBatch, StringPool,
+	get_string_pool, compile_templates, TemplateIndex, NULL_EVENT)
+from zeitgeist import mimetypes
+
+class SymbolTest(unittest.TestCase):
+
+	def runPython(self, *lines):
+		env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+		return subprocess.Popen([sys.executable, "-c", "\n".join(lines)],
+			stdout=subprocess.PIPE, env=env).communicate()[0].strip()
+
+	def testLazyLoading(self):
+		output = self.runPython(
+			"import zeitgeist.datamodel as datamodel",
+			"assert not datamodel._ontology_loaded",
+			"print datamodel.Interpretation.AUDIO.display_name",
+			"assert datamodel._ontology_loaded")
+		self.assertEquals(Interpretation.AUDIO.display_name, output)
+
+	def testSnapshot(self):
+		import zeitgeist.datamodel as datamodel
+		if not os.path.exists(datamodel.ontology_snapshot_file):
+			return
+		# Both ways of loading the ontology need to give the same result
+		code = [
+			"import zeitgeist.datamodel as datamodel",
+			"datamodel.Interpretation.get_children()",
+			"symbols = sorted(set(datamodel._SYMBOLS_BY_URI.values()))",
+			"print [(s.uri, s.name, s.display_name, s.doc,",
+			"	sorted(s.get_parents()), sorted(s.get_children()),",
+			"	[s.is_child_of(p) for p in symbols]) for s in symbols]",
+		]
+		self.assertEquals(self.runPython(*code), self.runPython(
+			"import zeitgeist.datamodel as datamodel",
+			"datamodel._load_ontology_snapshot = lambda: None", *code))
+
+	def testLoadingError(self):
+		# A failed load is retried on the next lookup
+		code = [
+			"import zeitgeist.datamodel as datamodel",
+			"load_snapshot = datamodel._load_ontology_snapshot",
+			"def failing_load():",
+			"	load_snapshot()",
+			"	raise RuntimeError()",
+			"datamodel._load_ontology_snapshot = failing_load",
+			"try:",
+			"	datamodel.Interpretation.AUDIO",
+			"except RuntimeError:",
+			"	pass",
+			"assert not datamodel._ontology_loaded",
+			"datamodel._load_ontology_snapshot = load_snapshot",
+			"print datamodel.Interpretation.AUDIO.display_name,",
+			"print len(datamodel.Interpretation.get_children())",
+		]
+		self.assertEquals(self.runPython(*code), self.runPython(
+			"import zeitgeist.datamodel as datamodel",
+			"print datamodel.Interpretation.AUDIO.display_name,",
+			"print len(datamodel.Interpretation.get_children())"))
+
+	def testConcurrentLoading(self):
+		output = self.runPython(
+			"import threading",
+			"import zeitgeist.datamodel as datamodel",
+			"results = []",
+			"def lookup():",
+			"	results.append(len(datamodel.Interpretation.get_all_children()))",
+			"threads = [threading.Thread(target=lookup) for i in range(8)]",
+			"for thread in threads: thread.start()",
+			"for thread in threads: thread.join()",
+			"print sorted(set(results))")
+		self.assertEquals(str([len(Interpretation.get_all_children())]),
+			output)
+
+	def testIsChildOf(self):
+		self.assertTrue(Interpretation.AUDIO.is_child_of(Interpretation.MEDIA))
+		self.assertTrue(Interpretation.AUDIO.is_child_of(Interpretation.AUDIO))
+		self.assertTrue(Interpretation.AUDIO.is_child_of(Interpretation))
+		self.assertFalse(Interpretation.MEDIA.is_child_of(Interpretation.AUDIO))
+		self.assertFalse(Interpretation.AUDIO.is_child_of(Manifestation))
+		self.assertTrue(Manifestation.FILE_DATA_OBJECT.is_child_of(
+			Manifestation.FILE_DATA_OBJECT.uri))
+		self.assertFalse(Interpretation.AUDIO.is_child_of("stfu:Unknown"))
+
+	def testAllSymbols(self):
+		symbols = set(Interpretation.get_all_children()) | \
+			set(Manifestation.get_all_children())
+		for parent in symbols:
+			children = set(child.uri for child in parent.get_all_children())
+			for child in symbols:
+				self.assertEquals(
+					child.uri == parent.uri or child.uri in children,
+					Symbol.uri_is_child_of(str(child.uri), str(parent.uri)))
+
+	def testUriIsChildOf(self):
+		self.assertTrue(Symbol.uri_is_child_of(Interpretation.AUDIO.uri,
+			Interpretation.MEDIA))
+		self.assertTrue(Symbol.uri_is_child_of("stfu:Unknown", "stfu:Unknown"))
+		self.assertFalse(Symbol.uri_is_child_of("stfu:Unknown",
+			Interpretation.MEDIA))
+		self.assertFalse(Symbol.uri_is_child_of(Interpretation.AUDIO.uri,
+			"stfu:Unknown"))
+
+class CompactEventTest(unittest.TestCase):
+	"""
+	Those tests don't need a running Zeitgeist daemon.
+	"""
+
+	def setUp(self):
+		self.events = parse_events("test/data/five_events.js")
+
+	def testProperties(self):
+		for event in self.events:
+			compact = CompactEvent(event)
+			self.assertEquals(compact.id, event.id)
+			self.assertEquals(compact.timestamp, event.timestamp)
+			self.assertEquals(compact.interpretation, event.interpretation)
+			self.assertEquals(compact.manifestation, event.manifestation)
+			self.assertEquals(compact.actor, event.actor)
+			self.assertEquals(compact.origin, event.origin)
+			self.assertEquals(compact.payload, event.payload)
+			self.assertEquals(len(compact.subjects), len(event.subjects))
+			for csubj, subj in zip(compact.subjects, event.subjects):
+				self.assertTrue(isinstance(csubj, CompactSubject))
+				self.assertEquals(csubj.uri, subj.uri)
+				self.assertEquals(csubj.mimetype, subj.mimetype)
+				self.assertEquals(csubj.text, subj.text)
+
+	def testRoundTrip(self):
+		for event in self.events:
+			self.assertEquals(CompactEvent(event).to_event(), event)
+
+	def testStructLayout(self):
+		# The D-Bus marshalling relies on this layout
+		compact = CompactEvent(self.events[0])
+		self.assertTrue(isinstance(compact, tuple))
+		self.assertEquals(3, len(compact))
+		self.assertEquals(len(Event.Fields), len(compact[0]))
+		self.assertTrue(isinstance(compact[1], tuple))
+
+	def testOldSubjectLayout(self):
+		subj = CompactSubject(["file:///tmp/a", "", "", "", "", "", ""])
+		self.assertEquals(len(Subject.Fields), len(subj))
+		self.assertEquals("", subj.current_uri)
+		self.assertRaises(ValueError, CompactSubject, ["file:///tmp/a"])
+
+	def testNullEvent(self):
+		self.assertEquals(None, CompactEvent.new_for_struct(NULL_EVENT))
+
+	def testMatchesTemplate(self):
+		templates = [
+			Event.new_for_values(interpretation="stfu:OpenEvent"),
+			Event.new_for_values(actor="!firefox*"),
+			Event.new_for_values(subject_uri="file:///tmp/*"),
+			Event.new_for_values(subject_mimetype="!text/plain"),
+			Event.new_for_values(
+				subject_interpretation=Interpretation.DOCUMENT),
+		]
+		for event in self.events:
+			compact = CompactEvent(event)
+			for template in templates:
+				self.assertEquals(compact.matches_template(template),
+					event.matches_template(template))
+				self.assertEquals(
+					compact.matches_template(CompactEvent(template)),
+					event.matches_template(template))
+
+class RawStructTest(unittest.TestCase):
+
+	def setUp(self):
+		self.events = parse_events("test/data/five_events.js")
+
+	def getStruct(self, event):
+		return [list(event[0]), map(list, event[1]), event[2]]
+
+	def testNewForRawStruct(self):
+		for event in self.events:
+			raw = Event.new_for_raw_struct(self.getStruct(event))
+			self.assertEquals(raw, event)
+			self.assertEquals(raw.id, event.id)
+			self.assertEquals(raw.actor, event.actor)
+			for subject in raw.subjects:
+				self.assertTrue(isinstance(subject, Subject))
+		self.assertEquals(None, Event.new_for_raw_struct(NULL_EVENT))
+
+	def testRawSubjects(self):
+		event = self.events[0]
+		raw = Event.new_for_raw_struct(self.getStruct(event))
+		self.assertEquals(event.subjects, raw.subjects)
+		self.assertTrue(isinstance(list.__getitem__(raw[1], 0), Subject))
+
+	def testListOperations(self):
+		struct = self.getStruct(self.events[0])
+		for operation in (lambda subjects: subjects + [],
+			lambda subjects: [] + subjects, lambda subjects: subjects * 2,
+			lambda subjects: 2 * subjects, reversed):
+			subjects = Event.new_for_raw_struct(struct).subjects
+			for subject in operation(subjects):
+				self.assertTrue(isinstance(subject, Subject))
+		subjects = Event.new_for_raw_struct(struct).subjects
+		subjects += [Subject()]
+		for subject in list.__iter__(subjects):
+			self.assertTrue(isinstance(subject, Subject))
+
+	def testSubclass(self):
+		class MyEvent(Event):
+			def __init__(self, struct=None):
+				super(MyEvent, self).__init__(struct)
+				self.initialized = True
+		raw = MyEvent.new_for_raw_struct(self.getStruct(self.events[0]))
+		self.assertTrue(raw.initialized)
+		self.assertEquals(self.events[0], raw)
+
+	def testMatchesTemplate(self):
+		templates = [
+			Event.new_for_values(subject_uri="file:///tmp/*"),
+			Event.new_for_values(subject_mimetype="!text/plain"),
+		]
+		for event in self.events:
+			for template in templates:
+				raw = Event.new_for_raw_struct(self.getStruct(event))
+				self.assertEquals(raw.matches_template(template),
+					event.matches_template(template))
+
+	def testCopy(self):
+		raw = Event.new_for_raw_struct(self.getStruct(self.events[0]))
+		copy = Event(raw)
+		self.assertEquals(copy, self.events[0])
+		self.assertTrue(isinstance(copy.subjects[0], Subject))
+
+class TimeRangeSetTest(unittest.TestCase):
+
+	def setUp(self):
+		self.ranges = TimeRangeSet([(50, 60), TimeRange(10, 20), (15, 30),
+			(31, 40), (70, 69)])
+
+	def testNormalize(self):
+		self.assertEquals([TimeRange(10, 40), TimeRange(50, 60)],
+			list(self.ranges))
+		self.assertEquals([(10, 40), (50, 60)], self.ranges.to_dbus())
+		self.assertEquals(TimeRange(10, 60), self.ranges.get_bounds())
+		self.assertEquals(None, TimeRangeSet().get_bounds())
+
+	def testEquality(self):
+		self.assertTrue(self.ranges == [(50, 60), (10, 40)])
+		self.assertFalse(self.ranges != [(50, 60), (10, 40)])
+		self.assertTrue(self.ranges != [(10, 60)])
+		self.assertEquals(TimeRangeSet(), [])
+		self.assertEquals(hash(TimeRangeSet(self.ranges)), hash(self.ranges))
+
+	def testCompareToOtherTypes(self):
+		for other in (None, 42, "ab", [1, 2], [("a", "b")], object()):
+			self.assertFalse(self.ranges == other)
+			self.assertTrue(self.ranges != other)
+			self.assertFalse(other == self.ranges)
+			self.assertTrue(other != self.ranges)
+
+	def testContains(self):
+		self.assertTrue(10 in self.ranges)
+		self.assertTrue(40 in self.ranges)
+		self.assertFalse(45 in self.ranges)
+		self.assertTrue(TimeRange(12, 35) in self.ranges)
+		self.assertFalse((35, 55) in self.ranges)
+		self.assertEquals([False, True, False, True, False],
+			self.ranges.contains_timestamps([5, 20, 41, 60, 61]))
+
+	def testOverlaps(self):
+		self.assertTrue(self.ranges.overlaps((35, 55)))
+		self.assertTrue(self.ranges.overlaps(TimeRange(0, 10)))
+		self.assertFalse(self.ranges.overlaps((41, 49)))
+		self.assertFalse(self.ranges.overlaps(TimeRange(61, 100)))
+
+	def testSetOperations(self):
+		other = TimeRangeSet([(0, 12), (38, 52), (60, 100)])
+		self.assertEquals([(0, 100)], (self.ranges | other).to_dbus())
+		self.assertEquals([(10, 12), (38, 40), (50, 52), (60, 60)],
+			(self.ranges & other).to_dbus())
+		self.assertEquals([(13, 37), (53, 59)],
+			(self.ranges - other).to_dbus())
+		self.assertEquals([(10, 14), (26, 40), (50, 60)],
+			self.ranges.difference(TimeRange(15, 25)).to_dbus())
+		self.assertEquals([(0, 9), (41, 49), (61, 70)],
+			TimeRangeSet([(0, 70)]).difference(self.ranges).to_dbus())
+		self.assertEquals(self.ranges,
+			self.ranges.intersection(TimeRange.always()))
+		self.assertFalse(self.ranges - self.ranges)
+
+class MimetypesTest(unittest.TestCase):
+
+	def testInterpretation(self):
+		self.assertEquals(Interpretation.TEXT_DOCUMENT,
+			mimetypes.get_interpretation_for_mimetype("text/plain"))
+		self.assertEquals(None,
+			mimetypes.get_interpretation_for_mimetype("asdfasdf"))
+		self.assertEquals(Interpretation.DOCUMENT,
+			mimetypes.get_interpretation_for_mimetype(
+				"application/x-applix-FOOOOBAR!"))
+		self.assertEquals(Interpretation.SPREADSHEET,
+			mimetypes.get_interpretation_for_mimetype(
+				"application/x-applix-spreadsheet"))
+
+	def testRegexOrder(self):
+		# The first matching pattern wins, as with a linear scan
+		for mimetype in ("application/vnd.oasis.opendocument.text-master",
+			"application/vnd.ms-excel.sheet.macroEnabled.12",
+			"application/vnd.foo", "image/x-dvi", "image/foo",
+			"video/ogg", "text/foo"):
+			expected = None
+			for pattern, interpretation in mimetypes.MIMES_REGEX:
+				if pattern.match(mimetype):
+					expected = interpretation
+					break
+			for i in range(2):
+				self.assertEquals(expected,
+					mimetypes.get_interpretation_for_mimetype(mimetype))
+
+	def testManifestation(self):
+		self.assertEquals(Manifestation.FILE_DATA_OBJECT,
+			mimetypes.get_manifestation_for_uri("file:///tmp/foo.txt"))
+		self.assertEquals(Manifestation.WEB_DATA_OBJECT,
+			mimetypes.get_manifestation_for_uri("https://x.org/a://b"))
+		self.assertEquals(None,
+			mimetypes.get_manifestation_for_uri("asdf://asdfasdf"))
+		self.assertEquals(None, mimetypes.get_manifestation_for_uri("file"))
+
+	def testReplacedTables(self):
+		schemes, mimes_regex = mimetypes.SCHEMES, mimetypes.MIMES_REGEX
+		self.assertEquals(None,
+			mimetypes.get_manifestation_for_uri("foo://bar"))
+		try:
+			mimetypes.SCHEMES = schemes + (("foo://",
+				Manifestation.REMOTE_DATA_OBJECT),)
+			mimetypes.MIMES_REGEX = mimetypes.make_regex_tuple(
+				("foo/.*", Interpretation.DOCUMENT))
+			self.assertEquals(Manifestation.REMOTE_DATA_OBJECT,
+				mimetypes.get_manifestation_for_uri("foo://bar"))
+			self.assertEquals([Interpretation.DOCUMENT, None],
+				mimetypes.get_interpretations_for_mimetypes(
+					["foo/bar", "image/foo"]))
+		finally:
+			mimetypes.SCHEMES, mimetypes.MIMES_REGEX = schemes, mimes_regex
+		self.assertEquals(None,
+			mimetypes.get_manifestation_for_uri("foo://bar"))
+		self.assertEquals(Interpretation.IMAGE,
+			mimetypes.get_interpretation_for_mimetype("image/foo"))
+
+	def testClassifySubjects(self):
+		subjects = [
+			Subject.new_for_values(uri="file:///tmp/a.png",
+				mimetype="image/png"),
+			Subject.new_for_values(uri="http://x.org/", mimetype="text/html"),
+			Subject.new_for_values(uri="foo:bar", mimetype="foo/bar"),
+		]
+		self.assertEquals([
+			(Interpretation.RASTER_IMAGE, Manifestation.FILE_DATA_OBJECT),
+			(Interpretation.HTML_DOCUMENT, Manifestation.WEB_DATA_OBJECT),
+			(None, None)], mimetypes.classify_subjects(subjects))
+		self.assertEquals([Interpretation.RASTER_IMAGE, None],
+			mimetypes.get_interpretations_for_mimetypes(
+				["image/png", "foo/bar"]))
+		self.assertEquals([Manifestation.FILE_DATA_OBJECT, None],
+			mimetypes.get_manifestations_for_uris(["file:///a", "foo:bar"]))
+
+	def testOriginForUri(self):
+		self.assertEquals("file:///home/user",
+			mimetypes.get_origin_for_uri("file:///home/user/a.txt"))
+		self.assertEquals("file:///home",
+			mimetypes.get_origin_for_uri("file:///home/user/"))
+		self.assertEquals("file:///",
+			mimetypes.get_origin_for_uri("file:///a.txt"))
+		self.assertEquals("http://x.org",
+			mimetypes.get_origin_for_uri("http://x.org/page"))
+		self.assertEquals(None, mimetypes.get_origin_for_uri("http://x.org"))
+		self.assertEquals(None, mimetypes.get_origin_for_uri("foo:bar"))
+
+	def testSubjectClassifier(self):
+		events = [Event.new_for_values(subjects=[
+			Subject.new_for_values(uri="file:///tmp/a.png",
+				mimetype="image/png"),
+			Subject.new_for_values(uri="http://x.org/b",
+				interpretation=Interpretation.WEBSITE, origin="http://x.org/"),
+			Subject.new_for_values(uri="foo:bar")])]
+		classifier = mimetypes.SubjectClassifier()
+		self.assertEquals(2, classifier.enrich_events(events))
+		first, second, third = events[0].subjects
+		self.assertEquals(Interpretation.RASTER_IMAGE, first.interpretation)
+		self.assertEquals(Manifestation.FILE_DATA_OBJECT, first.manifestation)
+		self.assertEquals("file:///tmp", first.origin)
+		self.assertEquals(Interpretation.WEBSITE, second.interpretation)
+		self.assertEquals(Manifestation.WEB_DATA_OBJECT, second.manifestation)
+		self.assertEquals("http://x.org/", second.origin)
+		self.assertEquals(["", "", ""], [third.interpretation,
+			third.manifestation, third.origin])
+		self.assertEquals(0, classifier.enrich_events(events))
+
+		subject = Subject.new_for_values(uri="file:///tmp/a.txt")
+		mimetypes.SubjectClassifier(fill_origin=False).enrich_subjects(
+			[subject])
+		self.assertEquals("", subject.origin)
+
+	def testCacheSize(self):
+		classifier = mimetypes.Classifier({}, mimetypes.MIMES_REGEX, (),
+			cache_size=2)
+		for i in range(5):
+			self.assertEquals(Interpretation.IMAGE,
+				classifier.get_interpretation("image/x-%d" % i))
+			self.assertTrue(len(classifier._cache) <= 2)
+
+class EventBatchTest(unittest.TestCase):
+
+	def setUp(self):
+		self.events = parse_events("test/data/five_events.js")
+		for i, event in enumerate(self.events):
+			event[0][Event.Id] = str(i + 1)
+		self.batch = EventBatch.new_for_structs(self.events + [NULL_EVENT])
+
+	def testRows(self):
+		self.assertEquals(6, len(self.batch))
+		self.assertEquals(self.events + [None], list(self.batch))
+		self.assertEquals(self.events[-1], self.batch[-2])
+		self.assertEquals([1, 2, 3, 4, 5, 0], self.batch.get_ids())
+		self.assertTrue(self.batch.is_null(5))
+		self.assertEquals(["file:///tmp/bar.txt"],
+			self.batch.get_subject_values(3, Subject.Uri))
+
+	def testEventsWithoutId(self):
+		event = Event.new_for_values(timestamp=5,
+			interpretation="stfu:OpenEvent", subject_uri="file:///tmp/foo")
+		batch = EventBatch.new_for_events([event, None])
+		self.assertFalse(batch.is_null(0))
+		self.assertEquals(event, batch[0])
+		self.assertEquals(None, batch[1])
+		self.assertEquals([0], batch.filter_time_range(
+			TimeRange(0, 10)).get_ids())
+		self.assertEquals(event, batch.filter_values(
+			interpretation="stfu:OpenEvent")[0])
+		self.assertTrue(batch.select([1, 0]).is_null(0))
+
+	def testSelect(self):
+		self.assertEquals([2, 3], self.batch[1:3].get_ids())
+		self.assertEquals([5, 1], self.batch.select([4, 0]).get_ids())
+		self.assertEquals(self.events[1], self.batch.select([1])[0])
+
+	def testFilterValues(self):
+		self.assertEquals([1, 5], self.batch.filter_values(
+			interpretation="stfu:OpenEvent").get_ids())
+		self.assertEquals([4], self.batch.filter_values(
+			subject_uri="file:///tmp/bar.txt").get_ids())
+		self.assertEquals([], self.batch.filter_values(
+			actor="unknown").get_ids())
+		self.assertRaises(ValueError, self.batch.filter_values, foo="bar")
+
+	def testFilterTimeRange(self):
+		self.assertEquals([2, 3], self.batch.filter_time_range(
+			TimeRange(130, 150)).get_ids())
+
+	def testFilter(self):
+		template = Event.new_for_values(subject_uri="file:///tmp/*")
+		self.assertEquals(
+			[event.id for event in self.events
+				if event.matches_template(template)],
+			self.batch.filter(lambda event: event is not None and
+				event.matches_template(template)).get_ids())
+
+	def testSortByTimestamp(self):
+		ordered = sorted(self.events, key=lambda event: int(event.timestamp))
+		self.assertEquals([event.id for event in ordered],
+			self.batch.select(range(5)).sort_by_timestamp().get_ids())
+		self.assertEquals([event.id for event in reversed(ordered)],
+			self.batch.select(range(5)).sort_by_timestamp(True).get_ids())
+
+def get_matching_test_events():
+	events = parse_events("test/data/five_events.js")
+	events.append(Event.new_for_values(
+		interpretation=Interpretation.MODIFY_EVENT,
+		subject_interpretation=Interpretation.AUDIO,
+		subject_manifestation=Manifestation.FILE_DATA_OBJECT))
+	events.append(Event.new_for_values(interpretation="stfu:OpenEvent"))
+	return events
+
+class TemplateMatcherTest(unittest.TestCase):
+
+	TEMPLATES = [
+		Event.new_for_values(interpretation="stfu:OpenEvent"),
+		Event.new_for_values(interpretation="!stfu:OpenEvent"),
+		Event.new_for_values(actor="firefox*"),
+		Event.new_for_values(actor="!!firefox"),
+		Event.new_for_values(subject_uri="file:///tmp/*"),
+		Event.new_for_values(subject_uri="!file:///tmp/foo.txt"),
+		Event.new_for_values(subject_mimetype="!text/*"),
+		Event.new_for_values(subject_interpretation="stfu:Bee"),
+		Event.new_for_values(subjects=[
+			Subject.new_for_values(mimetype="meat/raw"),
+			Subject.new_for_values(text="*")]),
+		Event.new_for_values(subjects=[Subject()]),
+	]
+
+	def setUp(self):
+		self.events = get_matching_test_events()
+
+	def assertSameResults(self, templates):
+		matches = compile_templates(templates)
+		for event in self.events:
+			expected = any(event.matches_template(template)
+				for template in templates)
+			self.assertEquals(expected, matches(event))
+			self.assertEquals(expected, matches(CompactEvent(event)))
+
+	def testSingleTemplates(self):
+		for template in self.TEMPLATES:
+			self.assertSameResults([template])
+
+	def testSeveralTemplates(self):
+		self.assertSameResults(self.TEMPLATES[2:5])
+
+	def testSymbols(self):
+		self.assertSameResults([
+			Event.new_for_values(interpretation=Interpretation.EVENT_INTERPRETATION),
+			Event.new_for_values(subject_interpretation=Interpretation.MEDIA),
+		])
+		self.assertSameResults([Event.new_for_values(
+			subject_manifestation="!" + Manifestation.FILE_DATA_OBJECT)])
+
+	def testNoTemplates(self):
+		self.assertEquals(self.events, compile_templates([]).filter(self.events))
+
+	def testGetMatchingTemplates(self):
+		matches = compile_templates(self.TEMPLATES[:2])
+		self.assertEquals([0], matches.get_matching_templates(self.events[0]))
+		self.assertEquals([1], matches.get_matching_templates(self.events[1]))
+
+	def testStorage(self):
+		self.assertRaises(ValueError, compile_templates,
+			[Event.new_for_values(subject_storage="net")])
+
+class TemplateIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.events = get_matching_test_events()
+		self.templates = TemplateMatcherTest.TEMPLATES + [
+			Event.new_for_values(actor="firefox"),
+			Event.new_for_values(actor="!!firefox", subject_uri="file:///tmp/*"),
+			Event.new_for_values(interpretation=Interpretation.EVENT_INTERPRETATION),
+			Event.new_for_values(manifestation="stfu:EpicFailActivity"),
+			Event.new_for_values(subject_uri="file:///tmp/foo.txt"),
+			Event.new_for_values(subject_uri="*"),
+		]
+		self.index = TemplateIndex()
+		self.handles = [self.index.add(template, i)
+			for (i, template) in enumerate(self.templates)]
+
+	def assertSameResults(self):
+		for event in self.events:
+			expected = [handle for (handle, template)
+				in zip(self.handles, self.templates)
+				if event.matches_template(template)]
+			self.assertEquals(expected, self.index.matches(event))
+			self.assertEquals(bool(expected), self.index.matches_any(event))
+
+	def testMatches(self):
+		self.assertEquals(len(self.templates), len(self.index))
+		self.assertSameResults()
+
+	def testCandidates(self):
+		# Templates with other actors aren't even looked at
+		event = Event.new_for_values(actor="gedit")
+		self.assertFalse(self.handles[10] in self.index.candidates(event))
+
+	def testData(self):
+		self.assertEquals(3, self.index[self.handles[3]])
+		self.assertEquals(self.templates[3],
+			self.index.get_template(self.handles[3]))
+
+	def testRemove(self):
+		for i in (15, 14, 10, 12, 0):
+			self.index.remove(self.handles[i])
+			del self.handles[i]
+			del self.templates[i]
+			self.assertSameResults()
+		for handle in self.handles:
+			self.index.remove(handle)
+		self.assertEquals(0, len(self.index))
+		self.assertEquals([{}, set(), set()], self.index._uri_trie)
+
+class StringPoolTest(unittest.TestCase):
+
+	def setUp(self):
+		get_string_pool().enabled = True
+
+	def tearDown(self):
+		get_string_pool().enabled = False
+		get_string_pool().clear()
+
+	def testIntern(self):
+		pool = StringPool()
+		first = pool.intern("".join(["text/", "plain"]))
+		second = pool.intern("".join(["text/", "plain"]))
+		self.assertTrue(first is second)
+		self.assertEquals("", pool.intern(""))
+		stats = pool.get_stats()
+		self.assertEquals(1, stats["size"])
+		self.assertEquals(1, stats["hits"])
+		self.assertEquals(1, stats["misses"])
+		self.assertEquals(0.5, stats["hit_rate"])
+		self.assertTrue(stats["bytes_saved"] > 0)
+
+	def testMaxSize(self):
+		pool = StringPool(max_size=1)
+		pool.intern("a")
+		value = "".join(["b", "c"])
+		self.assertTrue(pool.intern(value) is value)
+		self.assertEquals(1, pool.get_stats()["size"])
+
+	def testInternKeepsType(self):
+		pool = StringPool()
+		pool.intern(u"text/plain")
+		self.assertEquals(str, type(pool.intern("text/plain")))
+		data = ["", "", "".join(["text/", "plain"])]
+		interned = pool.intern_fields(data, (2,))
+		self.assertTrue(interned is not data)
+		self.assertTrue(interned[2] is pool.intern("text/plain"))
+		self.assertTrue(data[2] is not interned[2])
+		self.assertEquals(["", "", "text/plain"], data)
+
+	def testEventKeepsFieldTypes(self):
+		Event([[u"", u"1", u"http://x/I", u"http://x/M", u"actor", u""]])
+		data = ["", "2", "http://x/I", "http://x/M", "actor", ""]
+		event = Event([data])
+		self.assertEquals(str, type(event.interpretation))
+		self.assertEquals(str, type(event.actor))
+
+	def testDecodedEventsShareStrings(self):
+		events = [Event(event) for event in
+			parse_events("test/data/five_events.js")]
+		self.assertTrue(events[0].interpretation is events[4].interpretation)
+		self.assertTrue(events[1].subjects[0].mimetype is
+			events[2].subjects[0].mimetype)
+		self.assertTrue(get_string_pool().get_stats()["hits"] > 0)
+
+	def testOnlyLowCardinalityFields(self):
+		origin = "".join(["file:///", "tmp"])
+		Subject.new_for_values(origin="file:///tmp")
+		self.assertTrue(Subject.new_for_values(origin=origin).origin is origin)
+
+if __name__ == "__main__":
+	testutils.run()
+
+# vim:noexpandtab:ts=4:sw=4
@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+# -.- coding: utf-8 -.-
+
+# localdb-test.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from zeitgeist.datamodel import (Event, Subject, Interpretation, Manifestation,
+	TimeRange, StorageState, ResultType)
+from zeitgeist.localdb import LocalDatabase, TableLookup
+
+import testutils
+from testutils import parse_events
+
+class LocalDatabaseTest(testutils.RemoteTestCase):
+	"""
+	Check that querying the database directly gives the same results as
+	asking the engine
+	"""
+
+	def setUp(self):
+		self._db_file = tempfile.mktemp(".sqlite", prefix="zeitgeist.localdb.")
+		super(LocalDatabaseTest, self).setUp(self._db_file)
+		self.ids = self.insertEventsAndWait(
+			parse_events("test/data/five_events.js"))
+		self.db = LocalDatabase(self._db_file)
+
+	def tearDown(self):
+		self.db.close()
+		super(LocalDatabaseTest, self).tearDown()
+		os.remove(self._db_file)
+
+	def assertSameResult(self, templates, time_range=TimeRange.always(),
+		storage_state=StorageState.Any, num_events=0,
+		result_type=ResultType.MostRecentEvents):
+		expected = self.findEventIdsAndWait(templates, timerange=time_range,
+			storage_state=storage_state, num_events=num_events,
+			result_type=result_type)
+		self.assertEquals(list(expected), self.db.find_event_ids(time_range,
+			templates, storage_state, num_events, result_type))
+
+	@staticmethod
+	def normalize(events):
+		return [(event.id, event[0][1:], event.subjects,
+			str(bytearray(event.payload))) if event else None
+			for event in events]
+
+	def testGetEvents(self):
+		expected = self.getEventsAndWait(self.ids + [1000])
+		self.assertEquals(self.normalize(expected),
+			self.normalize(self.db.get_events(self.ids + [1000])))
+		self.assertEquals(None, self.db.get_events([1000])[0])
+
+	def testFindEventIds(self):
+		self.assertSameResult([])
+		self.assertSameResult([], TimeRange(125, 155))
+		self.assertSameResult([], num_events=2)
+		self.assertSameResult([Event.new_for_values(
+			interpretation="stfu:OpenEvent")])
+		self.assertSameResult([Event.new_for_values(actor="firefox*")])
+		self.assertSameResult([Event.new_for_values(actor="!firefox*")])
+		self.assertSameResult([Event.new_for_values(
+			subject_uri="file:///tmp/*", subject_mimetype="!text/plain")])
+		self.assertSameResult([Event.new_for_values(
+			subject_interpretation=Interpretation.MEDIA),
+			Event.new_for_values(subject_text="this item has no text... rly!")])
+		self.assertSameResult([], storage_state=StorageState.Available)
+		self.assertRaises(ValueError, self.db.find_event_ids,
+			event_templates=[Event.new_for_values(interpretation="foo*")])
+
+	def testResultTypes(self):
+		for name, result_type in ResultType.iteritems():
+			self.assertSameResult([], result_type=result_type)
+
+	def testIterEvents(self):
+		expected = self.findEventsForTemplatesAndWait([],
+			result_type=ResultType.LeastRecentEvents)
+		self.assertEquals(self.normalize(expected),
+			self.normalize(self.db.iter_events(
+				result_type=ResultType.LeastRecentEvents, batch_size=2)))
+		self.assertEquals(self.normalize(expected[:3]),
+			self.normalize(self.db.iter_events(num_events=3,
+				result_type=ResultType.LeastRecentEvents, batch_size=2)))
+		self.assertEquals(self.normalize(expected[::-1][:3]),
+			self.normalize(self.db.iter_events(num_events=3, batch_size=2)))
+
+	def testIterEventsWithSubjectTemplate(self):
+		event = Event.new_for_values(timestamp=1000,
+			interpretation=Interpretation.ACCESS_EVENT,
+			manifestation=Manifestation.USER_ACTIVITY,
+			actor="application://gedit.desktop",
+			subjects=[
+				Subject.new_for_values(uri="file:///tmp/a.txt",
+					interpretation=Interpretation.DOCUMENT),
+				Subject.new_for_values(uri="file:///tmp/b.png",
+					interpretation=Interpretation.IMAGE)])
+		self.insertEventsAndWait([event])
+		templates = [Event.new_for_values(
+			subject_interpretation=Interpretation.DOCUMENT)]
+		expected = self.findEventsForTemplatesAndWait(templates)
+		self.assertEquals(2, len(expected[0].subjects))
+		self.assertEquals(self.normalize(expected),
+			self.normalize(self.db.iter_events(event_templates=templates)))
+		self.assertEquals(self.normalize(expected),
+			self.normalize(self.db.find_events(event_templates=templates)))
+
+	def testTableLookup(self):
+		connection = sqlite3.connect(self._db_file)
+		actors = TableLookup(connection, "actor")
+		self.assertEquals(-1, actors.id_try_string("application://new.desktop"))
+		self.insertEventsAndWait([Event.new_for_values(timestamp=1000,
+			interpretation=Interpretation.ACCESS_EVENT,
+			manifestation=Manifestation.USER_ACTIVITY,
+			actor="application://new.desktop", subject_uri="file:///new")])
+		actor_id = actors.id_try_string("application://new.desktop")
+		self.assertNotEquals(-1, actor_id)
+		self.assertEquals("application://new.desktop",
+			actors.get_value(actor_id))
+		self.assertEquals("", actors.get_value(0))
+		uris = TableLookup(connection, "uri", preload=False)
+		uri_id = uris.id_try_string("file:///new")
+		self.assertEquals("file:///new", uris.get_value(uri_id))
+		connection.close()
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim:noexpandtab:ts=4:sw=4
@@ -42,7 +42,10 @@ DBusGMainLoop(set_as_default=True)
 from dbus.exceptions import DBusException
 
 from zeitgeist.datamodel import (Event, Subject, Interpretation, Manifestation,
-	TimeRange, StorageState, DataSource, NULL_EVENT, ResultType)
+	TimeRange, StorageState, DataSource, NULL_EVENT, ResultType,
+	get_timestamp_for_now)
+
+from zeitgeist.client import Monitor, MonitorHub
 
 import testutils
 from testutils import parse_events, import_events, asyncTestMethod
@@ -315,6 +318,172 @@ class ZeitgeistMonitorTest(testutils.RemoteTestCase):
 		
 		self.assertEquals(3, len(result))
 
+	def testMonitorCoalescing(self):
+		result = []
+		mainloop = self.create_mainloop()
+		events = parse_events("test/data/five_events.js")
+
+		@asyncTestMethod(mainloop)
+		def notify_insert_handler(time_range, events):
+			result.append((time_range, events))
+			mainloop.quit()
+
+		@asyncTestMethod(mainloop)
+		def notify_delete_handler(time_range, event_ids):
+			mainloop.quit()
+			self.fail("Unexpected delete notification")
+
+		self.client.install_monitor(TimeRange.always(), [],
+			notify_insert_handler, notify_delete_handler,
+			coalesce_delay=500)
+		for event in events:
+			self.client.insert_event(event)
+		mainloop.run()
+
+		self.assertEquals(1, len(result))
+		time_range, inserted = result[0]
+		self.assertEquals(5, len(inserted))
+		timestamps = [int(event.timestamp) for event in inserted]
+		self.assertEquals(TimeRange(min(timestamps), max(timestamps)),
+			time_range)
+
+	def testMonitorCoalescingCancelsDeletedEvents(self):
+		result = []
+		mainloop = self.create_mainloop()
+		events = parse_events("test/data/five_events.js")
+
+		@asyncTestMethod(mainloop)
+		def notify_insert_handler(time_range, events):
+			result.extend(event.id for event in events)
+
+		@asyncTestMethod(mainloop)
+		def notify_delete_handler(time_range, event_ids):
+			mainloop.quit()
+			self.fail("Unexpected delete notification")
+
+		def inserted(ids):
+			self.client.delete_events(ids[:2],
+				reply_handler=lambda time_range: mainloop.quit())
+
+		monitor = self.client.install_monitor(TimeRange.always(), [],
+			notify_insert_handler, notify_delete_handler,
+			coalesce_delay=60000)
+		self.client.insert_events(events, inserted)
+		mainloop.run()
+
+		# Wait for the delete notification to get here
+		gobject.timeout_add(200, mainloop.quit)
+		mainloop.run()
+		monitor.flush()
+		self.assertEquals(3, len(result))
+
+	def testMonitorHub(self):
+		result1 = []
+		result2 = []
+		mainloop = self.create_mainloop()
+		events = parse_events("test/data/five_events.js")
+		hub = MonitorHub(self.client)
+
+		@asyncTestMethod(mainloop)
+		def check_ok():
+			if len(result1) == 2 and len(result2) == 1:
+				mainloop.quit()
+
+		@asyncTestMethod(mainloop)
+		def notify_insert_handler1(time_range, events):
+			result1.extend(events)
+			check_ok()
+
+		@asyncTestMethod(mainloop)
+		def notify_insert_handler2(time_range, events):
+			result2.extend(events)
+			check_ok()
+
+		hub.install_monitor(TimeRange.always(),
+			[Event.new_for_values(interpretation="stfu:OpenEvent")],
+			notify_insert_handler1, lambda *args: None)
+		hub.install_monitor([153, 166],
+			[Event.new_for_values(subject_uri="file:///tmp/bar.txt")],
+			notify_insert_handler2, lambda *args: None)
+		# The hub installs its monitor once the main loop is idle
+		gobject.idle_add(lambda *args: self.client.insert_events(events))
+		mainloop.run()
+
+		self.assertEquals(2, len(result1))
+		self.assertEquals(1, len(result2))
+
+	def testMonitorHubRetiresMonitors(self):
+		mainloop = self.create_mainloop()
+		hub = MonitorHub(self.client)
+
+		def run_until(condition):
+			def check():
+				if condition():
+					mainloop.quit()
+					return False
+				return True
+			gobject.timeout_add(50, check)
+			mainloop.run()
+
+		hub.install_monitor(TimeRange.always(), [],
+			lambda *args: None, lambda *args: None)
+		run_until(lambda: hub._monitor is not None)
+		first = hub._monitor
+		hub.install_monitor(TimeRange.always(),
+			[Event.new_for_values(interpretation="stfu:OpenEvent")],
+			lambda *args: None, lambda *args: None)
+		# The replaced monitor isn't exported on the bus anymore
+		run_until(lambda: hub._monitor is not first and
+			not list(first.locations))
+
+	def testMonitorResumeToken(self):
+		result = []
+		mainloop = self.create_mainloop()
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events)
+		resume_file = os.path.join(tempfile.mkdtemp(), "token.json")
+		token = {"timestamp": 0, "event_id": ids[1]}
+
+		@asyncTestMethod(mainloop)
+		def notify_insert_handler(time_range, events):
+			result.extend(events)
+			mainloop.quit()
+
+		monitor = self.client.install_monitor(TimeRange.always(), [],
+			notify_insert_handler, lambda *args: None,
+			resume_token=token, resume_file=resume_file)
+		mainloop.run()
+
+		self.assertEquals(ids[2:], [event.id for event in result])
+		self.assertEquals(max(ids), monitor.get_resume_token()["event_id"])
+		self.client.remove_monitor(monitor)
+		self.assertEquals(max(ids),
+			Monitor._load_resume_token(resume_file)["event_id"])
+		shutil.rmtree(os.path.dirname(resume_file))
+
+	def testMonitorResumeTokenSeeded(self):
+		mainloop = self.create_mainloop()
+		events = parse_events("test/data/five_events.js")
+		# Only events logged after the monitor is installed are missed
+		future = get_timestamp_for_now() + 3600000
+		for event in events[:2]:
+			event.timestamp = future
+		ids = self.insertEventsAndWait(events)
+
+		monitor = self.client.install_monitor(TimeRange.always(), [],
+			lambda *args: None, lambda *args: None, resume=True)
+		def check():
+			if monitor.get_resume_token() is not None:
+				mainloop.quit()
+				return False
+			return True
+		gobject.timeout_add(50, check)
+		mainloop.run()
+
+		token = monitor.get_resume_token()
+		self.assertEquals(max(ids[:2]), token["event_id"])
+		self.assertTrue(token["timestamp"] < future)
+
 if __name__ == "__main__":
 	unittest.main()
 
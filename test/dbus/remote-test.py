@@ -25,9 +25,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import signal
+from xml.etree import ElementTree
 
 from zeitgeist.datamodel import (Event, Subject, Interpretation, Manifestation,
-	TimeRange, StorageState, DataSource, NULL_EVENT, ResultType)
+	TimeRange, StorageState, DataSource, NULL_EVENT, ResultType, EventBatch)
+
+from zeitgeist.client import (BulkInserter, AsyncZeitgeistClient, gather,
+	KNOWN_INTERFACES, get_bus)
 
 import testutils
 from testutils import parse_events, import_events
@@ -59,6 +63,239 @@ class ZeitgeistRemoteAPITest(testutils.RemoteTestCase):
 		self.assertEquals(len(filter(None, result)), len(events))
 		self.assertEquals(len(filter(lambda event: event is None, result)), 2)
 
+	def testGetEventsAsBatch(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events) + [1000]
+		mainloop = self.create_mainloop()
+		result = []
+		
+		def callback(batch):
+			result.append(batch)
+			mainloop.quit()
+		
+		self.client.get_events(ids, callback, as_batch=True)
+		mainloop.run()
+		
+		batch = result[0]
+		self.assertTrue(isinstance(batch, EventBatch))
+		self.assertEquals(len(ids), len(batch))
+		self.assertEquals(ids[:-1], batch.get_ids()[:-1])
+		self.assertEquals(None, batch[-1])
+		for event, retrieved in zip(events, batch):
+			self.assertEventsEqual(retrieved, event)
+
+	def testBulkInserter(self):
+		events = parse_events("test/data/five_events.js")
+		inserter = BulkInserter(self.client, batch_size=2, max_in_flight=2)
+		for event in events:
+			self.assertTrue(inserter.insert(event) in (True, False))
+		ids = inserter.wait()
+		self.assertEquals(len(events), len(ids))
+		self.assertEquals(0, ids.count(0))
+		
+		stats = inserter.get_stats()
+		self.assertEquals(5, stats["inserted"])
+		self.assertEquals(3, stats["batches"])
+		self.assertEquals(0, stats["errors"])
+		self.assertEquals(0, stats["buffered"] + stats["in_flight"])
+		
+		# The ids are in the same order as the inserted events
+		for event, retrieved in zip(events, self.getEventsAndWait(ids)):
+			self.assertEventsEqual(retrieved, event)
+
+	def testIterEvents(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events)
+		self.deleteEventsAndWait([ids[2]])
+		expected = self.findEventsForTemplatesAndWait([], num_events=0)
+		self.assertEquals(4, len(expected))
+		for page_size, prefetch in ((1, 0), (2, 1), (10, 3)):
+			result = list(self.client.iter_events([], page_size=page_size,
+				prefetch=prefetch))
+			self.assertEquals([event.id for event in expected],
+				[event.id for event in result])
+
+	def testEventCache(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events)
+		self.client.enable_event_cache(max_size=10)
+		try:
+			first = self.getEventsAndWait(ids + [1000])
+			second = self.getEventsAndWait(list(reversed(ids)))
+			self.assertEquals(None, first[-1])
+			self.assertEquals(list(reversed(first[:-1])), second)
+			stats = self.client.get_event_cache_stats()
+			self.assertEquals(5, stats["size"])
+			self.assertEquals(5, stats["hits"])
+			self.assertEquals(6, stats["misses"])
+			
+			# Deleted events are dropped from the cache
+			self.deleteEventsAndWait([ids[0]])
+			self.assertEquals(None, self.getEventsAndWait([ids[0]])[0])
+			self.assertEquals(1,
+				self.client.get_event_cache_stats()["invalidations"])
+		finally:
+			self.client.disable_event_cache()
+		self.assertEquals(None, self.client.get_event_cache_stats())
+
+	def testEventCacheDeletionInFlight(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events[:2])
+		mainloop = self.create_mainloop()
+		result = []
+		
+		def collect_events_and_quit(events):
+			result.extend(events)
+			mainloop.quit()
+		
+		self.client.enable_event_cache()
+		try:
+			self.client.get_events(ids, collect_events_and_quit)
+			# Deleted before the reply arrives, as if notified meanwhile
+			self.client._event_cache.remove([ids[0]])
+			mainloop.run()
+			self.assertEquals(ids, [event.id for event in result])
+			stats = self.client.get_event_cache_stats()
+			self.assertEquals(1, stats["size"])
+			self.assertEquals(None, self.client._event_cache.get(ids[0]))
+		finally:
+			self.client.disable_event_cache()
+
+	def testQueryCache(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events[:4])
+		template = Event.new_for_values(interpretation="stfu:OpenEvent")
+		self.client.enable_query_cache()
+		try:
+			first = self.findEventIdsAndWait([template])
+			self.assertEquals(first, self.findEventIdsAndWait([template]))
+			stats = self.client.get_query_cache_stats()
+			self.assertEquals((1, 1), (stats["hits"], stats["misses"]))
+			
+			# Inserting a matching event invalidates the result
+			new_ids = self.insertEventsAndWait(events[4:])
+			self.assertTrue(new_ids[0] in self.findEventIdsAndWait([template]))
+			self.assertEquals(1,
+				self.client.get_query_cache_stats()["invalidations"])
+			
+			# So does deleting an event
+			self.deleteEventsAndWait(new_ids)
+			self.assertEquals(first, self.findEventIdsAndWait([template]))
+			self.assertEquals(2,
+				self.client.get_query_cache_stats()["invalidations"])
+		finally:
+			self.client.disable_query_cache()
+
+	def testRequestCoalescing(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events)
+		template = Event.new_for_values(interpretation="stfu:OpenEvent")
+		expected_ids = self.findEventIdsAndWait([template])
+		self.client.enable_request_coalescing(get_events_window=50)
+		try:
+			mainloop = self.create_mainloop()
+			results = []
+
+			def callback(result):
+				results.append(result)
+				if len(results) == 4:
+					mainloop.quit()
+
+			# Identical queries share their reply
+			self.client.find_event_ids_for_templates([template], callback)
+			self.client.find_event_ids_for_templates([template], callback)
+			# Both GetEvents calls end up in a single request
+			self.client.get_events(ids[:3], callback)
+			self.client.get_events(ids[2:] + [1000], callback)
+			mainloop.run()
+
+			self.assertEquals(expected_ids, results[0])
+			self.assertTrue(results[0] is results[1])
+			events = sorted(results[2:], key=len)
+			self.assertEquals(ids[:3], [event.id for event in events[0]])
+			self.assertEquals(ids[2:], [event.id for event in events[1][:-1]])
+			self.assertEquals(None, events[1][-1])
+		finally:
+			self.client.disable_request_coalescing()
+
+	def testAsyncClient(self):
+		client = AsyncZeitgeistClient(self.client)
+		events = parse_events("test/data/five_events.js")
+		template = Event.new_for_values(interpretation="stfu:OpenEvent")
+		stream = client.monitor(TimeRange.always(), [template])
+		try:
+			ids = client.insert_events(events).result()
+			self.assertEquals(5, len(ids))
+
+			futures = [client.find_event_ids([template]),
+				client.get_events(ids)]
+			found_ids, found_events = gather(futures).result()
+			self.assertEquals(set(found_ids),
+				set(event.id for event in found_events
+					if event.interpretation == "stfu:OpenEvent"))
+
+			kind, time_range, inserted = stream.next()
+			self.assertEquals("insert", kind)
+			self.assertEquals(set(found_ids),
+				set(event.id for event in inserted))
+		finally:
+			stream.close()
+		self.assertEquals([], list(stream))
+
+		time_range = client.delete_events(ids).result()
+		self.assertTrue(isinstance(time_range, TimeRange))
+		self.assertEquals([None] * 5, client.get_events(ids).result())
+
+	def testFollow(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events[:3])
+		mainloop = self.create_mainloop()
+		result = []
+		new_ids = []
+
+		def caught_up():
+			result.append("live")
+			self.client.insert_events(events[3:], new_ids.extend)
+
+		def events_handler(events):
+			result.extend(event.id for event in events)
+			if len(result) == 6:
+				mainloop.quit()
+
+		follower = self.client.follow([], events_handler, page_size=2,
+			caught_up_handler=caught_up)
+		try:
+			mainloop.run()
+		finally:
+			follower.cancel()
+		self.assertTrue(follower.is_live())
+		self.assertEquals(ids + ["live"] + new_ids, result)
+
+	def testFollowDeleteDuringBackfill(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events[:3])
+		mainloop = self.create_mainloop()
+		result = []
+		deleted = []
+
+		def events_handler(events):
+			if not result:
+				# Delete an event which was already delivered
+				self.client.delete_events([events[0].id])
+			result.extend(event.id for event in events)
+
+		def delete_handler(event_ids):
+			deleted.extend(event_ids)
+			mainloop.quit()
+
+		follower = self.client.follow([], events_handler, page_size=2,
+			delete_handler=delete_handler)
+		try:
+			mainloop.run()
+		finally:
+			follower.cancel()
+		self.assertEquals([ids[0]], deleted)
+
 	def testInsertAndDeleteEvent(self):
 		# Insert an event
 		events = parse_events("test/data/single_event.js")
@@ -245,6 +482,24 @@ class ZeitgeistRemoteAPITestAdvanced(testutils.RemoteTestCase):
 		self.assertEquals(Manifestation.FILE_DATA_OBJECT, subject.manifestation)  # FIXME
 		self.assertEquals("", subject.interpretation) # FIXME
 
+	def testInsertWithSubjectClassification(self):
+		event = Event.new_for_values(
+			interpretation=Interpretation.ACCESS_EVENT,
+			manifestation=Manifestation.USER_ACTIVITY,
+			actor="application://eog.desktop",
+			subjects=[Subject.new_for_values(uri="file:///tmp/a.png",
+				mimetype="image/png", text="a.png")])
+		self.client.enable_subject_classification()
+		try:
+			ids = self.insertEventsAndWait([event])
+		finally:
+			self.client.disable_subject_classification()
+
+		subject = self.getEventsAndWait(ids)[0].subjects[0]
+		self.assertEquals(Interpretation.RASTER_IMAGE, subject.interpretation)
+		self.assertEquals(Manifestation.FILE_DATA_OBJECT, subject.manifestation)
+		self.assertEquals("file:///tmp", subject.origin)
+
 	def testInsertIncompleteEvent(self):
 		events = parse_events("test/data/incomplete_events.js")
 
@@ -511,6 +766,31 @@ class ZeitgeistRemoteInterfaceTest(testutils.RemoteTestCase):
 		self.assertEqual(code, 0)
 		self.spawn_daemon()
 
+	def testKnownInterfaces(self):
+		"""
+		The static interface descriptions used instead of introspection
+		must match what the engine actually exports.
+		"""
+		for interface_name, path in (
+			("org.gnome.zeitgeist.Log", "log/activity"),
+			("org.gnome.zeitgeist.DataSourceRegistry", "data_source_registry"),
+			("org.gnome.zeitgeist.Blacklist", "blacklist")):
+			proxy = get_bus().get_object(
+				"org.gnome.zeitgeist.Engine", "/org/gnome/zeitgeist/" + path)
+			xml = ElementTree.fromstring(proxy.Introspect(
+				dbus_interface="org.freedesktop.DBus.Introspectable"))
+			for node in xml.findall("interface"):
+				if node.attrib["name"] == interface_name:
+					break
+			methods = dict((method.attrib["name"], "".join(arg.attrib["type"]
+				for arg in method.findall("arg")
+				if arg.attrib.get("direction", "in") == "in"))
+				for method in node.findall("method"))
+			signals = [signal.attrib["name"] for signal in node.findall("signal")]
+			self.assertEquals(methods, KNOWN_INTERFACES[interface_name][0])
+			self.assertEquals(sorted(signals),
+				sorted(KNOWN_INTERFACES[interface_name][1]))
+
 
 class ZeitgeistRemotePropertiesTest(testutils.RemoteTestCase):
 
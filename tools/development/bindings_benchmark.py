@@ -0,0 +1,381 @@
+#! /usr/bin/env python
+# -.- coding: utf-8 -.-
+
+# Zeitgeist - Micro-benchmarks for the Python bindings
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# USAGE
+#
+#  ./bindings_benchmark.py [-n NUM_EVENTS] [BENCHMARK...]
+#
+# Without arguments all benchmarks are run. Unless noted otherwise the
+# benchmarks work on synthetic data and don't need a running Zeitgeist.
+
+import os
+import sys
+import time
+import random
+import subprocess
+from optparse import OptionParser
+
+from zeitgeist.datamodel import *
+from zeitgeist.datamodel import Symbol
+from zeitgeist import mimetypes
+
+ACTORS = ['application://%s.desktop' % name for name in
+    ('firefox', 'gedit', 'nautilus', 'totem', 'eog', 'evince', 'empathy')]
+MIMETYPES = ('text/plain', 'text/x-python', 'image/png', 'audio/x-vorbis+ogg',
+    'application/pdf', 'video/mp4', 'application/x-desktop')
+
+def deep_sizeof(obj, seen=None):
+    """
+    Return the number of bytes used by `obj' and everything it references,
+    counting each object only once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, Symbol):
+        # Symbols are shared by everyone, don't count them
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen)
+            for (k, v) in obj.iteritems())
+    return size
+
+def copy_str(text):
+    return (text + ' ')[:-1]
+
+def make_structs(num_events):
+    """
+    Generate a list of raw event structs, like those received from D-Bus.
+    """
+    interpretations = list(Interpretation.EVENT_INTERPRETATION.get_children())
+    subject_interpretations = [Interpretation.DOCUMENT, Interpretation.AUDIO,
+        Interpretation.VIDEO, Interpretation.IMAGE, Interpretation.SOURCE_CODE]
+    structs = []
+    timestamp = int(time.time() * 1000) - num_events * 1000
+    for i in xrange(num_events):
+        timestamp += random.randint(1, 2000)
+        # Build new strings, as a D-Bus reply would
+        event = [str(i + 1), str(timestamp),
+            copy_str(random.choice(interpretations)),
+            copy_str(Manifestation.USER_ACTIVITY),
+            copy_str(random.choice(ACTORS)), '']
+        subjects = []
+        for j in xrange(random.randint(1, 2)):
+            uri = 'file:///home/user/folder%d/file%d.txt' % (i % 50, i)
+            subjects.append([uri, copy_str(random.choice(subject_interpretations)),
+                copy_str(Manifestation.FILE_DATA_OBJECT),
+                'file:///home/user/folder%d' % (i % 50),
+                copy_str(random.choice(MIMETYPES)), 'file%d.txt' % i,
+                'c6ad2a3b-3a8d-4bd9-9b94-b2d7b7f5d8c1', uri,
+                'file:///home/user/folder%d' % (i % 50)])
+        structs.append([event, subjects, ''])
+    return structs
+
+def timeit(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def report(label, seconds, num_items, size=None):
+    line = '  %-32s %8.3f s %10.0f items/s' % (label, seconds,
+        num_items / max(seconds, 1e-9))
+    if size is not None:
+        line += ' %9.1f bytes/item' % (float(size) / num_items)
+    print line
+
+def benchmark_compact(num_events):
+    """
+    Compare memory usage, decoding time and matching throughput of Event
+    and CompactEvent.
+    """
+    structs = make_structs(num_events)
+    template = Event.new_for_values(
+        interpretation=Interpretation.ACCESS_EVENT,
+        subjects=[Subject.new_for_values(uri='file:///home/user/folder1*')])
+    for event_type in (Event, CompactEvent):
+        seconds, events = timeit(map, event_type.new_for_struct, structs)
+        report('%s decode' % event_type.__name__, seconds, num_events,
+            deep_sizeof(events))
+        seconds, matches = timeit(lambda: [ev for ev in events
+            if ev.matches_template(template)])
+        report('%s matches_template' % event_type.__name__, seconds,
+            num_events)
+
+def benchmark_decode(num_events):
+    """
+    Compare decoding D-Bus replies with Event.new_for_struct and with
+    Event.new_for_raw_struct, without and with accessing the subjects.
+    """
+    for access_subjects in (False, True):
+        for constructor in (Event.new_for_struct, Event.new_for_raw_struct):
+            # Use fresh structs for each run, so that none of them finds
+            # the strings of the previous one already pooled
+            structs = make_structs(num_events)
+            def decode():
+                events = map(constructor, structs)
+                if access_subjects:
+                    for event in events:
+                        event.subjects[0].uri
+                return events
+            seconds, events = timeit(decode)
+            label = 'Event.%s' % constructor.__name__
+            if access_subjects:
+                label += ' + subjects'
+            report(label, seconds, num_events)
+
+def benchmark_string_pool(num_events):
+    """
+    Compare memory usage and decoding time of Event with and without the
+    string pool.
+    """
+    pool = get_string_pool()
+    was_enabled = pool.enabled
+    for enabled in (False, True):
+        pool.clear()
+        pool.enabled = enabled
+        # Use fresh structs for each run, built before starting the timer
+        structs = make_structs(num_events)
+        seconds, events = timeit(map, Event.new_for_struct, structs)
+        report('Event decode (pool %s)' % ('on' if enabled else 'off'),
+            seconds, num_events, deep_sizeof(events))
+        del structs, events
+    pool.enabled = was_enabled
+    stats = pool.get_stats()
+    print '  %d pooled strings, %.1f%% hit rate, %d bytes saved' % (
+        stats['size'], stats['hit_rate'] * 100, stats['bytes_saved'])
+
+def benchmark_matcher(num_events):
+    """
+    Compare filtering events through Event.matches_template and through
+    a compiled TemplateMatcher.
+    """
+    events = map(Event.new_for_struct, make_structs(num_events))
+    templates = [
+        Event.new_for_values(interpretation=Interpretation.ACCESS_EVENT,
+            actor='!application://firefox*'),
+        Event.new_for_values(subject_interpretation=Interpretation.MEDIA),
+        Event.new_for_values(subject_uri='file:///home/user/folder1*',
+            subject_mimetype='text/*'),
+    ]
+    seconds, expected = timeit(lambda: [ev for ev in events
+        if any(ev.matches_template(t) for t in templates)])
+    report('matches_template', seconds, num_events)
+    seconds, matches = timeit(compile_templates, templates)
+    report('compile_templates', seconds, len(templates))
+    seconds, result = timeit(matches.filter, events)
+    report('TemplateMatcher.filter', seconds, num_events)
+    assert result == expected
+
+def benchmark_index(num_events, num_templates=2000):
+    """
+    Compare dispatching events against a large rule set with
+    compile_templates and with a TemplateIndex.
+    """
+    # Matching without the index is slow, keep the number of events sane
+    num_events = min(num_events, 10000)
+    events = map(Event.new_for_struct, make_structs(num_events))
+    interpretations = list(Interpretation.EVENT_INTERPRETATION.get_children())
+    templates = []
+    for i in xrange(num_templates):
+        kind = i % 4
+        if kind == 0:
+            template = Event.new_for_values(actor='application://app%d.desktop' % i)
+        elif kind == 1:
+            template = Event.new_for_values(
+                interpretation=random.choice(interpretations),
+                subject_uri='file:///home/user/folder%d/*' % i)
+        elif kind == 2:
+            template = Event.new_for_values(
+                subject_uri='file:///home/user/folder%d/file%d.txt' % (i % 50, i))
+        else:
+            template = Event.new_for_values(subject_uri='http://site%d/*' % i)
+        templates.append(template)
+
+    matches = compile_templates(templates)
+    seconds, expected = timeit(lambda: map(matches.get_matching_templates,
+        events))
+    report('TemplateMatcher (%d templates)' % num_templates, seconds,
+        num_events)
+    seconds, index = timeit(TemplateIndex, templates)
+    report('TemplateIndex build', seconds, num_templates)
+    seconds, result = timeit(lambda: map(index.matches, events))
+    report('TemplateIndex (%d templates)' % num_templates, seconds,
+        num_events)
+    assert result == expected
+
+def benchmark_symbols(num_events):
+    """
+    Measure the subtype checks done when matching events against templates
+    with interpretations and manifestations.
+    """
+    structs = make_structs(num_events)
+    pairs = [(copy_str(event[0][2]), Interpretation.EVENT_INTERPRETATION)
+        for event in structs]
+    pairs += [(copy_str(subject[1]), Interpretation.MEDIA)
+        for event in structs for subject in event[1]]
+    seconds, result = timeit(lambda: [Symbol.uri_is_child_of(child, parent)
+        for (child, parent) in pairs])
+    report('Symbol.uri_is_child_of', seconds, len(pairs))
+
+def benchmark_mimetypes(num_events):
+    """
+    Compare classifying subjects with a linear scan over the mimetype
+    patterns and schemes and with the compiled mimetypes.Classifier.
+    """
+    subjects = [Subject(subject) for event in make_structs(num_events)
+        for subject in event[1]]
+    uri_prefixes = ['file:///home/user/', 'https://example.org/',
+        'smb://server/', 'note://']
+    mimetypes_ = [copy_str(subject.mimetype) for subject in subjects]
+    uris = [random.choice(uri_prefixes) + subject.text for subject in subjects]
+
+    def get_interpretation(mimetype):
+        interpretation = mimetypes.MIMES.get(mimetype, None)
+        if interpretation is not None:
+            return interpretation
+        for pattern, interpretation in mimetypes.MIMES_REGEX:
+            if pattern.match(mimetype):
+                return interpretation
+        return None
+
+    def get_manifestation(uri):
+        for scheme, manifestation in mimetypes.SCHEMES:
+            if uri.startswith(scheme):
+                return manifestation
+        return None
+
+    seconds, expected = timeit(map, get_interpretation, mimetypes_)
+    report('linear mimetype lookup', seconds, len(subjects))
+    seconds, result = timeit(mimetypes.get_interpretations_for_mimetypes,
+        mimetypes_)
+    report('Classifier mimetype lookup', seconds, len(subjects))
+    assert result == expected
+    seconds, expected = timeit(map, get_manifestation, uris)
+    report('linear scheme lookup', seconds, len(subjects))
+    seconds, result = timeit(mimetypes.get_manifestations_for_uris, uris)
+    report('Classifier scheme lookup', seconds, len(subjects))
+    assert result == expected
+
+    def clear_subjects():
+        for subject in subjects:
+            subject.interpretation = subject.manifestation = \
+                subject.origin = ''
+        return subjects
+
+    def enrich_by_hand():
+        for subject in clear_subjects():
+            subject.interpretation = \
+                mimetypes.get_interpretation_for_mimetype(subject.mimetype) or ''
+            subject.manifestation = \
+                mimetypes.get_manifestation_for_uri(subject.uri) or ''
+            subject.origin = mimetypes.get_origin_for_uri(subject.uri) or ''
+
+    seconds, result = timeit(enrich_by_hand)
+    report('per subject enrichment', seconds, len(subjects))
+    classifier = mimetypes.SubjectClassifier()
+    seconds, result = timeit(lambda: classifier.enrich_subjects(
+        clear_subjects()))
+    report('SubjectClassifier enrichment', seconds, len(subjects))
+
+def benchmark_import(num_events, repeat=20):
+    """
+    Measure the startup time of short-lived processes importing the
+    bindings, with and without touching the ontology. Doesn't use events.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    for label, code in (
+        ('python (baseline)', 'pass'),
+        ('import datamodel', 'import zeitgeist.datamodel'),
+        ('import datamodel + ontology', 'from zeitgeist.datamodel import '
+            'Interpretation; Interpretation.AUDIO'),
+        ('import client', 'import zeitgeist.client')):
+        def run():
+            for i in xrange(repeat):
+                subprocess.check_call([sys.executable, '-c', code], env=env)
+        seconds, result = timeit(run)
+        print '  %-32s %8.1f ms' % (label, seconds * 1000 / repeat)
+
+STARTUP_CODE = """
+import time
+start = time.time()
+from zeitgeist.client import ZeitgeistDBusInterface
+iface = ZeitgeistDBusInterface(introspect=%s)
+iface.get_extension('DataSourceRegistry', 'data_source_registry')
+connected = time.time()
+iface.GetEvents([])
+print connected - start, time.time() - start
+"""
+
+def benchmark_startup(num_events, repeat=20):
+    """
+    Measure how long short-lived processes take to connect to the engine
+    and to get the reply to a first request, with the static interface
+    descriptions and with introspection. Needs a running Zeitgeist,
+    doesn't use events.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    for introspect in (False, True):
+        timings = []
+        for i in xrange(repeat):
+            output = subprocess.Popen([sys.executable, '-c',
+                STARTUP_CODE % introspect], env=env,
+                stdout=subprocess.PIPE).communicate()[0]
+            timings.append(map(float, output.split()))
+        label = 'introspection' if introspect else 'static interfaces'
+        for column, what in enumerate(('connect', 'first reply')):
+            print '  %-32s %8.1f ms' % ('%s (%s)' % (what, label),
+                sum(timing[column] for timing in timings) * 1000 / repeat)
+
+BENCHMARKS = [
+    ('compact', benchmark_compact),
+    ('decode', benchmark_decode),
+    ('pool', benchmark_string_pool),
+    ('matcher', benchmark_matcher),
+    ('index', benchmark_index),
+    ('symbols', benchmark_symbols),
+    ('mimetypes', benchmark_mimetypes),
+    ('import', benchmark_import),
+    ('startup', benchmark_startup),
+]
+
+def main():
+    parser = OptionParser(usage='%prog [options] [BENCHMARK...]')
+    parser.add_option('-n', dest='num_events', type='int', default=100000,
+        help='number of events to work on (default: %default)')
+    options, args = parser.parse_args()
+
+    names = [name for (name, func) in BENCHMARKS]
+    for name in args:
+        if name not in names:
+            parser.error('unknown benchmark %r, try one of: %s' % (name,
+                ', '.join(names)))
+
+    random.seed(0)
+    for name, func in BENCHMARKS:
+        if args and name not in args:
+            continue
+        print '%s (%d events):' % (name, options.num_events)
+        func(options.num_events)
+
+if __name__ == '__main__':
+    main()
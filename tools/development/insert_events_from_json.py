@@ -31,7 +31,7 @@ import os
 import sys
 
 from zeitgeist.datamodel import *
-from zeitgeist.client import ZeitgeistDBusInterface
+from zeitgeist.client import ZeitgeistClient, BulkInserter
 
 # Import parse_events from testutils.py
 path = os.path.join(os.path.dirname(__file__), '../../test/dbus')
@@ -42,12 +42,14 @@ from testutils import parse_events
 LIMIT = 100
 
 def insert_events(events):
-    iface = ZeitgeistDBusInterface()
+    inserter = BulkInserter(ZeitgeistClient(), batch_size=LIMIT,
+        ready_handler=lambda: sys.stdout.write('.'))
     print "Inserting %d events..." % len(events)
-    while len(events):
-        iface.InsertEvents(events[:LIMIT])
-        events = events[LIMIT:]
-        print "."
+    for event in events:
+        if not inserter.insert(event):
+            inserter.wait_until_ready()
+    inserter.wait()
+    print
     print 'OK.'
 
 def main():
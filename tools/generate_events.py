@@ -36,7 +36,7 @@ from gi.repository import GLib, GObject
 
 from zeitgeist import mimetypes
 from zeitgeist.datamodel import *
-from zeitgeist.client import ZeitgeistDBusInterface
+from zeitgeist.client import ZeitgeistClient, BulkInserter
 
 class EventGenerator:
 
@@ -239,35 +239,6 @@ class TimestampGenerator():
     def current_time():
         return int(time.time() * 1000)
 
-class EventInserter():
-
-    BUFFER_SIZE = 1000
-
-    _log = None
-    _buffer = None
-    _events_inserted = None
-
-    def __init__(self):
-        self._log = ZeitgeistDBusInterface()
-        self._buffer = []
-        self._events_inserted = 0
-
-    def insert(self, event):
-        buffer_full = len(self._buffer) >= self.BUFFER_SIZE
-        if buffer_full:
-            self.flush()
-        self._buffer.append(event)
-        return buffer_full
-
-    def flush(self):
-        if self._buffer:
-            self._log.InsertEvents(self._buffer)
-            self._events_inserted += len(self._buffer)
-            self._buffer = []
-
-    def get_insertion_count(self):
-        return self._events_inserted
-
 def main():
     limit = '10000000' if len(sys.argv) < 2 else sys.argv[1]
     if len(sys.argv) > 2 or not limit.isdigit():
@@ -275,18 +246,20 @@ def main():
         sys.exit(1)
     limit = int(limit)
 
-    event_inserter = EventInserter()
+    event_inserter = BulkInserter(ZeitgeistClient(), batch_size=1000)
     try:
         generator = EventGenerator()
         for i in xrange(limit):
             event = generator.get_event()
             event.payload = 'generate_events.py'
-            if event_inserter.insert(event):
-                print "Inserted %d events." % i
+            if not event_inserter.insert(event):
+                print "Inserted %d events." % \
+                    event_inserter.get_stats()['inserted']
+                event_inserter.wait_until_ready()
     except KeyboardInterrupt:
         pass
-    event_inserter.flush()
-    print "Inserted %d events. Done." % event_inserter.get_insertion_count()
+    event_inserter.wait()
+    print "Inserted %d events. Done." % event_inserter.get_stats()['inserted']
 
 if __name__ == '__main__':
     main()